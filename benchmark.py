@@ -1,10 +1,37 @@
-import unittest
+"""
+Benchmark of kNN engines, CRUD, pagination and bulk create
+Dataset is generated by seed into benchmark.db, results are written
+as JSON and compared with baseline results if it is set.
+Example:
+	python benchmark.py --dataset clustered --size 100000 --output results.json
+	python benchmark.py --baseline results.json --threshold 0.2
+	python benchmark.py --sqlite-default --skip knn crud pages bulk
+	python benchmark.py --rtree --engines rtree sql split
+	python benchmark.py --group-commit --writers 16 --skip knn crud pages bulk concurrency
+"""
+from __future__ import print_function
+import argparse
+import json
+import platform
 import random
-from math import sqrt
+import sys
+import threading
 import time
-from pprint import pprint
+from math import ceil, sqrt
 
-from main import app
+import consts
+if "--sqlite-default" in sys.argv:
+	# Baseline without SQLite tuning, WAL mode is persistent so it is reset
+	consts.BenchmarkConfig.SQLITE_PRAGMAS = consts.OrderedDict((("journal_mode", "DELETE"),))
+	consts.BenchmarkConfig.SQLALCHEMY_POOL_SIZE = None
+	consts.BenchmarkConfig.SQLALCHEMY_MAX_OVERFLOW = None
+	consts.BenchmarkConfig.SQLALCHEMY_POOL_TIMEOUT = None
+if "--rtree" in sys.argv:
+	consts.BenchmarkConfig.RTREE_INDEX = True
+if "--group-commit" in sys.argv:
+	consts.BenchmarkConfig.GROUP_COMMIT = True
+
+from main import app, encodeCursor, reloadIndexes, knn_engines, indexes
 from flask_api import status
 
 from consts import *
@@ -14,34 +41,359 @@ db.app = app
 db.init_app(app)
 client = app.test_client()
 
-# define initial variables
-initial_user_id_list = [1, 2, 3]
-radius_list = [10, 50, 100 , 500, 1000]
 baseurl = "v1/NN"
+DATASETS = ("uniform", "clustered", "skewed")
+# Page numbers of pagination benchmark
+PAGE_DEPTHS = (0, 10, 100, 1000, 5000)
 
-def testAllDistanceSearch(radius, initial_user_id):
-	url = "%s/users/knn?R=%s&U=%s&dist=Y" % (baseurl, radius, initial_user_id)
-	res = client.get(url)
-	return eval(res.get_data())["result"]
+def generateUsers(dataset, size, rnd):
+	"""
+	Return size unique (x, y) points of dataset
+	Points fill square with side sqrt(4 * size) so density is 1/4:
+	- uniform: evenly over the square
+	- clustered: gaussian clusters with random centers
+	- skewed: concentrated near (0, 0) corner by power law
+	"""
+	side = int(sqrt(4 * size))
+	centers = [(rnd.uniform(0, side), rnd.uniform(0, side)) for i in range(20)]
+	sigma = side / 20.0
+	points = set()
+	while len(points) < size:
+		if dataset == "uniform":
+			x, y = rnd.uniform(0, side), rnd.uniform(0, side)
+		elif dataset == "clustered":
+			cx, cy = rnd.choice(centers)
+			x, y = rnd.gauss(cx, sigma), rnd.gauss(cy, sigma)
+		else:
+			x, y = side * rnd.random() ** 3, side * rnd.random() ** 3
+		if 0 <= x < side and 0 <= y < side:
+			points.add((int(x), int(y)))
+	return sorted(points), side
 
-def testBinarySearch(radius, initial_user_id):
-	url = "%s/users/knn?R=%s&U=%s" % (baseurl, radius, initial_user_id)
-	res = client.get(url)
-	return eval(res.get_data())["result"]
+def fillDB(points):
+	"""
+	Replace DB users by points and reload in-memory indexes
+	"""
+	DBUser.query.delete()
+	db.session.commit()
+	connection = db.session.get_bind().raw_connection()
+	try:
+		connection.cursor().executemany(
+			"INSERT INTO db_user (x, y) VALUES (?, ?)", points)
+		connection.commit()
+	finally:
+		connection.close()
+	reloadIndexes()
+
+def percentile(values, p):
+	"""
+	Nearest rank percentile of sorted values
+	"""
+	rank = int(ceil(p / 100.0 * len(values)))
+	return values[min(max(rank, 1), len(values)) - 1]
+
+def summarize(latencies, total_time):
+	latencies = sorted(latencies)
+	ms = lambda value: round(value * 1000, 3)
+	return {
+		"count": len(latencies),
+		"mean_ms": ms(sum(latencies) / len(latencies)),
+		"p50_ms": ms(percentile(latencies, 50)),
+		"p95_ms": ms(percentile(latencies, 95)),
+		"p99_ms": ms(percentile(latencies, 99)),
+		"qps": round(len(latencies) / total_time, 2) if total_time else None,
+	}
+
+def measure(requests):
+	"""
+	Run (method, url, data) requests and return latency summary
+	Unexpected status stops the benchmark
+	"""
+	latencies = list()
+	start = time.time()
+	for method, url, data in requests:
+		init_time = time.time()
+		res = getattr(client, method)(url, data = data)
+		latencies.append(time.time() - init_time)
+		if res.status_code not in (status.HTTP_200_OK, status.HTTP_201_CREATED):
+			raise RuntimeError("%s %s returned %s" % (method, url, res.status_code))
+	return summarize(latencies, time.time() - start)
+
+def benchmarkKnn(args, user_ids, rnd):
+	results = dict()
+	# By default all engines with index enabled or without index
+	engines = args.engines or [
+		engine.name for engine in knn_engines.values() \
+		if engine.index is None or indexes.get(engine.index) is not None
+	] + ["auto"]
+	for engine_name in engines:
+		for radius in args.radii:
+			requests = [
+				("get", "%s/users/knn?R=%s&U=%s&engine=%s" \
+					% (baseurl, radius, rnd.choice(user_ids), engine_name), None)
+				for i in range(args.queries)
+			]
+			results["knn.%s.R%s" % (engine_name, radius)] = measure(requests)
+	return results
+
+def benchmarkCRUD(args, side, rnd):
+	# New users are placed outside of dataset square to avoid conflicts
+	points = [(side + i, side + rnd.randrange(side)) for i in range(args.queries)]
+	requests = [
+		("post", "%s/users" % baseurl, json.dumps({"x": x, "y": y})) \
+		for x, y in points
+	]
+	results = {"crud.create": measure(requests)}
+	created = [user.id for user in DBUser.query.filter(DBUser.x >= side)]
+	results["crud.get"] = measure([
+		("get", "%s/users/%s" % (baseurl, user_id), None) for user_id in created
+	])
+	results["crud.update"] = measure([
+		("post", "%s/users/%s" % (baseurl, user_id), json.dumps({"x": x + side})) \
+		for user_id, (x, y) in zip(created, points)
+	])
+	results["crud.delete"] = measure([
+		("delete", "%s/users/%s" % (baseurl, user_id), None) for user_id in created
+	])
+	return results
+
+def benchmarkPages(args, size):
+	"""
+	Measure offset and cursor pages at every depth of PAGE_DEPTHS
+	within dataset, cursor latency should stay flat with depth
+	"""
+	pagesize = 100
+	results = dict()
+	for page in PAGE_DEPTHS:
+		if page * pagesize >= size:
+			break
+		url = "%s/users?pagesize=%s" % (baseurl, pagesize)
+		cursor_url = url
+		if page:
+			user = DBUser.query.order_by(DBUser.id).offset(page * pagesize - 1).first()
+			cursor_url = "%s&after=%s" % (url, encodeCursor(user.id))
+		results["pages.offset.p%s" % page] = measure(
+			[("get", "%s&page=%s" % (url, page), None)] * args.queries)
+		results["pages.cursor.p%s" % page] = measure(
+			[("get", cursor_url, None)] * args.queries)
+	return results
+
+def benchmarkBulk(args, side, rnd):
+	# Every request creates new batch of users outside of dataset square
+	requests = list()
+	for number in range(args.bulk_requests):
+		lines = ["x,y"] + [
+			"%s,%s" % (2 * side + i, 2 * side + number) \
+			for i in range(args.bulk_size)
+		]
+		requests.append(("post", "%s/users/bulk?format=csv" % baseurl, "\n".join(lines)))
+	result = measure(requests)
+	result["users_per_second"] = round(result["qps"] * args.bulk_size, 2)
+	DBUser.query.filter(DBUser.x >= side).delete()
+	db.session.commit()
+	reloadIndexes()
+	return {"bulk.csv": result}
+
+def benchmarkConcurrency(args, user_ids, side, rnd):
+	"""
+	Reader threads request kNN by main algorythm on DB
+	while writer thread creates users for args.duration seconds
+	"""
+	stop = threading.Event()
+	reads = [list() for i in range(args.readers)]
+	writes = list()
+	errors = list()
+
+	def reader(latencies, seed):
+		reader_client = app.test_client()
+		reader_rnd = random.Random(seed)
+		while not stop.is_set():
+			url = "%s/users/knn?R=10&U=%s&engine=split" % (baseurl, reader_rnd.choice(user_ids))
+			init_time = time.time()
+			res = reader_client.get(url)
+			latencies.append(time.time() - init_time)
+			if res.status_code != status.HTTP_200_OK:
+				errors.append(res.status_code)
+
+	def writer():
+		writer_client = app.test_client()
+		number = 0
+		while not stop.is_set():
+			data = json.dumps({"x": 3 * side + number, "y": 3 * side})
+			init_time = time.time()
+			res = writer_client.post("%s/users" % baseurl, data = data)
+			writes.append(time.time() - init_time)
+			if res.status_code != status.HTTP_201_CREATED:
+				errors.append(res.status_code)
+			number += 1
+
+	threads = [threading.Thread(target = reader, args = (latencies, rnd.random())) \
+		for latencies in reads]
+	threads.append(threading.Thread(target = writer))
+	start = time.time()
+	for thread in threads:
+		thread.start()
+	time.sleep(args.duration)
+	stop.set()
+	for thread in threads:
+		thread.join()
+	total_time = time.time() - start
+
+	DBUser.query.filter(DBUser.x >= 3 * side).delete()
+	db.session.commit()
+	reloadIndexes()
+	read = summarize(sum(reads, list()), total_time)
+	read["errors"] = len(errors)
+	return {
+		"concurrency.read": read,
+		"concurrency.write": summarize(writes, total_time),
+	}
+
+def benchmarkWrites(args, side, rnd):
+	"""
+	Writer threads create users for args.duration seconds,
+	every tenth write is a conflict
+	"""
+	stop = threading.Event()
+	writes = [list() for i in range(args.writers)]
+	errors = list()
+
+	def writer(latencies, number):
+		writer_client = app.test_client()
+		count = 0
+		while not stop.is_set():
+			x = 3 * side + count * args.writers + number
+			if count % 10 == 9:
+				x -= args.writers
+			data = json.dumps({"x": x, "y": 4 * side})
+			init_time = time.time()
+			res = writer_client.post("%s/users" % baseurl, data = data)
+			latencies.append(time.time() - init_time)
+			if res.status_code not in (status.HTTP_201_CREATED, status.HTTP_409_CONFLICT):
+				errors.append(res.status_code)
+			count += 1
+
+	threads = [threading.Thread(target = writer, args = (latencies, number)) \
+		for number, latencies in enumerate(writes)]
+	start = time.time()
+	for thread in threads:
+		thread.start()
+	time.sleep(args.duration)
+	stop.set()
+	for thread in threads:
+		thread.join()
+	total_time = time.time() - start
+
+	DBUser.query.filter(DBUser.x >= 3 * side).delete()
+	db.session.commit()
+	reloadIndexes()
+	result = summarize(sum(writes, list()), total_time)
+	result["errors"] = len(errors)
+	return {"writes.create": result}
+
+def compare(results, baseline, threshold):
+	"""
+	Return (name, baseline p50, current p50) of benchmarks
+	slower than baseline by more than threshold fraction
+	"""
+	regressions = list()
+	for name, result in sorted(results.items()):
+		base = baseline.get(name)
+		if base is None:
+			continue
+		if result["p50_ms"] > base["p50_ms"] * (1 + threshold):
+			regressions.append((name, base["p50_ms"], result["p50_ms"]))
+	return regressions
+
+def parseArgs(argv):
+	parser = argparse.ArgumentParser(description = "NN benchmark")
+	parser.add_argument("--dataset", choices = DATASETS, default = "uniform")
+	parser.add_argument("--size", type = int, default = 100000, \
+		help = "users count, 10k-5M")
+	parser.add_argument("--seed", type = int, default = 1)
+	parser.add_argument("--queries", type = int, default = 100, \
+		help = "requests per benchmark")
+	parser.add_argument("--radii", type = int, nargs = "+", default = [10, 50, 100, 500])
+	parser.add_argument("--engines", nargs = "+", \
+		help = "kNN engines, all registered ones and auto by default")
+	parser.add_argument("--bulk-size", type = int, default = 1000)
+	parser.add_argument("--bulk-requests", type = int, default = 10)
+	parser.add_argument("--readers", type = int, default = 4, \
+		help = "kNN reader threads of concurrency benchmark")
+	parser.add_argument("--duration", type = float, default = 10, \
+		help = "seconds of concurrency and writes benchmarks")
+	parser.add_argument("--writers", type = int, default = 8, \
+		help = "writer threads of writes benchmark")
+	parser.add_argument("--sqlite-default", action = "store_true", \
+		help = "run without SQLite PRAGMAs and connection pool")
+	parser.add_argument("--rtree", action = "store_true", \
+		help = "enable SQLite R*Tree index and rtree engine")
+	parser.add_argument("--group-commit", action = "store_true", \
+		help = "commit single user writes by groups")
+	parser.add_argument("--skip", nargs = "+", default = [], \
+		choices = ("knn", "crud", "pages", "bulk", "concurrency", "writes"))
+	parser.add_argument("--output", default = "benchmark.json")
+	parser.add_argument("--baseline", help = "JSON results to compare with")
+	parser.add_argument("--threshold", type = float, default = 0.2, \
+		help = "allowed p50 slowdown against baseline, 0.2 is 20%%")
+	return parser.parse_args(argv)
+
+def main(argv):
+	args = parseArgs(argv)
+	rnd = random.Random(args.seed)
+	print("Generate %s %s users by seed %s..." % (args.size, args.dataset, args.seed))
+	points, side = generateUsers(args.dataset, args.size, rnd)
+	fillDB(points)
+	user_ids = [user_id for user_id, in db.session.query(DBUser.id)]
 
-if __name__ == '__main__':
 	results = dict()
-	print "\ntest | attempt_id | radius | knn | exec_time"
-	for test in (testBinarySearch, testAllDistanceSearch):
-		timelist = list()
-		for radius in radius_list:
-			for initial_user_id in initial_user_id_list:
-				init_time = time.time()
-				knn = test(radius, initial_user_id)
-				exec_time = time.time() - init_time
-				timelist.append(exec_time)
-				print "\n", test.__name__, initial_user_id, radius, knn, exec_time, 
-		results[test.__name__] = sum(timelist) / len(timelist)
-	print "\n\nRESULTS:\n"
-	for testname in results:
-		print "\t%s: %s" %(testname, results[testname])
+	for name, run in (
+			("knn", lambda: benchmarkKnn(args, user_ids, rnd)),
+			("crud", lambda: benchmarkCRUD(args, side, rnd)),
+			("pages", lambda: benchmarkPages(args, args.size)),
+			("bulk", lambda: benchmarkBulk(args, side, rnd)),
+			("concurrency", lambda: benchmarkConcurrency(args, user_ids, side, rnd)),
+			("writes", lambda: benchmarkWrites(args, side, rnd))):
+		if name in args.skip:
+			continue
+		print("Run %s benchmark..." % name)
+		results.update(run())
+
+	print("\nbenchmark | p50_ms | p95_ms | p99_ms | qps")
+	for name, result in sorted(results.items()):
+		print(name, result["p50_ms"], result["p95_ms"], result["p99_ms"], result["qps"])
+
+	output = {
+		"meta": {
+			"dataset": args.dataset,
+			"size": args.size,
+			"seed": args.seed,
+			"queries": args.queries,
+			"sqlite": "default" if args.sqlite_default else "tuned",
+			"rtree": args.rtree,
+			"group_commit": args.group_commit,
+			"python": platform.python_version(),
+			"time": int(time.time()),
+		},
+		"results": results,
+	}
+	with open(args.output, "w") as f:
+		json.dump(output, f, indent = 2, sort_keys = True)
+	print("\nResults are written to %s" % args.output)
+
+	if args.baseline:
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+		if baseline["meta"]["dataset"] != args.dataset or baseline["meta"]["size"] != args.size:
+			print("Warning: baseline dataset is %(dataset)s of %(size)s users" % baseline["meta"])
+		regressions = compare(results, baseline["results"], args.threshold)
+		if regressions:
+			print("\nREGRESSIONS (p50 slower by more than %s%%):" % (args.threshold * 100))
+			for name, base, current in regressions:
+				print("\t%s: %s -> %s ms" % (name, base, current))
+			return 1
+		print("\nNo regressions against %s" % args.baseline)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv[1:]))
@@ -1,6 +1,14 @@
+from collections import OrderedDict
+
 BASEURL = "/v1/NN"
 SQL_TESTDATA_COUNT = 100
 MIN_USERS = 100
+MIN_RECT_SIDE = 8
+# Default relative error of approximate kNN count
+APPROX_EPS = 0.01
+# Coordinates range, in-memory indexes and snapshot keep them as int32
+MIN_COORD = -2 ** 31
+MAX_COORD = 2 ** 31 - 1
 
 DBFile = "production.db"
 
@@ -9,12 +17,120 @@ class ProductionConfig(object):
 	DEBUG = False
 	SQLALCHEMY_DATABASE_URI = "sqlite:///%s" % DBFile
 	SQLALCHEMY_TRACK_MODIFICATIONS = True
+	# Pool of DB connections instead of connection per request
+	SQLALCHEMY_POOL_SIZE = 8
+	SQLALCHEMY_MAX_OVERFLOW = 8
+	SQLALCHEMY_POOL_TIMEOUT = 10
+	# Applied to every DB connection: WAL lets reads go on during
+	# write commit, NORMAL sync is safe with WAL, mmap_size in bytes,
+	# negative cache_size in KiB
+	SQLITE_PRAGMAS = OrderedDict((
+		("journal_mode", "WAL"),
+		("synchronous", "NORMAL"),
+		("mmap_size", 268435456),
+		("cache_size", -65536),
+		("busy_timeout", 5000),
+	))
+	# In-memory uniform grid for kNN
+	GRID_INDEX = True
+	GRID_CELL_SIZE = 16
+	# Numpy columns for all distances algorythm
+	COLUMN_INDEX = True
+	COLUMN_CHUNK_SIZE = 65536
+	# KD-tree for kNN and K nearest users, rebuilt in background
+	KDTREE_INDEX = True
+	KDTREE_LEAF_SIZE = 32
+	KDTREE_REBUILD_WRITES = 10000
+	# Fenwick tree of counts over [0, FENWICK_SIZE) square
+	FENWICK_INDEX = True
+	FENWICK_SIZE = 1024
+	# Count, sums, min and max of users and density histogram
+	# of AGGREGATE_CELL_SIZE cells for Info and kNN
+	AGGREGATE_INDEX = True
+	AGGREGATE_CELL_SIZE = 64
+	# Sorted x and y of users for median split of main algorythm
+	QUANTILE_INDEX = True
+	# Vertical strips of users in shard processes with own grid index,
+	# shard with more than SHARD_MAX_USERS is split into two
+	SHARD_INDEX = False
+	SHARD_COUNT = 4
+	SHARD_MAX_USERS = 250000
+	# SQLite R*Tree mirror of users kept by triggers, used by rtree
+	# kNN engine and by rect stats of main algorythm
+	RTREE_INDEX = False
+	# Users inserted by one statement in bulk create
+	BULK_BATCH_SIZE = 1000
+	# Users fetched from DB cursor per export chunk
+	EXPORT_CHUNK_SIZE = 1000
+	# LRU cache of DBUserStats by rect, 0 disables it
+	STATS_CACHE_SIZE = 10000
+	# kNN results cache, 0 disables it
+	KNN_CACHE_SIZE = 1000
+	KNN_CACHE_TTL = 60
+	# Worker threads of main algorythm, 1 evaluates rects in request thread
+	KNN_WORKERS = 4
+	# Rects queue length to evaluate it by workers
+	KNN_INLINE_RECTS = 4
+	# Snapshot of users and log of writes after it for warm start,
+	# log is compacted into snapshot every SNAPSHOT_WAL_RECORDS writes
+	SNAPSHOT_FILE = "production.snapshot"
+	WAL_FILE = "production.wal"
+	SNAPSHOT_WAL_RECORDS = 100000
+	# Single user writes are queued and committed together every
+	# GROUP_COMMIT_MS milliseconds or GROUP_COMMIT_WRITES writes,
+	# response is sent after commit
+	GROUP_COMMIT = False
+	GROUP_COMMIT_MS = 5
+	GROUP_COMMIT_WRITES = 100
 
 class TestingConfig(object):
 	TESTING = True
 	DEBUG = True
 	SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
 	SQLALCHEMY_TRACK_MODIFICATIONS = True
+	SQLITE_PRAGMAS = OrderedDict()
+	GRID_INDEX = True
+	GRID_CELL_SIZE = 16
+	COLUMN_INDEX = True
+	COLUMN_CHUNK_SIZE = 64
+	KDTREE_INDEX = True
+	KDTREE_LEAF_SIZE = 4
+	KDTREE_REBUILD_WRITES = 20
+	FENWICK_INDEX = True
+	FENWICK_SIZE = 1024
+	AGGREGATE_INDEX = True
+	AGGREGATE_CELL_SIZE = 64
+	QUANTILE_INDEX = True
+	SHARD_INDEX = True
+	SHARD_COUNT = 2
+	SHARD_MAX_USERS = 200
+	RTREE_INDEX = True
+	BULK_BATCH_SIZE = 1000
+	EXPORT_CHUNK_SIZE = 3
+	STATS_CACHE_SIZE = 100
+	KNN_CACHE_SIZE = 100
+	KNN_CACHE_TTL = 60
+	KNN_WORKERS = 2
+	KNN_INLINE_RECTS = 2
+	SNAPSHOT_FILE = None
+	GROUP_COMMIT = False
+	GROUP_COMMIT_MS = 1
+	GROUP_COMMIT_WRITES = 100
 
 class BenchmarkConfig(TestingConfig):
 	SQLALCHEMY_DATABASE_URI = "sqlite:///benchmark.db"
+	SQLALCHEMY_POOL_SIZE = ProductionConfig.SQLALCHEMY_POOL_SIZE
+	SQLALCHEMY_MAX_OVERFLOW = ProductionConfig.SQLALCHEMY_MAX_OVERFLOW
+	SQLALCHEMY_POOL_TIMEOUT = ProductionConfig.SQLALCHEMY_POOL_TIMEOUT
+	SQLITE_PRAGMAS = ProductionConfig.SQLITE_PRAGMAS
+	COLUMN_CHUNK_SIZE = ProductionConfig.COLUMN_CHUNK_SIZE
+	KDTREE_LEAF_SIZE = ProductionConfig.KDTREE_LEAF_SIZE
+	KDTREE_REBUILD_WRITES = ProductionConfig.KDTREE_REBUILD_WRITES
+	# Repeated queries should be measured, not cached
+	KNN_CACHE_SIZE = 0
+	KNN_WORKERS = ProductionConfig.KNN_WORKERS
+	KNN_INLINE_RECTS = ProductionConfig.KNN_INLINE_RECTS
+	SHARD_MAX_USERS = ProductionConfig.SHARD_MAX_USERS
+	RTREE_INDEX = ProductionConfig.RTREE_INDEX
+	GROUP_COMMIT = ProductionConfig.GROUP_COMMIT
+	GROUP_COMMIT_MS = ProductionConfig.GROUP_COMMIT_MS
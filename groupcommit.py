@@ -0,0 +1,178 @@
+"""
+Group commit of single user writes
+Write requests are queued and committed together by writer thread
+in one transaction every interval seconds or max_writes writes.
+Request gets its response after the transaction is committed,
+so acknowledged write is as durable as with own commit and the
+durability window is only the wait of queued writes.
+"""
+import threading
+import time
+
+try:
+	import Queue as queue
+except ImportError:
+	import queue
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, DBUser
+
+class GroupWrite(object):
+	"""
+	Base class of queued write
+	apply() changes DB in current transaction and sets status,
+	unique index conflict raises IntegrityError from its flush.
+	sync() applies committed change to in-memory state
+	"""
+	status = None
+	bind = None
+
+	def __init__(self):
+		self.done = threading.Event()
+		self.error = None
+
+	def apply(self):
+		raise NotImplementedError
+
+	def sync(self):
+		pass
+
+def syncCommitted(write, logger):
+	"""
+	Apply committed write to in-memory state
+	Write is in DB anyway, so sync error is logged
+	and does not change write status
+	Return False if sync failed
+	"""
+	try:
+		write.sync()
+	except Exception:
+		logger.exception("Sync of committed %s failed", type(write).__name__)
+		return False
+	return True
+
+class GroupCommitter(object):
+	"""
+	Writer thread committing queued writes by groups
+	"""
+
+	def __init__(self, interval, max_writes, logger):
+		self.interval = interval
+		self.max_writes = max_writes
+		self.logger = logger
+		self.queue = queue.Queue()
+		self.thread = None
+		self.batches = 0
+		self.writes = 0
+		self.max_batch = 0
+		self.sync_errors = 0
+
+	def start(self):
+		self.thread = threading.Thread(target = self._run)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def stop(self):
+		"""
+		Commit queued writes and stop writer thread
+		"""
+		self.queue.put(None)
+		self.thread.join()
+
+	def submit(self, write):
+		"""
+		Queue write and wait until its group is committed
+		Writer session is bound to DB engine of request session
+		"""
+		write.bind = db.session.get_bind(DBUser.__mapper__)
+		self.queue.put(write)
+		write.done.wait()
+		if write.error is not None:
+			raise write.error
+		return write.status
+
+	def _collect(self):
+		"""
+		Return writes queued within interval after the first one,
+		None if writer is stopped
+		"""
+		write = self.queue.get()
+		if write is None:
+			return None
+		batch = [write]
+		deadline = time.time() + self.interval
+		while len(batch) < self.max_writes:
+			timeout = deadline - time.time()
+			if timeout <= 0:
+				break
+			try:
+				write = self.queue.get(timeout = timeout)
+			except queue.Empty:
+				break
+			if write is None:
+				# Stop after this group
+				self.queue.put(None)
+				break
+			batch.append(write)
+		return batch
+
+	def _run(self):
+		while True:
+			batch = self._collect()
+			if batch is None:
+				return
+			db.session().bind_mapper(DBUser, batch[0].bind)
+			try:
+				self._commit(batch)
+			except Exception as e:
+				# Group transaction failed, none of its writes is committed
+				db.session.rollback()
+				for write in batch:
+					write.error = e
+			else:
+				self._count(len(batch))
+				for write in batch:
+					if write.error is None and not syncCommitted(write, self.logger):
+						self.sync_errors += 1
+			finally:
+				db.session.remove()
+				for write in batch:
+					write.done.set()
+
+	def _commit(self, batch):
+		"""
+		Apply writes in one transaction holding write lock,
+		each write is in own SAVEPOINT, so its failure
+		rolls back only this write
+		"""
+		db.session.connection(mapper = DBUser.__mapper__, \
+							execution_options = {"sqlite_begin": "IMMEDIATE"})
+		for write in batch:
+			savepoint = db.session.begin_nested()
+			try:
+				write.apply()
+				savepoint.commit()
+			except IntegrityError:
+				savepoint.rollback()
+				write.status = "conflict"
+			except Exception as e:
+				savepoint.rollback()
+				write.error = e
+		db.session.commit()
+
+	def _count(self, writes):
+		self.batches += 1
+		self.writes += writes
+		self.max_batch = max(self.max_batch, writes)
+
+	@property
+	def info(self):
+		return {
+			"batches": self.batches,
+			"writes": self.writes,
+			"max_batch": self.max_batch,
+			"sync_errors": self.sync_errors,
+			"interval": self.interval,
+			"max_writes": self.max_writes,
+		}
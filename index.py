@@ -0,0 +1,1326 @@
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter, OrderedDict
+from math import sqrt
+from operator import itemgetter
+import heapq
+import multiprocessing
+import threading
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+class SpatialIndex(object):
+	"""
+	Base class for in-memory indexes mirroring DBUser table
+	Index is filled once by rebuild and then kept in sync
+	by CRUD controllers with insert, update and delete
+	"""
+
+	def rebuild(self, users):
+		"""
+		Drop index content and fill it with (id, x, y) rows
+		"""
+		raise NotImplementedError
+
+	def insert(self, user_id, x, y):
+		raise NotImplementedError
+
+	def insertMany(self, users):
+		"""
+		Insert list of (id, x, y) rows
+		"""
+		for user_id, x, y in users:
+			self.insert(user_id, x, y)
+
+	def update(self, user_id, x, y):
+		self.delete(user_id)
+		self.insert(user_id, x, y)
+
+	def delete(self, user_id):
+		raise NotImplementedError
+
+class IndexSet(object):
+	"""
+	Named set of enabled indexes
+	All write operations are applied to every index in the set
+	"""
+
+	def __init__(self):
+		self.indexes = OrderedDict()
+
+	def register(self, name, index):
+		self.indexes[name] = index
+
+	def get(self, name):
+		"""
+		Return index by name or None if it is not enabled
+		"""
+		return self.indexes.get(name)
+
+	def rebuild(self, users):
+		users = list(users)
+		for index in self.indexes.values():
+			index.rebuild(users)
+
+	def insert(self, user_id, x, y):
+		for index in self.indexes.values():
+			index.insert(user_id, x, y)
+
+	def insertMany(self, users):
+		users = list(users)
+		for index in self.indexes.values():
+			index.insertMany(users)
+
+	def update(self, user_id, x, y):
+		for index in self.indexes.values():
+			index.update(user_id, x, y)
+
+	def delete(self, user_id):
+		for index in self.indexes.values():
+			index.delete(user_id)
+
+class GridIndex(SpatialIndex):
+	"""
+	Uniform grid: users are bucketed by square cells of cell_size
+	Cell user count is the size of the cell bucket
+	Counts of coarse cells of coarse_factor x coarse_factor cells
+	are the density histogram for approximate count
+	"""
+
+	def __init__(self, cell_size, coarse_factor = 8):
+		self.cell_size = cell_size
+		self.coarse_factor = coarse_factor
+		self.users = dict()
+		self.cells = dict()
+		self.coarse = dict()
+
+	def getCell(self, x, y):
+		return (x // self.cell_size, y // self.cell_size)
+
+	def getCellRect(self, cell):
+		"""
+		Return cell bounds as (minX, minY, maxX, maxY)
+		"""
+		cx, cy = cell
+		size = self.cell_size
+		return (cx * size, cy * size, (cx + 1) * size, (cy + 1) * size)
+
+	def getCoarseCell(self, cell):
+		return (cell[0] // self.coarse_factor, cell[1] // self.coarse_factor)
+
+	def getCoarseRect(self, coarse_cell):
+		cx, cy = coarse_cell
+		size = self.cell_size * self.coarse_factor
+		return (cx * size, cy * size, (cx + 1) * size, (cy + 1) * size)
+
+	@property
+	def count(self):
+		return len(self.users)
+
+	def rebuild(self, users):
+		self.users = dict()
+		self.cells = dict()
+		self.coarse = dict()
+		for user_id, x, y in users:
+			self.insert(user_id, x, y)
+
+	def insert(self, user_id, x, y):
+		self.users[user_id] = (x, y)
+		cell = self.getCell(x, y)
+		self.cells.setdefault(cell, dict())[user_id] = (x, y)
+		coarse_cell = self.getCoarseCell(cell)
+		self.coarse[coarse_cell] = self.coarse.get(coarse_cell, 0) + 1
+
+	def delete(self, user_id):
+		x, y = self.users.pop(user_id)
+		cell = self.getCell(x, y)
+		bucket = self.cells[cell]
+		del bucket[user_id]
+		if not bucket:
+			del self.cells[cell]
+		coarse_cell = self.getCoarseCell(cell)
+		self.coarse[coarse_cell] -= 1
+		if not self.coarse[coarse_cell]:
+			del self.coarse[coarse_cell]
+
+	def _getFilledCells(self, cells, minCX, minCY, maxCX, maxCY):
+		"""
+		Return keys of cells dict in [minC, maxC] cell range
+		"""
+		if (maxCX - minCX + 1) * (maxCY - minCY + 1) > len(cells):
+			# Search zone covers more cells than there are filled ones
+			return [
+				cell for cell in cells \
+				if minCX <= cell[0] <= maxCX and minCY <= cell[1] <= maxCY
+			]
+		return [
+			(cx, cy) for cx in range(minCX, maxCX + 1) \
+			for cy in range(minCY, maxCY + 1) \
+			if (cx, cy) in cells
+		]
+
+	def getCircleCells(self, x0, y0, r):
+		"""
+		Return non-empty cells intersecting bounding square of the circle
+		"""
+		minCX, minCY = self.getCell(x0 - r, y0 - r)
+		maxCX, maxCY = self.getCell(x0 + r, y0 + r)
+		return self._getFilledCells(self.cells, minCX, minCY, maxCX, maxCY)
+
+	def getRectPosition(self, rect, x0, y0, r):
+		"""
+		Return inside, outside or boundary position of rect to the circle
+		"""
+		minX, minY, maxX, maxY = rect
+		# Nearest and farthest rect points from the center
+		nearX = min(max(x0, minX), maxX)
+		nearY = min(max(y0, minY), maxY)
+		farX = max(abs(x0 - minX), abs(x0 - maxX))
+		farY = max(abs(y0 - minY), abs(y0 - maxY))
+		if (nearX - x0) ** 2 + (nearY - y0) ** 2 > r * r:
+			return "outside"
+		if farX ** 2 + farY ** 2 <= r * r:
+			return "inside"
+		return "boundary"
+
+	def getRectShare(self, rect, x0, y0, r, samples = 4):
+		"""
+		Return share of rect area inside the circle
+		by samples x samples points in the rect
+		"""
+		minX, minY, maxX, maxY = rect
+		xs = [minX + (maxX - minX) * (i + 0.5) / samples for i in range(samples)]
+		ys = [minY + (maxY - minY) * (i + 0.5) / samples for i in range(samples)]
+		inside = 0
+		for x in xs:
+			for y in ys:
+				if (x - x0) ** 2 + (y - y0) ** 2 <= r * r:
+					inside += 1
+		return float(inside) / samples ** 2
+
+	def _countInCells(self, cells, x0, y0, r):
+		"""
+		Return users count of cells within r from (x0, y0)
+		"""
+		result = 0
+		r2 = r * r
+		for cell in cells:
+			# Same as getRectPosition, inlined for the hot loop
+			minX, minY, maxX, maxY = self.getCellRect(cell)
+			nearX = min(max(x0, minX), maxX)
+			nearY = min(max(y0, minY), maxY)
+			farX = max(abs(x0 - minX), abs(x0 - maxX))
+			farY = max(abs(y0 - minY), abs(y0 - maxY))
+			if (nearX - x0) ** 2 + (nearY - y0) ** 2 > r2:
+				# Cell outside
+				continue
+			bucket = self.cells[cell]
+			if farX ** 2 + farY ** 2 <= r2:
+				# Cell inside
+				result += len(bucket)
+				continue
+			for x, y in bucket.values():
+				if (x - x0) ** 2 + (y - y0) ** 2 <= r2:
+					result += 1
+		return result
+
+	def countInCircle(self, x0, y0, r):
+		"""
+		Return users count within r from (x0, y0)
+		Fully covered cells add their count,
+		distances are checked only in boundary cells
+		"""
+		return self._countInCells(self.getCircleCells(x0, y0, r), x0, y0, r)
+
+	def approxCountInCircle(self, x0, y0, r, eps):
+		"""
+		Return (estimate, error bound) of users count within r from (x0, y0)
+		Boundary coarse cell or cell adds its count by share of its area
+		inside the circle. True count is between counts without and with
+		all boundary cells, so error is at most max of counts added and
+		left out. Boundary cell with most users is refined first: coarse
+		cell into its cells, cell into its users distances, until error
+		is at most eps of estimate. Error is 0 when all are refined.
+		"""
+		result = 0
+		# Max heap of boundary cells by count
+		boundary = list()
+		sums = [0.0, 0.0]
+
+		def addBoundary(coarse, cell, count, rect):
+			estimate = count * self.getRectShare(rect, x0, y0, r)
+			heapq.heappush(boundary, (-count, coarse, cell, estimate))
+			sums[0] += estimate
+			sums[1] += count - estimate
+
+		minCX, minCY = self.getCoarseCell(self.getCell(x0 - r, y0 - r))
+		maxCX, maxCY = self.getCoarseCell(self.getCell(x0 + r, y0 + r))
+		for coarse_cell in self._getFilledCells(self.coarse, minCX, minCY, maxCX, maxCY):
+			rect = self.getCoarseRect(coarse_cell)
+			position = self.getRectPosition(rect, x0, y0, r)
+			if position == "inside":
+				result += self.coarse[coarse_cell]
+			elif position == "boundary":
+				addBoundary(True, coarse_cell, self.coarse[coarse_cell], rect)
+
+		factor = self.coarse_factor
+		while boundary and max(sums) > eps * (result + sums[0]):
+			count, coarse, (cx, cy), estimate = heapq.heappop(boundary)
+			sums[0] -= estimate
+			sums[1] -= -count - estimate
+			if not coarse:
+				result += self._countInCells([(cx, cy)], x0, y0, r)
+				continue
+			cells = self._getFilledCells(self.cells, cx * factor, cy * factor, \
+				(cx + 1) * factor - 1, (cy + 1) * factor - 1)
+			for cell in cells:
+				rect = self.getCellRect(cell)
+				position = self.getRectPosition(rect, x0, y0, r)
+				if position == "inside":
+					result += len(self.cells[cell])
+				elif position == "boundary":
+					addBoundary(False, cell, len(self.cells[cell]), rect)
+		if not boundary:
+			return result, 0
+		return result + sums[0], max(sums)
+
+	def countInRegion(self, region):
+		"""
+		Return users count in region
+		Coarse cells inside the region add their count, cells of
+		boundary coarse cells are classified the same way and
+		users are checked only in boundary cells
+		"""
+		minX, minY, maxX, maxY = region.bounds
+		minCX, minCY = self.getCoarseCell(self.getCell(minX, minY))
+		maxCX, maxCY = self.getCoarseCell(self.getCell(maxX, maxY))
+		factor = self.coarse_factor
+		result = 0
+		for cx, cy in self._getFilledCells(self.coarse, minCX, minCY, maxCX, maxCY):
+			position = region.getRectPosition(self.getCoarseRect((cx, cy)))
+			if position == "inside":
+				result += self.coarse[(cx, cy)]
+			elif position == "boundary":
+				cells = self._getFilledCells(self.cells, cx * factor, cy * factor, \
+					(cx + 1) * factor - 1, (cy + 1) * factor - 1)
+				for cell in cells:
+					position = region.getRectPosition(self.getCellRect(cell))
+					if position == "inside":
+						result += len(self.cells[cell])
+					elif position == "boundary":
+						result += region.countPoints(self.cells[cell].values())
+		return result
+
+# Max abs of int64 delta whose square summed with another one fits int64
+MAX_SQUARED_DELTA = 2 ** 31 - 1
+
+def _inCircle(dx, dy, r):
+	"""
+	Return mask of int64 deltas (dx, dy) with dx ** 2 + dy ** 2 <= r ** 2
+	Deltas out of [-r, r] box are dropped before squaring, so squares
+	fit int64 if r <= MAX_SQUARED_DELTA, bigger r is checked by Python ints
+	"""
+	near = (numpy.abs(dx) <= r) & (numpy.abs(dy) <= r)
+	if numpy.max(r) > MAX_SQUARED_DELTA:
+		mask = numpy.zeros(near.shape, dtype = bool)
+		mask[near] = [x * x + y * y <= r * r for x, y in zip(dx[near].tolist(), dy[near].tolist())]
+		return mask
+	dx = numpy.where(near, dx, 0)
+	dy = numpy.where(near, dy, 0)
+	return near & (dx * dx + dy * dy <= r * r)
+
+class ColumnIndex(SpatialIndex):
+	"""
+	Users stored as contiguous int32 numpy columns: ids, x, y
+	Deleted user is replaced by the last one to keep columns dense
+	Distances are compared in vectorized chunks to bound peak memory
+	"""
+
+	def __init__(self, chunk_size):
+		self.chunk_size = chunk_size
+		self.rebuild(list())
+
+	@property
+	def count(self):
+		return self.size
+
+	def _resize(self, capacity):
+		for name in ("ids", "xs", "ys"):
+			column = numpy.zeros(capacity, dtype = numpy.int32)
+			column[:self.size] = getattr(self, name)[:self.size]
+			setattr(self, name, column)
+
+	def rebuild(self, users):
+		users = list(users)
+		self.size = len(users)
+		columns = list(zip(*users)) or [(), (), ()]
+		self.ids, self.xs, self.ys = [
+			numpy.array(column, dtype = numpy.int32) for column in columns
+		]
+		self.positions = dict(
+			(user_id, pos) for pos, user_id in enumerate(self.ids.tolist())
+		)
+
+	def insert(self, user_id, x, y):
+		if self.size == len(self.ids):
+			self._resize(max(16, 2 * self.size))
+		pos = self.size
+		self.ids[pos], self.xs[pos], self.ys[pos] = user_id, x, y
+		self.positions[user_id] = pos
+		self.size += 1
+
+	def insertMany(self, users):
+		if not users:
+			return
+		if self.size + len(users) > len(self.ids):
+			self._resize(max(16, 2 * (self.size + len(users))))
+		start, end = self.size, self.size + len(users)
+		for name, column in zip(("ids", "xs", "ys"), zip(*users)):
+			getattr(self, name)[start:end] = column
+		for pos, (user_id, _, _) in enumerate(users, start):
+			self.positions[user_id] = pos
+		self.size = end
+
+	def update(self, user_id, x, y):
+		pos = self.positions[user_id]
+		self.xs[pos], self.ys[pos] = x, y
+
+	def delete(self, user_id):
+		pos = self.positions.pop(user_id)
+		last = self.size - 1
+		if pos != last:
+			# Move last user into the hole
+			self.ids[pos] = self.ids[last]
+			self.xs[pos] = self.xs[last]
+			self.ys[pos] = self.ys[last]
+			self.positions[int(self.ids[pos])] = pos
+		self.size = last
+
+	def countInCircle(self, x0, y0, r):
+		"""
+		Return users count within r from (x0, y0)
+		Squared distances are compared with r ** 2, no sqrt needed
+		"""
+		result = 0
+		for start in range(0, self.size, self.chunk_size):
+			end = min(start + self.chunk_size, self.size)
+			dx = self.xs[start:end].astype(numpy.int64) - x0
+			dy = self.ys[start:end].astype(numpy.int64) - y0
+			result += int(numpy.count_nonzero(_inCircle(dx, dy, r)))
+		return result
+
+	def countInCircles(self, circles):
+		"""
+		Return users count for each (x0, y0, r) circle
+		Every users chunk is compared with all circles at once,
+		chunk is reduced to keep chunk_size distances in memory
+		"""
+		if not circles:
+			return list()
+		if max(r for _, _, r in circles) > MAX_SQUARED_DELTA:
+			return [self.countInCircle(x0, y0, r) for x0, y0, r in circles]
+		x0, y0, r = [
+			numpy.array(column, dtype = numpy.int64)[:, None] \
+			for column in zip(*circles)
+		]
+		result = numpy.zeros(len(circles), dtype = numpy.int64)
+		step = max(1, self.chunk_size // len(circles))
+		for start in range(0, self.size, step):
+			end = min(start + step, self.size)
+			dx = self.xs[start:end].astype(numpy.int64) - x0
+			dy = self.ys[start:end].astype(numpy.int64) - y0
+			result += numpy.count_nonzero(_inCircle(dx, dy, r), axis = 1)
+		return result.tolist()
+
+class KDNode(object):
+	"""
+	KD-tree node with bounding box of its users
+	Leaf keeps users as (id, x, y) list
+	"""
+	__slots__ = ("rect", "count", "left", "right", "users")
+
+	def __init__(self, users, leaf_size):
+		xs = [x for _, x, _ in users]
+		ys = [y for _, _, y in users]
+		self.rect = (min(xs), min(ys), max(xs), max(ys))
+		self.count = len(users)
+		self.left = self.right = self.users = None
+		if self.count <= leaf_size:
+			self.users = users
+			return
+		# Split by median of longer side
+		minX, minY, maxX, maxY = self.rect
+		axis = 1 if (maxX - minX) >= (maxY - minY) else 2
+		users.sort(key = itemgetter(axis))
+		mid = self.count // 2
+		self.left = KDNode(users[:mid], leaf_size)
+		self.right = KDNode(users[mid:], leaf_size)
+
+	def getMinMaxDist2(self, x0, y0):
+		"""
+		Return min and max squared distances from point to node rect
+		"""
+		minX, minY, maxX, maxY = self.rect
+		nearX = min(max(x0, minX), maxX) - x0
+		nearY = min(max(y0, minY), maxY) - y0
+		farX = max(abs(x0 - minX), abs(x0 - maxX))
+		farY = max(abs(y0 - minY), abs(y0 - maxY))
+		return nearX ** 2 + nearY ** 2, farX ** 2 + farY ** 2
+
+	def countInCircle(self, x0, y0, r2):
+		min_dist2, max_dist2 = self.getMinMaxDist2(x0, y0)
+		if min_dist2 > r2:
+			return 0
+		if max_dist2 <= r2:
+			return self.count
+		if self.users is not None:
+			return len([
+				user_id for user_id, x, y in self.users \
+				if (x - x0) ** 2 + (y - y0) ** 2 <= r2
+			])
+		return self.left.countInCircle(x0, y0, r2) + \
+				self.right.countInCircle(x0, y0, r2)
+
+	def nearest(self, x0, y0, k, r2, heap, skip):
+		"""
+		Push users closer than r2 into bounded max-heap of size k
+		Heap items are (-dist2, -id), so the farthest user is on top
+		Skip nodes farther than the worst user found
+		"""
+		min_dist2, _ = self.getMinMaxDist2(x0, y0)
+		if min_dist2 > r2 or (len(heap) == k and min_dist2 > -heap[0][0]):
+			return
+		if self.users is not None:
+			for user_id, x, y in self.users:
+				if user_id not in skip:
+					pushNearest(heap, k, (x - x0) ** 2 + (y - y0) ** 2, \
+								user_id, r2)
+			return
+		# Visit closer child first to shrink search radius faster
+		children = (self.left, self.right)
+		if self.right.getMinMaxDist2(x0, y0)[0] < \
+						self.left.getMinMaxDist2(x0, y0)[0]:
+			children = (self.right, self.left)
+		for child in children:
+			child.nearest(x0, y0, k, r2, heap, skip)
+
+def pushNearest(heap, k, dist2, user_id, r2):
+	"""
+	Push user into bounded max-heap if it is one of k nearest
+	Equal distances are ordered by user id
+	"""
+	if dist2 > r2:
+		return
+	item = (-dist2, -user_id)
+	if len(heap) < k:
+		heapq.heappush(heap, item)
+	elif item > heap[0]:
+		heapq.heapreplace(heap, item)
+
+class KDTreeIndex(SpatialIndex):
+	"""
+	Static KD-tree with overlay of writes made after it was built
+	Overlay keeps inserted users and deleted tree users.
+	When overlay grows up to rebuild_writes the tree is rebuilt
+	in background thread, writes made meanwhile are replayed on top.
+	"""
+
+	def __init__(self, leaf_size, rebuild_writes):
+		self.leaf_size = leaf_size
+		self.rebuild_writes = rebuild_writes
+		self.lock = threading.RLock()
+		self.rebuild_thread = None
+		self.journal = None
+		self.rebuild(list())
+
+	@property
+	def count(self):
+		return len(self.users)
+
+	@property
+	def pending(self):
+		"""
+		Amount of writes not merged into the tree yet
+		"""
+		return len(self.inserted) + len(self.deleted)
+
+	def _build(self, users):
+		users = list(users)
+		if not users:
+			return None
+		return KDNode(users, self.leaf_size)
+
+	def rebuild(self, users):
+		users = list(users)
+		root = self._build(users)
+		with self.lock:
+			self.root = root
+			self.users = dict((user_id, (x, y)) for user_id, x, y in users)
+			self.tree_users = dict(self.users)
+			self.inserted = dict()
+			self.deleted = dict()
+
+	def _backgroundRebuild(self, users):
+		root = self._build(users)
+		with self.lock:
+			self.root = root
+			self.tree_users = dict((user_id, (x, y)) for user_id, x, y in users)
+			self.inserted = dict()
+			self.deleted = dict()
+			# Replay writes made during the build
+			for user_id in self.journal:
+				if user_id in self.tree_users:
+					self.deleted[user_id] = self.tree_users[user_id]
+				if user_id in self.users:
+					self.inserted[user_id] = self.users[user_id]
+			self.journal = None
+
+	def startRebuild(self):
+		"""
+		Rebuild the tree from current users in background thread
+		"""
+		with self.lock:
+			if self.journal is not None:
+				# Rebuild is in progress
+				return
+			self.journal = set()
+			users = [(user_id, x, y) for user_id, (x, y) in self.users.items()]
+			self.rebuild_thread = threading.Thread(
+				target = self._backgroundRebuild, args = (users,))
+			self.rebuild_thread.daemon = True
+			self.rebuild_thread.start()
+
+	def _applyWrite(self, user_id, coord):
+		"""
+		Apply write to the overlay, coord is None for delete
+		"""
+		if coord is None:
+			del self.users[user_id]
+		else:
+			self.users[user_id] = coord
+		self.inserted.pop(user_id, None)
+		if user_id in self.tree_users:
+			self.deleted[user_id] = self.tree_users[user_id]
+		if coord is not None:
+			self.inserted[user_id] = coord
+		if self.journal is not None:
+			self.journal.add(user_id)
+
+	def _write(self, writes):
+		"""
+		Apply (id, coord) writes and start rebuild if overlay is big enough
+		"""
+		with self.lock:
+			for user_id, coord in writes:
+				self._applyWrite(user_id, coord)
+			if self.journal is None and self.pending >= self.rebuild_writes:
+				self.startRebuild()
+
+	def insert(self, user_id, x, y):
+		self._write([(user_id, (x, y))])
+
+	def insertMany(self, users):
+		self._write((user_id, (x, y)) for user_id, x, y in users)
+
+	def update(self, user_id, x, y):
+		self._write([(user_id, (x, y))])
+
+	def delete(self, user_id):
+		self._write([(user_id, None)])
+
+	def countInCircle(self, x0, y0, r):
+		"""
+		Return users count within r from (x0, y0)
+		Nodes inside the circle add their count without visiting users
+		"""
+		r2 = r * r
+		with self.lock:
+			result = 0
+			if self.root is not None:
+				result += self.root.countInCircle(x0, y0, r2)
+			for overlay, sign in ((self.deleted, -1), (self.inserted, 1)):
+				for x, y in overlay.values():
+					if (x - x0) ** 2 + (y - y0) ** 2 <= r2:
+						result += sign
+			return result
+
+	def nearest(self, x0, y0, k, r, exclude = None):
+		"""
+		Return up to k nearest users within r from (x0, y0)
+		as list of (id, dist) sorted by distance
+		"""
+		r2 = r * r
+		heap = list()
+		with self.lock:
+			skip = set(self.deleted)
+			if exclude is not None:
+				skip.add(exclude)
+			if self.root is not None and k > 0:
+				self.root.nearest(x0, y0, k, r2, heap, skip)
+			for user_id, (x, y) in self.inserted.items():
+				if user_id != exclude and k > 0:
+					pushNearest(heap, k, (x - x0) ** 2 + (y - y0) ** 2, \
+								user_id, r2)
+		return [
+			(-neg_id, sqrt(-neg_dist2)) \
+			for neg_dist2, neg_id in sorted(heap, reverse = True)
+		]
+
+def isqrt(n):
+	"""
+	Integer square root: max h with h * h <= n
+	"""
+	h = int(sqrt(n))
+	while h * h > n:
+		h -= 1
+	while (h + 1) * (h + 1) <= n:
+		h += 1
+	return h
+
+class FenwickIndex(SpatialIndex):
+	"""
+	2D Fenwick tree of user counts over integer points [0, size) x [0, size)
+	Rect count is 4 prefix sums, each is O(log(size) ** 2)
+	Users outside of the square are kept aside and checked one by one
+	"""
+
+	def __init__(self, size):
+		self.size = size
+		self.rebuild(list())
+
+	@property
+	def count(self):
+		return len(self.users) + len(self.outside)
+
+	def _inBounds(self, x, y):
+		return 0 <= x < self.size and 0 <= y < self.size
+
+	def _add(self, x, y, delta):
+		width = self.size + 1
+		i = x + 1
+		while i <= self.size:
+			j = y + 1
+			while j <= self.size:
+				self.tree[i * width + j] += delta
+				j += j & -j
+			i += i & -i
+
+	def _prefix(self, x, y):
+		"""
+		Return count of users with coordinates <= (x, y)
+		"""
+		if x < 0 or y < 0:
+			return 0
+		width = self.size + 1
+		result = 0
+		i = min(x, self.size - 1) + 1
+		jmax = min(y, self.size - 1) + 1
+		while i > 0:
+			j = jmax
+			while j > 0:
+				result += self.tree[i * width + j]
+				j -= j & -j
+			i -= i & -i
+		return result
+
+	def rebuild(self, users):
+		"""
+		Put point counts into the tree and propagate them
+		to parent nodes row by row and then column by column.
+		It takes O(size ** 2), so few users are inserted one by one.
+		"""
+		users = list(users)
+		size = self.size
+		width = size + 1
+		self.tree = tree = array("i", [0]) * (width ** 2)
+		self.users = dict()
+		self.outside = dict()
+		if len(users) * size.bit_length() ** 2 < 2 * width ** 2:
+			for user_id, x, y in users:
+				self.insert(user_id, x, y)
+			return
+		for user_id, x, y in users:
+			if self._inBounds(x, y):
+				self.users[user_id] = (x, y)
+				tree[(x + 1) * width + y + 1] += 1
+			else:
+				self.outside[user_id] = (x, y)
+		for i in range(1, width):
+			row = i * width
+			for j in range(1, width):
+				parent = j + (j & -j)
+				if parent <= size:
+					tree[row + parent] += tree[row + j]
+		for i in range(1, width):
+			parent = i + (i & -i)
+			if parent <= size:
+				for j in range(1, width):
+					tree[parent * width + j] += tree[i * width + j]
+
+	def insert(self, user_id, x, y):
+		if not self._inBounds(x, y):
+			self.outside[user_id] = (x, y)
+			return
+		self.users[user_id] = (x, y)
+		self._add(x, y, 1)
+
+	def delete(self, user_id):
+		if user_id in self.outside:
+			del self.outside[user_id]
+			return
+		x, y = self.users.pop(user_id)
+		self._add(x, y, -1)
+
+	def _countBounded(self, minX, minY, maxX, maxY):
+		if minX > maxX or minY > maxY:
+			return 0
+		return self._prefix(maxX, maxY) - self._prefix(minX - 1, maxY) - \
+				self._prefix(maxX, minY - 1) + self._prefix(minX - 1, minY - 1)
+
+	def countRect(self, minX, minY, maxX, maxY):
+		"""
+		Return users count in rect, bounds are included
+		"""
+		result = self._countBounded(minX, minY, maxX, maxY)
+		for x, y in self.outside.values():
+			if minX <= x <= maxX and minY <= y <= maxY:
+				result += 1
+		return result
+
+	def countInRectCircle(self, rect, x0, y0, r):
+		"""
+		Return users count in rect within r from (x0, y0)
+		Every line along the shorter rect side is counted
+		as range inside the circle
+		"""
+		minX, minY, maxX, maxY = rect
+		r2 = r * r
+		result = 0
+		if maxX - minX <= maxY - minY:
+			for x in range(max(minX, x0 - r), min(maxX, x0 + r) + 1):
+				h = isqrt(r2 - (x - x0) ** 2)
+				result += self._countBounded(x, max(minY, y0 - h), x, min(maxY, y0 + h))
+		else:
+			for y in range(max(minY, y0 - r), min(maxY, y0 + r) + 1):
+				h = isqrt(r2 - (y - y0) ** 2)
+				result += self._countBounded(max(minX, x0 - h), y, min(maxX, x0 + h), y)
+		for x, y in self.outside.values():
+			if minX <= x <= maxX and minY <= y <= maxY and \
+							(x - x0) ** 2 + (y - y0) ** 2 <= r2:
+				result += 1
+		return result
+
+	def countInCircle(self, x0, y0, r):
+		"""
+		Return users count within r from (x0, y0)
+		"""
+		return self.countInRectCircle((x0 - r, y0 - r, x0 + r, y0 + r), x0, y0, r)
+
+	def splitValues(self, rect, axis):
+		"""
+		Return adjacent distinct values (left, right) of axis values
+		of users in rect around their median, so rect halves
+		[min, left] and [right, max] have balanced counts
+		Value of rank k is found by bisection on counts of users
+		with axis value <= v, each count is 2 prefix sums
+		Return None if rect users have less than two distinct values
+		"""
+		minX, minY, maxX, maxY = rect
+		if axis == "x":
+			low, high = minX, maxX
+			prefix = lambda v: self._prefix(v, maxY) - self._prefix(v, minY - 1)
+			axis_index = 0
+		else:
+			low, high = minY, maxY
+			prefix = lambda v: self._prefix(maxX, v) - self._prefix(minX - 1, v)
+			axis_index = 1
+		base = prefix(low - 1)
+		outside = sorted(point[axis_index] for point in self.outside.values() \
+						if minX <= point[0] <= maxX and minY <= point[1] <= maxY)
+
+		def countTo(value):
+			return prefix(value) - base + bisect_right(outside, value)
+
+		def nth(k):
+			# Smallest value with at least k users up to it
+			left, right = low, high
+			while left < right:
+				middle = (left + right) // 2
+				if countTo(middle) >= k:
+					right = middle
+				else:
+					left = middle + 1
+			return left
+
+		total = countTo(high)
+		if total < 2:
+			return None
+		median = nth((total + 1) // 2)
+		below = countTo(median)
+		if below < total:
+			return median, nth(below + 1)
+		# Median is the max value, it is the right half
+		below = countTo(median - 1)
+		if below == 0:
+			return None
+		return nth(below), median
+
+class QuantileIndex(SpatialIndex):
+	"""
+	Sorted x and y coordinates of users
+	Quantile of axis values in [low, high] range is found by bisect
+	"""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.rebuild(list())
+
+	@property
+	def count(self):
+		return len(self.users)
+
+	def rebuild(self, users):
+		users = dict((user_id, (x, y)) for user_id, x, y in users)
+		with self.lock:
+			self.users = users
+			self.axes = {
+				"x": sorted(x for x, _ in users.values()),
+				"y": sorted(y for _, y in users.values()),
+			}
+
+	def insert(self, user_id, x, y):
+		with self.lock:
+			self.users[user_id] = (x, y)
+			insort(self.axes["x"], x)
+			insort(self.axes["y"], y)
+
+	def insertMany(self, users):
+		users = list(users)
+		if len(users) < 100:
+			SpatialIndex.insertMany(self, users)
+			return
+		with self.lock:
+			for user_id, x, y in users:
+				self.users[user_id] = (x, y)
+			# Sort merges two sorted runs in linear time
+			self.axes["x"].extend(x for _, x, _ in users)
+			self.axes["x"].sort()
+			self.axes["y"].extend(y for _, _, y in users)
+			self.axes["y"].sort()
+
+	def delete(self, user_id):
+		with self.lock:
+			x, y = self.users.pop(user_id)
+			for values, value in ((self.axes["x"], x), (self.axes["y"], y)):
+				del values[bisect_left(values, value)]
+
+	def _range(self, values, low, high):
+		return bisect_left(values, low), bisect_right(values, high)
+
+	def quantile(self, axis, low, high, q):
+		"""
+		Return q quantile of axis values in [low, high]
+		or None if there are no values
+		"""
+		with self.lock:
+			values = self.axes[axis]
+			start, end = self._range(values, low, high)
+			if start == end:
+				return None
+			return values[start + int(q * (end - start - 1))]
+
+	def median(self, axis, low, high):
+		return self.quantile(axis, low, high, 0.5)
+
+	def splitValues(self, axis, low, high):
+		"""
+		Return adjacent distinct values (left, right) of axis values
+		in [low, high] around their median
+		Values are of all users in the range, i.e. in the whole strip,
+		so counts are balanced in the strip, not in a rect inside it
+		Return None if the range has less than two distinct values
+		"""
+		with self.lock:
+			values = self.axes[axis]
+			start, end = self._range(values, low, high)
+			if start == end or values[start] == values[end - 1]:
+				return None
+			median = values[(start + end - 1) // 2]
+			right = bisect_right(values, median, start, end)
+			if right < end:
+				return median, values[right]
+			# Median is the max value, it is the right half
+			return values[bisect_left(values, median, start, end) - 1], median
+
+class Multiset(object):
+	"""
+	Counts of values with min and max
+	Heaps keep distinct values, deleted ones are dropped lazily
+	"""
+
+	def __init__(self, values = ()):
+		self.counts = Counter(values)
+		self._compact()
+
+	def _compact(self):
+		self.low = list(self.counts)
+		heapq.heapify(self.low)
+		self.high = [-value for value in self.counts]
+		heapq.heapify(self.high)
+
+	def add(self, value):
+		count = self.counts.get(value, 0)
+		self.counts[value] = count + 1
+		if not count:
+			heapq.heappush(self.low, value)
+			heapq.heappush(self.high, -value)
+
+	def remove(self, value):
+		count = self.counts[value] - 1
+		if count:
+			self.counts[value] = count
+			return
+		del self.counts[value]
+		if len(self.low) > 2 * len(self.counts) + 16:
+			self._compact()
+
+	@property
+	def min(self):
+		while self.low and self.low[0] not in self.counts:
+			heapq.heappop(self.low)
+		return self.low[0] if self.low else None
+
+	@property
+	def max(self):
+		while self.high and -self.high[0] not in self.counts:
+			heapq.heappop(self.high)
+		return -self.high[0] if self.high else None
+
+class AggregateTracker(SpatialIndex):
+	"""
+	Whole table aggregates: count, sums and min, max of coordinates
+	by multisets, so delete of min or max user is correct.
+	Counts of square cells of cell_size are the density histogram.
+	"""
+
+	def __init__(self, cell_size):
+		self.cell_size = cell_size
+		self.lock = threading.Lock()
+		self.rebuild(list())
+
+	@property
+	def count(self):
+		return len(self.users)
+
+	def getCell(self, x, y):
+		return (x // self.cell_size, y // self.cell_size)
+
+	def rebuild(self, users):
+		users = dict((user_id, (x, y)) for user_id, x, y in users)
+		with self.lock:
+			self.users = users
+			self.sumX = sum(x for x, _ in users.values())
+			self.sumY = sum(y for _, y in users.values())
+			self.xs = Multiset(x for x, _ in users.values())
+			self.ys = Multiset(y for _, y in users.values())
+			self.cells = Counter(self.getCell(x, y) for x, y in users.values())
+
+	def insert(self, user_id, x, y):
+		with self.lock:
+			self.users[user_id] = (x, y)
+			self.sumX += x
+			self.sumY += y
+			self.xs.add(x)
+			self.ys.add(y)
+			self.cells[self.getCell(x, y)] += 1
+
+	def delete(self, user_id):
+		with self.lock:
+			x, y = self.users.pop(user_id)
+			self.sumX -= x
+			self.sumY -= y
+			self.xs.remove(x)
+			self.ys.remove(y)
+			cell = self.getCell(x, y)
+			self.cells[cell] -= 1
+			if not self.cells[cell]:
+				del self.cells[cell]
+
+	def stats(self):
+		"""
+		Return (minX, minY, maxX, maxY, avgX, avgY, count),
+		min, max and average are None if there are no users
+		"""
+		with self.lock:
+			count = len(self.users)
+			if not count:
+				return (None, ) * 6 + (0, )
+			return (self.xs.min, self.ys.min, self.xs.max, self.ys.max, \
+				float(self.sumX) / count, float(self.sumY) / count, count)
+
+	def density(self, rect = None):
+		"""
+		Return users count per unit square of whole table bounds
+		or of histogram cells intersecting (minX, minY, maxX, maxY) rect
+		"""
+		with self.lock:
+			if not self.users:
+				return 0.0
+			if rect is None:
+				area = (self.xs.max - self.xs.min + 1) * (self.ys.max - self.ys.min + 1)
+				return float(len(self.users)) / area
+			minCX, minCY = self.getCell(rect[0], rect[1])
+			maxCX, maxCY = self.getCell(rect[2], rect[3])
+			cells = (maxCX - minCX + 1) * (maxCY - minCY + 1)
+			if cells > len(self.cells):
+				count = sum(
+					count for (cx, cy), count in self.cells.items() \
+					if minCX <= cx <= maxCX and minCY <= cy <= maxCY
+				)
+			else:
+				count = sum(
+					self.cells.get((cx, cy), 0) for cx in range(minCX, maxCX + 1) \
+					for cy in range(minCY, maxCY + 1)
+				)
+			return float(count) / (cells * self.cell_size ** 2)
+
+	@property
+	def histogram(self):
+		"""
+		Summary of density histogram
+		"""
+		with self.lock:
+			counts = list(self.cells.values())
+			return {
+				"cell_size": self.cell_size,
+				"cells": len(counts),
+				"max": max(counts) if counts else 0,
+				"mean": float(sum(counts)) / len(counts) if counts else 0.0,
+			}
+
+def _shardWorker(connection, cell_size):
+	"""
+	Shard process loop: apply commands to own grid index
+	and send back (True, result) or (False, error message)
+	"""
+	index = GridIndex(cell_size)
+	while True:
+		command, args = connection.recv()
+		if command == "stop":
+			break
+		try:
+			if command == "split":
+				# Move out users from median x, left part should not be empty
+				xs = sorted(x for x, y in index.users.values())
+				split_x = xs[len(xs) // 2] if xs else None
+				if xs and split_x == xs[0]:
+					split_x = next((x for x in xs if x > split_x), None)
+				moved = list()
+				if split_x is not None:
+					moved = [
+						(user_id, x, y) for user_id, (x, y) in index.users.items() \
+						if x >= split_x
+					]
+				for user_id, x, y in moved:
+					index.delete(user_id)
+				result = (split_x, moved)
+			else:
+				result = getattr(index, command)(*args)
+			connection.send((True, result))
+		except Exception as e:
+			connection.send((False, repr(e)))
+
+class Shard(object):
+	"""
+	Worker process owning users of one vertical strip
+	"""
+
+	def __init__(self, cell_size):
+		self.connection, child_connection = multiprocessing.Pipe()
+		self.process = multiprocessing.Process(
+			target = _shardWorker, args = (child_connection, cell_size))
+		self.process.daemon = True
+		self.process.start()
+		self.count = 0
+
+	def send(self, command, *args):
+		self.connection.send((command, args))
+
+	def receive(self):
+		ok, result = self.connection.recv()
+		if not ok:
+			raise RuntimeError("Shard failed: %s" % result)
+		return result
+
+	def call(self, command, *args):
+		self.send(command, *args)
+		return self.receive()
+
+	def stop(self):
+		self.send("stop")
+		self.process.join()
+
+class ShardedIndex(SpatialIndex):
+	"""
+	Plane is partitioned into vertical strips by split x coordinates,
+	every strip is owned by shard process with its own grid index.
+	Writes are routed by x, circle count is scattered to shards
+	intersecting the circle and their results are summed.
+	Shard with more than max_users is split by median x into two.
+	"""
+
+	def __init__(self, shard_count, max_users, cell_size):
+		self.shard_count = shard_count
+		self.max_users = max_users
+		self.cell_size = cell_size
+		self.lock = threading.RLock()
+		self.shards = [Shard(cell_size)]
+		self.splits = list()
+		self.owners = dict()
+
+	@property
+	def count(self):
+		return len(self.owners)
+
+	def getShard(self, x):
+		return self.shards[bisect_right(self.splits, x)]
+
+	def _setShards(self, splits):
+		"""
+		Start or stop shard processes to have one per strip
+		"""
+		while len(self.shards) < len(splits) + 1:
+			self.shards.append(Shard(self.cell_size))
+		while len(self.shards) > len(splits) + 1:
+			self.shards.pop().stop()
+		self.splits = splits
+
+	def rebuild(self, users):
+		users = sorted(users, key = itemgetter(1))
+		with self.lock:
+			# Strips with equal users count, users with equal x in one strip
+			splits = list()
+			for number in range(1, self.shard_count):
+				x = users[len(users) * number // self.shard_count][1] if users else None
+				if x is not None and (not splits or x > splits[-1]) and x > users[0][1]:
+					splits.append(x)
+			self._setShards(splits)
+			strips = [list() for shard in self.shards]
+			for user in users:
+				strips[bisect_right(splits, user[1])].append(user)
+			for shard, strip in zip(self.shards, strips):
+				shard.send("rebuild", strip)
+			self._raiseFirst(self._receiveAll(self.shards)[1])
+			for shard, strip in zip(self.shards, strips):
+				shard.count = len(strip)
+			self.owners = dict((user_id, self.getShard(x)) for user_id, x, y in users)
+			for shard in list(self.shards):
+				self.rebalance(shard)
+
+	def rebalance(self, shard):
+		"""
+		Split shard into two by median x while it has more than max_users
+		"""
+		while shard.count > self.max_users:
+			split_x, moved = shard.call("split")
+			if split_x is None:
+				# All users have the same x
+				return
+			number = self.shards.index(shard)
+			new_shard = Shard(self.cell_size)
+			new_shard.call("rebuild", moved)
+			new_shard.count = len(moved)
+			shard.count -= len(moved)
+			self.shards.insert(number + 1, new_shard)
+			self.splits.insert(number, split_x)
+			for user_id, x, y in moved:
+				self.owners[user_id] = new_shard
+			self.rebalance(new_shard)
+
+	def insert(self, user_id, x, y):
+		with self.lock:
+			shard = self.getShard(x)
+			shard.call("insert", user_id, x, y)
+			shard.count += 1
+			self.owners[user_id] = shard
+			self.rebalance(shard)
+
+	def insertMany(self, users):
+		with self.lock:
+			batches = OrderedDict()
+			for user_id, x, y in users:
+				batches.setdefault(self.getShard(x), list()).append((user_id, x, y))
+			for shard, batch in batches.items():
+				shard.send("insertMany", batch)
+			results, errors = self._receiveAll(batches)
+			for (shard, batch), error in zip(batches.items(), errors):
+				if error is not None:
+					continue
+				shard.count += len(batch)
+				for user_id, x, y in batch:
+					self.owners[user_id] = shard
+			self._raiseFirst(errors)
+			for shard in batches:
+				self.rebalance(shard)
+
+	def update(self, user_id, x, y):
+		with self.lock:
+			shard = self.getShard(x)
+			if self.owners[user_id] is shard:
+				shard.call("update", user_id, x, y)
+				return
+			self.delete(user_id)
+			self.insert(user_id, x, y)
+
+	def delete(self, user_id):
+		with self.lock:
+			shard = self.owners.pop(user_id)
+			shard.call("delete", user_id)
+			shard.count -= 1
+
+	def countInCircle(self, x0, y0, r):
+		"""
+		Return users count within r from (x0, y0)
+		Shards intersecting the circle count in parallel
+		"""
+		with self.lock:
+			first = bisect_right(self.splits, x0 - r)
+			last = bisect_right(self.splits, x0 + r)
+			shards = self.shards[first:last + 1]
+			for shard in shards:
+				shard.send("countInCircle", x0, y0, r)
+			results, errors = self._receiveAll(shards)
+			self._raiseFirst(errors)
+			return sum(results)
+
+	def _receiveAll(self, shards):
+		"""
+		Read replies of all shards even if some of them fail,
+		so no reply is left in pipe for the next command
+		Return lists of results and errors by shards,
+		result of failed shard is None, error of succeeded one is None
+		"""
+		results = list()
+		errors = list()
+		for shard in shards:
+			try:
+				results.append(shard.receive())
+				errors.append(None)
+			except Exception as e:
+				results.append(None)
+				errors.append(e)
+		return results, errors
+
+	def _raiseFirst(self, errors):
+		for error in errors:
+			if error is not None:
+				raise error
+
+	def stop(self):
+		with self.lock:
+			for shard in self.shards:
+				shard.stop()
+			self.shards = list()
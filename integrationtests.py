@@ -25,38 +25,38 @@ class TestNN(unittest.TestCase):
 
 	def testCheckAlgorythm(self):
 		"""
-		Add 10k data with rest
-		Get kNN with binary algorythm
+		Add 10k data with rest bulk request
+		Get kNN with binary algorythm and with default engine
 		Calculate all distances manually
 		Compare results
 		"""
 		# generate data
 		print "Generage %s users..." % self.user_count
-		url = "%s/users" % self.baseurl
-		for i in range(self.user_count):
-			res = requests.post(url, data = '{"x": "%s", "y": "%s"}' % coord.pop())
-			self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+		url = "%s/users/bulk" % self.baseurl
+		users = ["%s,%s" % coord.pop() for i in range(self.user_count)]
+		res = requests.post(url + "?format=csv", data = "\n".join(users))
+		self.assertEqual(res.status_code, status.HTTP_200_OK)
+		self.assertEqual(res.json()["created"], self.user_count)
 			
 		Rarg = "R=%s" % self.radius
 		Uarg = "U=%s" % self.user_id
 		Darg = "dist=Y"
 
-		print "Get kNN by binary algorythm..."
-		url = "%s/users/knn" % self.baseurl
-		url = "%s?%s&%s" % (url, Rarg, Uarg)
-		res = requests.get(url)
-		self.assertEquals(res.status_code, status.HTTP_200_OK)
-		result1 = res.json()["result"]
-
 		print "Get kNN by calculating all distances..."
 		url = "%s/users/knn" % self.baseurl
 		url = "%s?%s&%s&%s" % (url, Rarg, Uarg, Darg)
 		res = requests.get(url)
 		self.assertEquals(res.status_code, status.HTTP_200_OK)
-		result2 = res.json()["result"]
-
-		self.assertEquals(result1, result2)
-		print "Results are equal", result1, result2
+		result = res.json()["result"]
+
+		for name, Earg in (("binary algorythm", "engine=split"), ("default engine", "")):
+			print "Get kNN by %s..." % name
+			url = "%s/users/knn" % self.baseurl
+			url = "%s?%s&%s&%s" % (url, Rarg, Uarg, Earg)
+			res = requests.get(url)
+			self.assertEquals(res.status_code, status.HTTP_200_OK)
+			self.assertEquals(res.json()["result"], result)
+			print "Results are equal", result
 				
 if __name__ == '__main__':
     unittest.main()
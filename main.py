@@ -1,21 +1,27 @@
-from math import sqrt
-import os
+from collections import deque, OrderedDict, namedtuple
+from multiprocessing.pool import ThreadPool
+from math import ceil, log, pi, sqrt
+import base64
+import json
 import sys
 
-from flask import Flask, request
+from flask import Flask, Response, request
 from flask_api import status
 from flask_restful import Resource, Api
+from sqlalchemy.exc import IntegrityError
 
 from consts import *
 from models import *
+from index import *
+from metrics import *
+from snapshot import *
+from region import *
+from groupcommit import *
 
 app = Flask("NN")
 # Load config for app
 if __name__ == '__main__':
 	app.config.from_object('consts.ProductionConfig')
-	# re-create DB to not conflict with old data
-	if os.path.exists(DBFile):
-		os.unlink(DBFile)
 elif sys.argv[0] == "benchmark.py":
 	app.config.from_object('consts.BenchmarkConfig')
 else:
@@ -23,24 +29,327 @@ else:
 # Catch all unexpected 404s in json format
 api = Api(app, catch_all_404s = True)
 
+@app.before_request
+def startMetrics():
+	metrics.start()
+
+@app.after_request
+def finishMetrics(response):
+	"""
+	Sum request metrics by resource,
+	attach them to JSON response if debug argument is Y
+	"""
+	request_metrics = metrics.finish(request.endpoint)
+	if request_metrics is not None and request.args.get("debug") == "Y" \
+			and response.mimetype == "application/json" and not response.is_streamed:
+		data = json.loads(response.get_data())
+		if isinstance(data, dict):
+			data["debug"] = request_metrics.asDict()
+			response.set_data(json.dumps(data))
+	return response
+
 # Init DB
+sqlite_pragmas.update(app.config["SQLITE_PRAGMAS"])
 db.app = app
 db.init_app(app)
 db.create_all()
+removed = upgradeDB()
+if removed:
+	app.logger.warning("DB upgrade removed %s users with duplicated coordinates", removed)
+initWriteCount()
+if app.config["STATS_CACHE_SIZE"]:
+	DBUserStats.cache = LRUCache(app.config["STATS_CACHE_SIZE"])
+
+# Init in-memory indexes, CRUD controllers keep them in sync with DB
+indexes = IndexSet()
+if app.config["GRID_INDEX"]:
+	indexes.register("grid", GridIndex(app.config["GRID_CELL_SIZE"]))
+if app.config["COLUMN_INDEX"] and numpy is not None:
+	indexes.register("columns", ColumnIndex(app.config["COLUMN_CHUNK_SIZE"]))
+if app.config["KDTREE_INDEX"]:
+	indexes.register("kdtree", KDTreeIndex(app.config["KDTREE_LEAF_SIZE"], \
+										app.config["KDTREE_REBUILD_WRITES"]))
+if app.config["FENWICK_INDEX"]:
+	indexes.register("fenwick", FenwickIndex(app.config["FENWICK_SIZE"]))
+if app.config["AGGREGATE_INDEX"]:
+	indexes.register("aggregates", AggregateTracker(app.config["AGGREGATE_CELL_SIZE"]))
+if app.config["QUANTILE_INDEX"]:
+	indexes.register("quantiles", QuantileIndex())
+if app.config["SHARD_INDEX"]:
+	indexes.register("shards", ShardedIndex(app.config["SHARD_COUNT"], \
+						app.config["SHARD_MAX_USERS"], app.config["GRID_CELL_SIZE"]))
+if app.config["RTREE_INDEX"]:
+	rtree = RTreeIndex()
+	with db.session.get_bind().begin() as connection:
+		rtree_created = rtree.create(connection)
+	if rtree_created:
+		indexes.register("rtree", rtree)
+		DBUserStats.rtree = rtree
+
+# kNN results cache
+knn_cache = None
+if app.config["KNN_CACHE_SIZE"]:
+	knn_cache = ResultCache(app.config["KNN_CACHE_SIZE"], app.config["KNN_CACHE_TTL"])
+
+# Worker threads of main algorythm, each has its own DB session
+knn_pool = None
+if app.config["KNN_WORKERS"] > 1:
+	knn_pool = ThreadPool(app.config["KNN_WORKERS"])
+
+# Snapshot of users with log of writes for warm start
+store = None
+if app.config["SNAPSHOT_FILE"]:
+	store = SnapshotStore(app.config["SNAPSHOT_FILE"], app.config["WAL_FILE"], \
+						app.config["SNAPSHOT_WAL_RECORDS"])
+
+def _fillIndexes(users):
+	indexes.rebuild(users)
+	bumpDataVersion()
+	if knn_cache is not None:
+		knn_cache.clear()
+
+def reloadIndexes():
+	"""
+	Fill in-memory indexes from DBUser table
+	"""
+	write_count = getWriteCount()
+	users = list(db.session.query(DBUser.id, DBUser.x, DBUser.y).yield_per(1000))
+	_fillIndexes(users)
+	if store is not None:
+		store.save(users, write_count)
+
+def warmStart():
+	"""
+	Fill in-memory indexes from snapshot and log without DB scan
+	Indexes are reloaded from DB if there is no snapshot,
+	its users count and max id differ from DB ones or the last
+	log record number is not DB write count, e.g. after crash
+	between write commit and its log record
+	"""
+	users = store.load() if store is not None else None
+	if users is not None:
+		count, max_id = db.session.query(db.func.count(DBUser.id), db.func.max(DBUser.id)).one()
+		if (count, max_id) == (len(users), max([user_id for user_id, _, _ in users] or [None])) \
+				and store.record_number == getWriteCount():
+			_fillIndexes(users)
+			return
+	reloadIndexes()
+
+def snapshotUsers():
+	"""
+	Return current (id, x, y) users to write snapshot
+	"""
+	columns = indexes.get("columns")
+	if columns is not None:
+		size = columns.size
+		return zip(columns.ids[:size].tolist(), columns.xs[:size].tolist(), \
+				columns.ys[:size].tolist())
+	return db.session.query(DBUser.id, DBUser.x, DBUser.y).yield_per(1000)
+
+warmStart()
+
+def syncWrite(user_id, old, new):
+	"""
+	Apply committed write of user to in-memory state
+	old and new are user coordinates before and after the write,
+	old is None for created user, new is None for deleted one
+	"""
+	bumpDataVersion()
+	if old is None:
+		indexes.insert(user_id, *new)
+	elif new is None:
+		indexes.delete(user_id)
+	else:
+		indexes.update(user_id, *new)
+	if knn_cache is not None:
+		knn_cache.invalidate([coord for coord in (old, new) if coord is not None])
+	if store is not None:
+		if old is None:
+			record = (WAL_INSERT, user_id) + tuple(new)
+		elif new is None:
+			record = (WAL_DELETE, user_id) + tuple(old)
+		else:
+			record = (WAL_UPDATE, user_id) + tuple(new)
+		store.log([record], snapshotUsers)
+
+def syncCreated(users):
+	"""
+	Apply committed create of (id, x, y) users to in-memory state at once
+	"""
+	bumpDataVersion()
+	indexes.insertMany(users)
+	if knn_cache is not None:
+		knn_cache.invalidate([(x, y) for _, x, y in users])
+	if store is not None:
+		store.log([(WAL_INSERT, user_id, x, y) for user_id, x, y in users], snapshotUsers)
+
+# Writer thread committing single user writes by groups
+committer = None
+if app.config["GROUP_COMMIT"]:
+	committer = GroupCommitter(app.config["GROUP_COMMIT_MS"] / 1000.0, \
+							app.config["GROUP_COMMIT_WRITES"], app.logger)
+	committer.start()
+
+class CreateUser(GroupWrite):
+	"""
+	Create user, status is created or conflict
+	"""
+
+	def __init__(self, x, y):
+		GroupWrite.__init__(self)
+		self.x, self.y = x, y
+		self.user_id = None
+
+	def apply(self):
+		# If user exists unique index fails
+		user = DBUser(self.x, self.y)
+		db.session.add(user)
+		db.session.flush()
+		bumpWriteCount(1)
+		self.user_id = user.id
+		self.status = "created"
+
+	def sync(self):
+		if self.status == "created":
+			syncWrite(self.user_id, None, (self.x, self.y))
+
+class UpdateUser(GroupWrite):
+	"""
+	Move user, missed x or y is kept
+	Status is OK, conflict or not_found
+	"""
+
+	def __init__(self, user_id, x, y):
+		GroupWrite.__init__(self)
+		self.user_id, self.x, self.y = user_id, x, y
+		self.old = self.new = None
+
+	def apply(self):
+		user = DBUser.query.filter_by(id = self.user_id).first()
+		if not user:
+			self.status = "not_found"
+			return
+		self.old = (user.x, user.y)
+		self.new = (user.x if self.x is None else self.x, \
+					user.y if self.y is None else self.y)
+		user.x, user.y = self.new
+		db.session.flush()
+		bumpWriteCount(1)
+		self.status = "OK"
+
+	def sync(self):
+		if self.status == "OK":
+			syncWrite(self.user_id, self.old, self.new)
+
+class DeleteUser(GroupWrite):
+	"""
+	Delete user, status is OK or not_found
+	"""
+
+	def __init__(self, user_id):
+		GroupWrite.__init__(self)
+		self.user_id = user_id
+		self.old = None
+
+	def apply(self):
+		query = DBUser.query.filter_by(id = self.user_id)
+		user = query.first()
+		if not user:
+			self.status = "not_found"
+			return
+		self.old = (user.x, user.y)
+		query.delete()
+		bumpWriteCount(1)
+		self.status = "OK"
+
+	def sync(self):
+		if self.status == "OK":
+			syncWrite(self.user_id, self.old, None)
+
+def commitWrite(write):
+	"""
+	Commit write by group committer if it is enabled,
+	else by own transaction
+	Return write status, conflict on unique index failure
+	"""
+	if committer is not None:
+		return committer.submit(write)
+	try:
+		write.apply()
+		db.session.commit()
+	except IntegrityError:
+		db.session.rollback()
+		return "conflict"
+	syncCommitted(write, app.logger)
+	return write.status
+
+def checkCoord(coord):
+	"""
+	Return coord, raise ValueError if it is out of coordinates range
+	"""
+	if not MIN_COORD <= coord <= MAX_COORD:
+		raise ValueError("Coordinate %s is out of range" % coord)
+	return coord
+
+def encodeCursor(user_id):
+	"""
+	Return opaque cursor pointing after user_id
+	"""
+	return base64.urlsafe_b64encode(str(user_id).encode()).decode()
+
+def decodeCursor(cursor):
+	"""
+	Return user_id from cursor, raise ValueError for invalid cursor
+	"""
+	try:
+		return int(base64.urlsafe_b64decode(str(cursor)))
+	except TypeError:
+		raise ValueError("Invalid cursor %s" % cursor)
 
 class Info(Resource):
 	"""
 	Provide information about Users
+	Count, bounds, average and density are taken
+	from aggregate tracker if it is enabled
 	Example:
 		http://127.0.0.1:5000/v1/NN/users/info -X GET
 	"""
 
 	def get(self):
-		user_count = DBUser.query.count()
-		return {
-			"message": "OK",
-			"user_count": user_count
-		}, status.HTTP_200_OK
+		aggregates = indexes.get("aggregates")
+		if aggregates is None:
+			info = {
+				"message": "OK",
+				"user_count": DBUser.query.count()
+			}
+		else:
+			minX, minY, maxX, maxY, avgX, avgY, count = aggregates.stats()
+			info = {
+				"message": "OK",
+				"user_count": count,
+				"min": {"x": minX, "y": minY},
+				"max": {"x": maxX, "y": maxY},
+				"avg": {"x": avgX, "y": avgY},
+				"density": aggregates.density(),
+				"histogram": aggregates.histogram,
+			}
+		if DBUserStats.cache is not None:
+			info["stats_cache"] = DBUserStats.cache.info
+		if knn_cache is not None:
+			info["knn_cache"] = knn_cache.info
+		if committer is not None:
+			info["group_commit"] = committer.info
+		return info, status.HTTP_200_OK
+
+class Metrics(Resource):
+	"""
+	Provide request metrics by resource in Prometheus text format
+	Example:
+		http://127.0.0.1:5000/v1/NN/metrics -X GET
+	"""
+
+	def get(self):
+		return Response(metrics.export(), mimetype = "text/plain; version=0.0.4")
 
 class UserList(Resource):
 	"""
@@ -49,6 +358,7 @@ class UserList(Resource):
 	Example:
 		curl http://127.0.0.1:5000/v1/NN/users -X POST -d '{"x": 1, "y": 2}'
 		curl http://127.0.0.1:5000/v1/NN/users?page=2&pagesize=5 -X GET
+		curl http://127.0.0.1:5000/v1/NN/users?after=MTA=&pagesize=5 -X GET
 	"""
 
 	def get(self):
@@ -56,11 +366,22 @@ class UserList(Resource):
 		Get user list
 		By default show only first 100 records
 		page and pagesize are configurable by request args
+		after arg is cursor from next field of previous page,
+		it seeks by user id instead of skipping page * pagesize users
 		"""
 		page = int(request.args.get('page', 0))
 		pagesize = int(request.args.get('pagesize', 100))
-		query = DBUser.query
-		query = query.offset(page * pagesize)
+		after = request.args.get('after', None)
+		query = DBUser.query.order_by(DBUser.id)
+		if after is not None:
+			try:
+				query = query.filter(DBUser.id > decodeCursor(after))
+			except ValueError:
+				return {
+					"message": "Bad request. Invalid after cursor."
+				}, status.HTTP_400_BAD_REQUEST
+		else:
+			query = query.offset(page * pagesize)
 		query = query.limit(pagesize)
 		users = query.all()
 		if not users:
@@ -77,9 +398,15 @@ class UserList(Resource):
 				"user_url": "%s/%s" %(request.url, user.id)
 			}
 
+		# Cursor to the next page if this one is full
+		next_cursor = None
+		if len(users) == pagesize:
+			next_cursor = encodeCursor(users[-1].id)
+
 		return {
 			"message": "OK",
-			"users": json_users
+			"users": json_users,
+			"next": next_cursor
 		}, status.HTTP_200_OK
 
 	def post(self):
@@ -94,27 +421,174 @@ class UserList(Resource):
 				"message": "Bad request. x and y keys are requied."
 			}, status.HTTP_400_BAD_REQUEST
 
-		x = json_data["x"]
-		y = json_data["y"]
+		try:
+			x = checkCoord(int(json_data["x"]))
+			y = checkCoord(int(json_data["y"]))
+		except (ValueError, TypeError):
+			return {
+				"message": "Bad request. x and y should be integers in [%s, %s]." \
+					% (MIN_COORD, MAX_COORD)
+			}, status.HTTP_400_BAD_REQUEST
 
-		# Check user exists. If so, return conflict
-		user = DBUser.query.filter_by(x = x, y = y).first()
-		if user:
+		# Add user into DB
+		# If user exists return conflict
+		write = CreateUser(x, y)
+		if commitWrite(write) == "conflict":
 			return {
 				"message": "Conflict. User (%s, %s) exists" % (x, y),
 			}, status.HTTP_409_CONFLICT
-		# Add user into DB
-		user = DBUser(x, y)
-		db.session.add(user)
-		db.session.flush()
 
-		db.session.commit()
 		# Get user ID and return url
 		return {
 			"message": "Created",
-			"user_url": "%s/%s" %(request.url, user.id)
+			"user_url": "%s/%s" %(request.url, write.user_id)
 		}, status.HTTP_201_CREATED
 
+class UserBulk(Resource):
+	"""
+	Controller to add many users by one request
+	Body is streamed line by line in NDJSON or CSV format.
+	Format is set by format argument or by Content-Type header,
+	NDJSON is default. CSV header line is skipped.
+	Users are inserted by batches of batchsize,
+	existed users are ignored and counted as conflicts
+	Example:
+		curl http://127.0.0.1:5000/v1/NN/users/bulk -X POST --data-binary @users.ndjson
+		curl http://127.0.0.1:5000/v1/NN/users/bulk?format=csv&batchsize=5000 -X POST --data-binary @users.csv
+	"""
+
+	def _parseNDJSON(self, line):
+		json_data = json.loads(line)
+		return int(json_data["x"]), int(json_data["y"])
+
+	def _parseCSV(self, line):
+		x, y = line.split(",")
+		return int(x), int(y)
+
+	def insertBatch(self, batch):
+		"""
+		Insert list of (x, y) by one executemany statement
+		Update in-memory indexes by created users at once
+		Return created and conflicts count
+		"""
+		# Take write lock by new transaction before max id is read,
+		# so all new ids are from this batch
+		db.session.commit()
+		db.session.connection(mapper = DBUser.__mapper__, \
+							execution_options = {"sqlite_begin": "IMMEDIATE"})
+		last_id = db.session.query(db.func.max(DBUser.id)).scalar() or 0
+		insert = DBUser.__table__.insert().prefix_with("OR IGNORE")
+		db.session.execute(insert, [{"x": x, "y": y} for x, y in batch])
+		query = db.session.query(DBUser.id, DBUser.x, DBUser.y)
+		created = query.filter(DBUser.id > last_id).all()
+		bumpWriteCount(len(created))
+		db.session.commit()
+		syncCreated(created)
+		return {
+			"created": len(created),
+			"conflicts": len(batch) - len(created)
+		}
+
+	def _getResponse(self, message, batches):
+		return {
+			"message": message,
+			"created": sum(batch["created"] for batch in batches),
+			"conflicts": sum(batch["conflicts"] for batch in batches),
+			"batches": batches
+		}
+
+	def post(self):
+		"""
+		Parse body and insert users by batches
+		If body has invalid line or user out of coordinates range
+		return 400 Bad request,
+		batches inserted before that line are kept
+		"""
+		body_format = request.args.get('format')
+		if body_format is None:
+			body_format = "csv" if request.mimetype == "text/csv" else "ndjson"
+		if body_format not in ("csv", "ndjson"):
+			return {
+				"message": "Bad request. Format should be csv or ndjson."
+			}, status.HTTP_400_BAD_REQUEST
+		parse = self._parseCSV if body_format == "csv" else self._parseNDJSON
+		try:
+			batchsize = int(request.args.get('batchsize', app.config["BULK_BATCH_SIZE"]))
+		except ValueError:
+			batchsize = 0
+		if batchsize <= 0:
+			return {
+				"message": "Bad request. batchsize should be positive integer."
+			}, status.HTTP_400_BAD_REQUEST
+
+		batches = list()
+		batch = list()
+		for line_number, line in enumerate(request.stream, 1):
+			line = line.strip()
+			if not line:
+				continue
+			try:
+				x, y = parse(line)
+			except (ValueError, TypeError, KeyError):
+				if body_format == "csv" and line_number == 1:
+					# Header line
+					continue
+				message = "Bad request. Invalid user on line %s." % line_number
+				return self._getResponse(message, batches), \
+					status.HTTP_400_BAD_REQUEST
+			try:
+				batch.append((checkCoord(x), checkCoord(y)))
+			except ValueError:
+				message = "Bad request. User on line %s is out of coordinates range." % line_number
+				return self._getResponse(message, batches), \
+					status.HTTP_400_BAD_REQUEST
+			if len(batch) >= batchsize:
+				batches.append(self.insertBatch(batch))
+				batch = list()
+		if batch:
+			batches.append(self.insertBatch(batch))
+
+		return self._getResponse("OK", batches), status.HTTP_200_OK
+
+class UserExport(Resource):
+	"""
+	Controller to dump all users as NDJSON stream
+	Users are read by DB cursor chunk by chunk, so memory does not
+	depend on users count. user_url=N argument omits user urls
+	Example:
+		curl http://127.0.0.1:5000/v1/NN/users/export -X GET
+		curl http://127.0.0.1:5000/v1/NN/users/export?user_url=N -X GET
+	"""
+
+	def _generate(self, users_url, chunk_size):
+		"""
+		Yield chunk of NDJSON lines per chunk of DB rows
+		"""
+		query = db.select([DBUser.id, DBUser.x, DBUser.y]).order_by(DBUser.id)
+		connection = db.session.get_bind().connect()
+		try:
+			rows = connection.execution_options(stream_results = True).execute(query)
+			while True:
+				users = rows.fetchmany(chunk_size)
+				if not users:
+					break
+				lines = list()
+				for user_id, x, y in users:
+					json_user = {"id": user_id, "x": x, "y": y}
+					if users_url is not None:
+						json_user["user_url"] = "%s/%s" % (users_url, user_id)
+					lines.append(json.dumps(json_user) + "\n")
+				yield "".join(lines)
+		finally:
+			connection.close()
+
+	def get(self):
+		users_url = None
+		if request.args.get('user_url', None) != "N":
+			users_url = "%s%s/users" % (request.url_root.rstrip("/"), BASEURL)
+		chunks = self._generate(users_url, app.config["EXPORT_CHUNK_SIZE"])
+		return Response(chunks, mimetype = "application/x-ndjson")
+
 class User(Resource):
 	"""
 	Controller for other user CRUD actions
@@ -145,95 +619,422 @@ class User(Resource):
 	def post(self, user_id):
 		"""
 		Update User object
+		If user with new coordinates exists return 409 Conflict
 		"""
-		user = DBUser.query.filter_by(id = user_id).first()
-		if not user:
-			return self._not_found_error(user_id)
 		json_data = request.get_json(force = True)
 		if "x" not in json_data and "y" not in json_data:
 			return {
 				"message": "Bad request. x or y keys are requied."
 			}, status.HTTP_400_BAD_REQUEST
 
-		x = json_data.get("x")
-		y = json_data.get("y")
-		if x:
-			user.x = x
-		if y:
-			user.y = y
-		db.session.flush()
-		db.session.commit()
+		try:
+			x, y = [checkCoord(int(json_data[key])) if json_data.get(key) is not None else None \
+					for key in ("x", "y")]
+		except (ValueError, TypeError):
+			return {
+				"message": "Bad request. x and y should be integers in [%s, %s]." \
+					% (MIN_COORD, MAX_COORD)
+			}, status.HTTP_400_BAD_REQUEST
+
+		write = UpdateUser(user_id, x, y)
+		write_status = commitWrite(write)
+		if write_status == "not_found":
+			return self._not_found_error(user_id)
+		if write_status == "conflict":
+			return {
+				"message": "Conflict. User (%s, %s) exists" % write.new,
+			}, status.HTTP_409_CONFLICT
 		return {
 			"message": "OK",
-			"user_url": "%s/%s" %(request.url, user.id)
+			"user_url": "%s/%s" %(request.url, user_id)
 		}, status.HTTP_200_OK
 		
 	def delete(self, user_id):
 		"""
 		Delete User object
 		"""
-		query = DBUser.query.filter_by(id = user_id)
-		user = query.first()
-		if not user:
+		if commitWrite(DeleteUser(user_id)) == "not_found":
 			return self._not_found_error(user_id)
-		query.delete()
-		db.session.commit()
 		return {
 			"message": "OK"
 		}, status.HTTP_200_OK
 
+# Relative cost of SQL query and fetched ORM row
+# to one python step of in-memory index
+SQL_QUERY_COST = 200
+SQL_ROW_COST = 5
+# Cost of index entry checked inside SQLite
+SQL_INDEX_ROW_COST = 0.15
+# Cost of R*Tree entry checked inside SQLite
+RTREE_ROW_COST = 1.0
+# Cost of numpy column element
+COLUMN_COST = 0.005
+# Cost of call to shard process
+SHARD_CALL_COST = 100
+
+KnnEngine = namedtuple("KnnEngine", "name method index cost")
+
+# Registered kNN count engines by name
+knn_engines = OrderedDict()
+
+def knnEngine(name, cost, index = None):
+	"""
+	Register Knn method as count engine named for engine argument
+	Engine is available if its index is not set or is enabled
+	cost(n, density, r) estimates work by users count and density
+	"""
+	def register(method):
+		knn_engines[name] = KnnEngine(name, method, index, cost)
+		return method
+	return register
+
+def getEngine(name):
+	"""
+	Return available engine by name or raise ValueError
+	"""
+	engine = knn_engines.get(name)
+	if engine is None:
+		raise ValueError("Unknown engine %s" % name)
+	if engine.index is not None and indexes.get(engine.index) is None:
+		raise ValueError("Engine %s is not enabled" % name)
+	return engine
+
+def getEngineName(args):
+	"""
+	Return engine name from request arguments,
+	dist=Y is the same as engine=dist
+	None means the fastest enabled index, auto means planner
+	"""
+	name = args.get("engine", None)
+	if name is None and args.get("dist", None) == "Y":
+		name = "dist"
+	if name not in (None, "auto"):
+		getEngine(name)
+	return name
+
+def splitCost(n, density, r):
+	# Queries by rect splits along the circle until rect side < R/10,
+	# users of boundary rects (about 0.7 R^2 square) are fetched
+	return SQL_QUERY_COST * 3 * 20 * pi + SQL_ROW_COST * min(n, 0.7 * density * r * r)
+
+def sqlCost(n, density, r):
+	# Index entries of x range over the whole table height
+	side = sqrt(n / density)
+	return SQL_QUERY_COST + SQL_INDEX_ROW_COST * min(n, 2 * r * side * density)
+
+def rtreeCost(n, density, r):
+	# R*Tree entries of the circle square
+	return SQL_QUERY_COST + RTREE_ROW_COST * min(n, 4 * r * r * density)
+
+def distCost(n, density, r):
+	if indexes.get("columns") is not None:
+		return COLUMN_COST * n
+	return SQL_QUERY_COST + SQL_ROW_COST * n
+
+def gridCost(n, density, r):
+	# All cells of the circle square and users in cells on the boundary
+	cell_size = indexes.get("grid").cell_size
+	cells = (2.0 * r / cell_size + 2) ** 2
+	return cells + min(n, 2 * pi * r * cell_size * density)
+
+def kdtreeCost(n, density, r):
+	# Leaves on the boundary and overlay of recent writes
+	kdtree = indexes.get("kdtree")
+	leaf_size = kdtree.leaf_size
+	leaves = 2 * pi * r * sqrt(density / leaf_size) + log(n + 1, 2)
+	return min(n, leaves * leaf_size) + kdtree.pending
+
+def fenwickCost(n, density, r):
+	# Rects on the boundary counted by prefix sums and by lines
+	fenwick = indexes.get("fenwick")
+	bits = fenwick.size.bit_length()
+	rects = 2 * pi * r / MIN_RECT_SIDE + 1
+	return rects * (8 * bits ** 2 + MIN_RECT_SIDE * bits) + len(fenwick.outside)
+
+def shardsCost(n, density, r):
+	# Grid cost spread over shards and round trip to every shard
+	shards = indexes.get("shards")
+	cells = (2.0 * r / shards.cell_size + 2) ** 2
+	return cells + min(n, 2 * pi * r * shards.cell_size * density) \
+		+ SHARD_CALL_COST * len(shards.shards)
+
 class Knn(Resource):
 	"""
 	Controller to find K nearest neighbors
 	R (raduis) and U (user_id) arguments are mandatory
+	Returns users count within R from U
+	or K nearest users within R if K argument is set
+	Results are cached until TTL expires or some user
+	within R square is written, "cache" key tells hit or miss
+	engine argument selects count engine by name,
+	engine=auto selects the cheapest one by cost estimate
+	mode=approx returns count estimate with error bound
+	at most eps of estimate (APPROX_EPS by default)
 	Example:
 		curl http://127.0.0.1:5000/v1/NN/users/knn?U=10&R=10 -X GET
+		curl http://127.0.0.1:5000/v1/NN/users/knn?U=10&R=10&engine=auto -X GET
+		curl http://127.0.0.1:5000/v1/NN/users/knn?U=10&R=500&mode=approx&eps=0.01 -X GET
+		curl http://127.0.0.1:5000/v1/NN/users/knn?U=10&R=10&K=5 -X GET
 	"""
 	def __init__(self):
 		"""
 		Initial conditions:
 		- user coord
 		- radius
+		- whole table stats, shared by all queries of request
 		"""
 		self.x0 = None
 		self.y0 = None
 		self.r = None
+		self.dstats = None
 
 	def getMinMaxRectDist(self, stats):
 		"""
 		Returns min and max distances from point to rectangle
 		"""
-		dists = list()
-
-		# Add rect coner distances
-		for x, y in stats.rect:
-			dist = sqrt((self.x0 - x) ** 2 + (self.y0 - y) ** 2)
-			dists.append(dist)
+		return getMinMaxRectDist(self.x0, self.y0, \
+			(stats.minX, stats.minY, stats.maxX, stats.maxY))
 
-		# Add rect side distances
-		if (stats.minX <= self.x0 <= stats.maxX):
-			for y in (stats.minY, stats.maxY):
-				dist = abs(y - self.y0)
-				dists.append(dist)
-		if (stats.minY <= self.y0 <= stats.maxY):
-			for x in (stats.minX, stats.maxX):
-				dist = abs(x - self.x0)
-				dists.append(dist)
-
-		return min(dists), max(dists)
-
-	def getDistkNN(self, stats):
+	@knnEngine("dist", distCost)
+	def getDistkNN(self):
 		"""
 		Algorythm by comparing all distances with radius
+		Vectorized by numpy column index if it is enabled
 		Used in benchmark test
 		"""
+		columns = indexes.get("columns")
+		if columns is not None:
+			metrics.rows(columns.size)
+			return columns.countInCircle(self.x0, self.y0, self.r)
+
 		result = 0
 		for user in DBUser.query.yield_per(100):
+			metrics.rows(1)
 			dist = sqrt((user.x - self.x0) ** 2 + (user.y - self.y0) ** 2)
 			if dist <= self.r:
 				result += 1
 		return result
 
+	@knnEngine("sql", sqlCost)
+	def getSQLkNN(self):
+		"""
+		Algorythm by one aggregate query
+		Bounding square is filtered by x, y index,
+		distances are compared inside SQLite, only count is returned
+		"""
+		x0, y0, r = self.x0, self.y0, self.r
+		dist2 = (DBUser.x - x0) * (DBUser.x - x0) + (DBUser.y - y0) * (DBUser.y - y0)
+		query = db.session.query(db.func.count(DBUser.id)).filter(\
+			DBUser.x >= x0 - r, \
+			DBUser.x <= x0 + r, \
+			DBUser.y >= y0 - r, \
+			DBUser.y <= y0 + r, \
+			dist2 <= r * r)
+		return query.scalar()
+
+	@knnEngine("rtree", rtreeCost, "rtree")
+	def getRTreekNN(self):
+		"""
+		Algorythm by SQLite R*Tree
+		Bounding square is found by R*Tree,
+		distances are compared inside SQLite
+		"""
+		rtree = indexes.get("rtree")
+		return rtree.countInCircle(self.x0, self.y0, self.r)
+
+	@knnEngine("grid", gridCost, "grid")
+	def getGridkNN(self):
+		"""
+		Algorythm by in-memory uniform grid
+		Sum counts of cells inside the search zone and
+		check distances only in cells on the circle boundary
+		"""
+		grid = indexes.get("grid")
+		return grid.countInCircle(self.x0, self.y0, self.r)
+
+	@knnEngine("kdtree", kdtreeCost, "kdtree")
+	def getKDTreekNN(self):
+		"""
+		Algorythm by in-memory KD-tree
+		Nodes inside the search zone add their count,
+		nodes outside are skipped
+		"""
+		kdtree = indexes.get("kdtree")
+		return kdtree.countInCircle(self.x0, self.y0, self.r)
+
+	@knnEngine("shards", shardsCost, "shards")
+	def getShardskNN(self):
+		"""
+		Algorythm by shard processes
+		Shards intersecting the search zone count by their grids in parallel
+		"""
+		shards = indexes.get("shards")
+		return shards.countInCircle(self.x0, self.y0, self.r)
+
+	@knnEngine("fenwick", fenwickCost, "fenwick")
+	def getFenwickkNN(self, stats = None, depth = 1):
+		"""
+		Main algorythm without DB
+		Rect user count is 4 prefix sums of Fenwick tree.
+		Rects are geometric, they are split in the middle of longer side.
+		Small rect is counted by lines inside the search zone.
+		"""
+		fenwick = indexes.get("fenwick")
+		if stats is None:
+			x0, y0, r = self.x0, self.y0, self.r
+			init_rect = (x0 - r, y0 - r, x0 + r, y0 + r)
+			stats = RectStats(*init_rect, count = fenwick.countRect(*init_rect))
+		if stats.count == 0:
+			metrics.rect("outside", depth)
+			return 0
+
+		# Check rectangle is outside, inside or has intersections
+		min_dist, max_dist = self.getMinMaxRectDist(stats)
+		if min_dist > self.r:
+			metrics.rect("outside", depth)
+			return 0
+		elif max_dist <= self.r:
+			metrics.rect("inside", depth)
+			return stats.count
+
+		minX, minY, maxX, maxY = stats.bounds
+		if min(maxX - minX, maxY - minY) < MIN_RECT_SIDE:
+			metrics.rect("checked", depth)
+			return fenwick.countInRectCircle(stats.bounds, self.x0, self.y0, self.r)
+
+		metrics.rect("split", depth)
+		# Split rect into two in longer side
+		if maxX - minX >= maxY - minY:
+			midX = (minX + maxX) // 2
+			rects = ((minX, minY, midX, maxY), (midX + 1, minY, maxX, maxY))
+		else:
+			midY = (minY + maxY) // 2
+			rects = ((minX, minY, maxX, midY), (minX, midY + 1, maxX, maxY))
+		result = 0
+		for rect in rects:
+			stats = RectStats(*rect, count = fenwick.countRect(*rect))
+			result += self.getFenwickkNN(stats, depth + 1)
+		return result
+
+	def getNearest(self, k, user_id):
+		"""
+		Return K nearest users within R except user_id
+		as list of (id, dist) sorted by distance
+		"""
+		kdtree = indexes.get("kdtree")
+		if kdtree is not None:
+			return kdtree.nearest(self.x0, self.y0, k, self.r, user_id)
+
+		# Sort users by distance in DB
+		x0, y0, r = self.x0, self.y0, self.r
+		dist2 = (DBUser.x - x0) * (DBUser.x - x0) + (DBUser.y - y0) * (DBUser.y - y0)
+		query = db.session.query(DBUser.id, dist2).filter(\
+			DBUser.x >= x0 - r, \
+			DBUser.x <= x0 + r, \
+			DBUser.y >= y0 - r, \
+			DBUser.y <= y0 + r, \
+			dist2 <= r * r, \
+			DBUser.id != user_id)
+		query = query.order_by(dist2, DBUser.id).limit(k)
+		return [(nn_id, sqrt(nn_dist2)) for nn_id, nn_dist2 in query]
+
+	def getTableStats(self):
+		"""
+		Whole table stats, shared by all queries of request
+		Taken from aggregate tracker without DB if it is enabled
+		"""
+		if self.dstats is None:
+			aggregates = indexes.get("aggregates")
+			if aggregates is not None:
+				self.dstats = TrackedStats(aggregates)
+			else:
+				self.dstats = DBUserStats()
+		return self.dstats
+
+	def getInitStats(self):
+		"""
+		Stats of DB rect where search zone is located
+		"""
+		x0, y0, r = self.x0, self.y0, self.r
+		dstats = self.getTableStats()
+		nnstats = DBUserStats(x0 - r, y0 - r, x0 + r, y0 + r)
+		if nnstats.count == 0:
+			# No users around
+			return nnstats
+		init_rect = (
+			max(dstats.minX, nnstats.minX),
+			max(dstats.minY, nnstats.minY),
+			min(dstats.maxX, nnstats.maxX),
+			min(dstats.maxY, nnstats.maxY),
+		)
+		return DBUserStats(*init_rect)
+
+	def getCosts(self):
+		"""
+		Return cost estimates of available engines by name
+		Density is users count per square of whole table bounds
+		"""
+		costs = OrderedDict()
+		dstats = self.getTableStats()
+		n = dstats.count
+		if n == 0:
+			return costs
+		area = (dstats.maxX - dstats.minX + 1) * (dstats.maxY - dstats.minY + 1)
+		density = float(n) / area
+		for engine in knn_engines.values():
+			if engine.index is None or indexes.get(engine.index) is not None:
+				costs[engine.name] = engine.cost(n, density, self.r)
+		return costs
+
+	def planEngine(self):
+		"""
+		Return the cheapest engine name for current query
+		"""
+		costs = self.getCosts()
+		if not costs:
+			return "split"
+		name = min(costs, key = costs.get)
+		app.logger.info("kNN planner: R=%s engine=%s cost=%.0f estimates=%s", \
+			self.r, name, costs[name], \
+			", ".join("%s:%.0f" % item for item in costs.items()))
+		return name
+
+	def getCount(self, engine_name = None):
+		"""
+		Return users count within R from (x0, y0)
+		by named engine, by the cheapest one if engine_name is auto
+		or by the fastest enabled index if engine_name is None
+		"""
+		if engine_name == "auto":
+			engine_name = self.planEngine()
+		if engine_name is not None:
+			return getEngine(engine_name).method(self)
+		elif indexes.get("grid") is not None:
+			return self.getGridkNN()
+		elif indexes.get("kdtree") is not None:
+			return self.getKDTreekNN()
+		return self.getSplitkNN()
+
+	def getApproxCount(self, eps, engine_name = None):
+		"""
+		Return (estimate, error bound) of users count within R
+		Estimate is taken from grid cell counts, boundary cells are
+		checked until error bound is at most eps of estimate.
+		Without grid count is exact by engine and error is 0
+		"""
+		grid = indexes.get("grid")
+		if grid is None:
+			return self.getCount(engine_name), 0
+		estimate, error = grid.approxCountInCircle(self.x0, self.y0, self.r, eps)
+		return int(round(estimate)), int(ceil(error))
+
+	@knnEngine("split", splitCost)
+	def getSplitkNN(self):
+		"""
+		Main algorythm from whole table stats
+		"""
+		return self.getkNN(self.getInitStats())
+
 	def getkNN(self, stats):
 		"""
 		=== Main algorythm ===
@@ -250,20 +1051,61 @@ class Knn(Resource):
 			- Compare distance with R
 		Split logic:
 			- Split longer rect side.
-			- Split by neighbors of avarage value
+			- Split by neighbors of median value of all users in rect side range
+			if quantile index is enabled, else by neighbors of avarage value
+		Rects wait in work queue, while queue is shorter than
+		KNN_INLINE_RECTS they are evaluated one by one in request thread,
+		longer queue is evaluated at once by worker pool
+		"""
+		result = 0
+		queue = deque([(stats, 1)])
+		while queue:
+			if knn_pool is not None and len(queue) >= app.config["KNN_INLINE_RECTS"]:
+				bind = db.session.get_bind(DBUser.__mapper__)
+				request_metrics = metrics.current
+				tasks = [(stats, depth, bind, request_metrics) for stats, depth in queue]
+				queue.clear()
+				evaluated = knn_pool.map(self._evalRectTask, tasks)
+			else:
+				evaluated = [self.evalRect(*queue.popleft())]
+			for count, rects in evaluated:
+				result += count
+				queue.extend(rects)
+		return result
+
+	def _evalRectTask(self, task):
+		"""
+		Evaluate rect in worker thread with its own DB session
+		bound to request engine, metrics are added to request ones
+		"""
+		stats, depth, bind, request_metrics = task
+		metrics.attach(request_metrics)
+		db.session().bind_mapper(DBUser, bind)
+		try:
+			return self.evalRect(stats, depth)
+		finally:
+			metrics.attach(None)
+			db.session.remove()
+
+	def evalRect(self, stats, depth):
+		"""
+		Return users count of rect and (stats, depth) of its split rects
 		"""
 		result = 0
 		if stats.count == 0:
-			return 0
+			metrics.rect("outside", depth)
+			return 0, ()
 
 		# Check rectangle is outside, inside or has intersections
 		min_dist, max_dist = self.getMinMaxRectDist(stats)
 		if (min_dist > self.r) and (max_dist > self.r):
 			# Rect outside
-			return 0
+			metrics.rect("outside", depth)
+			return 0, ()
 		elif (min_dist <= self.r) and (max_dist <= self.r):
 			# Rect inside
-			return stats.count
+			metrics.rect("inside", depth)
+			return stats.count, ()
 
 		# Intersection between rectangle and search area
 		if (stats.maxX - stats.minX) < self.r / 10 \
@@ -276,28 +1118,54 @@ class Knn(Resource):
 				DBUser.x <= stats.maxX, \
 				DBUser.y >= stats.minY, \
 				DBUser.y <= stats.maxY).all()
+			metrics.rect("checked", depth)
+			metrics.rows(len(users))
 			for user in users:
 				dist = sqrt((self.x0 - user.x) ** 2 + (self.y0 - user.y) ** 2)
 				if dist <= self.r:
 					result += 1
+			return result, ()
+
+		# Split rect into two in longer side
+		metrics.rect("split", depth)
+		if abs(stats.maxX - stats.minX) >= abs(stats.maxY - stats.minY):
+			leftX, rightX = self.getSplitValues(stats, "x")
+			stats1 = DBUserStats(stats.minX, stats.minY, leftX, stats.maxY)
+			stats2 = DBUserStats(rightX, stats.minY, stats.maxX, stats.maxY)
 		else:
-			# Split rect into two in longer side
-			if abs(stats.maxX - stats.minX) >= abs(stats.maxY - stats.minY):
-				# find nearest left and right of avgX
-				leftX = DBUser.query.filter(DBUser.x <= stats.avgX).order_by(db.desc(DBUser.x)).first().x
-				rightX = DBUser.query.filter(DBUser.x > stats.avgX).order_by(DBUser.x).first().x
-				stats1 = DBUserStats(stats.minX, stats.minY, leftX, stats.maxY)
-				stats2 = DBUserStats(rightX, stats.minY, stats.maxX, stats.maxY)
-			else:
-				# find nearest left and right of avgY
-				downY = DBUser.query.filter(DBUser.y <= stats.avgY).order_by(db.desc(DBUser.y)).first().y
-				upY = DBUser.query.filter(DBUser.y > stats.avgY).order_by(DBUser.y).first().y
-				stats1 = DBUserStats(stats.minX, stats.minY, stats.maxX, downY)
-				stats2 = DBUserStats(stats.minX, upY, stats.maxX, stats.maxY)
-			result += self.getkNN(stats1)
-			result += self.getkNN(stats2)
+			downY, upY = self.getSplitValues(stats, "y")
+			stats1 = DBUserStats(stats.minX, stats.minY, stats.maxX, downY)
+			stats2 = DBUserStats(stats.minX, upY, stats.maxX, stats.maxY)
+		return 0, ((stats1, depth + 1), (stats2, depth + 1))
 
-		return result
+	def getSplitValues(self, stats, axis):
+		"""
+		Return adjacent user coordinates of axis to split stats rect
+		Median of users of the rect is found by bisection on Fenwick
+		rect counts, users outside of Fenwick square are scanned on every
+		split, so it is used while they are not more than rect users.
+		Otherwise median of the whole strip of the rect is found by quantile
+		index, halves are balanced only if strip users are spread as in
+		the rect, without indexes neighbors of average value are found in DB
+		"""
+		fenwick = indexes.get("fenwick")
+		if fenwick is not None and len(fenwick.outside) <= stats.count:
+			values = fenwick.splitValues(stats.bounds, axis)
+			if values is not None:
+				return values
+		if axis == "x":
+			low, high, avg = stats.minX, stats.maxX, stats.avgX
+		else:
+			low, high, avg = stats.minY, stats.maxY, stats.avgY
+		quantiles = indexes.get("quantiles")
+		if quantiles is not None:
+			values = quantiles.splitValues(axis, low, high)
+			if values is not None:
+				return values
+		column = getattr(DBUser, axis)
+		left = db.session.query(column).filter(column <= avg).order_by(db.desc(column)).first()[0]
+		right = db.session.query(column).filter(column > avg).order_by(column).first()[0]
+		return left, right
 
 	def get(self):
 		"""
@@ -306,7 +1174,19 @@ class Knn(Resource):
 		"""
 		r = int(request.args.get('R', 0))
 		user_id = int(request.args.get('U', 0))
-		dist_angorythm = request.args.get('dist', None)
+		try:
+			engine_name = getEngineName(request.args)
+		except ValueError as e:
+			return {
+				"message": "Bad request. %s." % e
+			}, status.HTTP_400_BAD_REQUEST
+		k = request.args.get('K', None)
+		if k is not None:
+			k = int(k)
+			if k <= 0:
+				return {
+					"message": "Bad request. K argument should be positive."
+				}, status.HTTP_400_BAD_REQUEST
 		if not r:
 			return {
 				"message": "Bad request. R argument is required."
@@ -315,6 +1195,24 @@ class Knn(Resource):
 			return {
 				"message": "Bad request. U argument is required."
 			}, status.HTTP_400_BAD_REQUEST
+		mode = request.args.get("mode", "exact")
+		if mode not in ("exact", "approx") or (mode == "approx" and k is not None):
+			return {
+				"message": "Bad request. mode should be exact or approx without K."
+			}, status.HTTP_400_BAD_REQUEST
+		eps = float(request.args.get("eps", APPROX_EPS))
+		if not 0 < eps < 1:
+			return {
+				"message": "Bad request. eps argument should be between 0 and 1."
+			}, status.HTTP_400_BAD_REQUEST
+
+		# Writes since token are checked before caching result
+		key = (user_id, r, k, engine_name, mode, eps if mode == "approx" else None)
+		if knn_cache is not None:
+			token = knn_cache.start()
+			response = knn_cache.get(key)
+			if response is not None:
+				return dict(response, cache = "hit"), status.HTTP_200_OK
 
 		u = DBUser.query.filter_by(id = user_id).first()
 		if not u:
@@ -322,33 +1220,309 @@ class Knn(Resource):
 				"message": "User %s not found" % user_id
 			}, status.HTTP_404_NOT_FOUND
 
-		dstats = DBUserStats()
-		nnstats = DBUserStats(u.x - r, u.y - r, u.x + r, u.y + r)
-		init_rect = (
-			max(dstats.minX, nnstats.minX),
-			max(dstats.minY, nnstats.minY),
-			min(dstats.maxX, nnstats.maxX),
-			min(dstats.maxY, nnstats.maxY),
-		)
-		init_stats = DBUserStats(*init_rect)
-
 		self.x0, self.y0 = (u.x, u.y)
 		self.r = r
 
-		if dist_angorythm == "Y":
-			result = self.getDistkNN(init_stats) - 1
+		if k is not None:
+			neighbors = [
+				{"id": nn_id, "dist": dist} \
+				for nn_id, dist in self.getNearest(k, user_id)
+			]
+			response = {
+				"message": "OK",
+				"neighbors": neighbors,
+			}
+		elif mode == "approx":
+			result, error = self.getApproxCount(eps, engine_name)
+			response = {
+				"message": "OK",
+				"result": result - 1,
+				"error": error,
+				"mode": "approx" if error else "exact",
+			}
+		else:
+			response = {
+				"message": "OK",
+				"result": self.getCount(engine_name) - 1,
+			}
+
+		if knn_cache is not None:
+			square = (u.x - r, u.y - r, u.x + r, u.y + r)
+			knn_cache.put(key, response, square, token)
+			response = dict(response, cache = "miss")
+		return response, status.HTTP_200_OK
+
+def parseCircle(query):
+	"""
+	Return (user_id, x, y, r) of query with R and U or x and y,
+	user_id is None for point query
+	"""
+	r = int(query["R"])
+	if r <= 0:
+		raise ValueError("R should be positive")
+	if "U" in query:
+		return int(query["U"]), None, None, r
+	return None, int(query["x"]), int(query["y"]), r
+
+class KnnBatch(Resource):
+	"""
+	Controller to evaluate many kNN queries by one request
+	Query has R and user U or point x, y.
+	Point itself is counted, user U is not.
+	Users are fetched by one query, whole table stats are shared,
+	all distances algorythm (dist=Y) compares every users chunk
+	with all queries at once
+	Example:
+		curl http://127.0.0.1:5000/v1/NN/users/knn/batch -X POST -d '{"queries": [{"U": 1, "R": 10}, {"x": 5, "y": 5, "R": 10}]}'
+	"""
+
+	def getCounts(self, circles, engine_name):
+		"""
+		Return users count for each (x0, y0, r) circle
+		"""
+		columns = indexes.get("columns")
+		if engine_name == "dist" and columns is not None:
+			return columns.countInCircles(circles)
+		knn = Knn()
+		counts = list()
+		for x0, y0, r in circles:
+			knn.x0, knn.y0, knn.r = x0, y0, r
+			counts.append(knn.getCount(engine_name))
+		return counts
+
+	def post(self):
+		"""
+		Return results in order of queries
+		Result is null with message if user is not found
+		"""
+		json_data = request.get_json(force = True)
+		queries = None
+		if isinstance(json_data, dict):
+			queries = json_data.get("queries")
+		if not isinstance(queries, list):
+			return {
+				"message": "Bad request. queries list is required."
+			}, status.HTTP_400_BAD_REQUEST
+		try:
+			engine_name = getEngineName(request.args)
+		except ValueError as e:
+			return {
+				"message": "Bad request. %s." % e
+			}, status.HTTP_400_BAD_REQUEST
+
+		parsed = list()
+		for query_number, query in enumerate(queries):
+			try:
+				parsed.append(parseCircle(query))
+			except (KeyError, ValueError, TypeError):
+				return {
+					"message": "Bad request. Query %s should have R and U or x and y." \
+								% query_number
+				}, status.HTTP_400_BAD_REQUEST
+
+		# Fetch all users by one query
+		user_ids = set(user_id for user_id, _, _, _ in parsed if user_id is not None)
+		users = dict()
+		if user_ids:
+			query = db.session.query(DBUser.id, DBUser.x, DBUser.y)
+			for user_id, x, y in query.filter(DBUser.id.in_(user_ids)):
+				users[user_id] = (x, y)
+
+		results = [None] * len(parsed)
+		circles = list()
+		positions = list()
+		for query_number, (user_id, x, y, r) in enumerate(parsed):
+			if user_id is not None:
+				if user_id not in users:
+					results[query_number] = {
+						"message": "User %s not found" % user_id,
+						"result": None
+					}
+					continue
+				x, y = users[user_id]
+			circles.append((x, y, r))
+			positions.append((query_number, user_id))
+
+		counts = self.getCounts(circles, engine_name)
+		for (query_number, user_id), count in zip(positions, counts):
+			if user_id is not None:
+				# User is not neighbor to himself
+				count -= 1
+			results[query_number] = {
+				"message": "OK",
+				"result": count
+			}
+
+		return {
+			"message": "OK",
+			"results": results
+		}, status.HTTP_200_OK
+
+def countInRegion(region):
+	"""
+	Return users count in region by one pass
+	over grid index cells or DB rects if grid is not enabled
+	DB rects are classified by region, inside rect adds its count,
+	boundary rect is split in the middle of longer side
+	or its users are checked if there are few of them
+	"""
+	grid = indexes.get("grid")
+	if grid is not None:
+		return grid.countInRegion(region)
+
+	result = 0
+	queue = deque([(DBUserStats(*region.bounds), 1)])
+	while queue:
+		stats, depth = queue.popleft()
+		if stats.count == 0:
+			metrics.rect("outside", depth)
+			continue
+		minX, minY, maxX, maxY = stats.minX, stats.minY, stats.maxX, stats.maxY
+		position = region.getRectPosition((minX, minY, maxX, maxY))
+		if position != "boundary":
+			metrics.rect(position, depth)
+			if position == "inside":
+				result += stats.count
+			continue
+		if stats.count < MIN_USERS:
+			metrics.rect("checked", depth)
+			users = db.session.query(DBUser.x, DBUser.y).filter(\
+				DBUser.x >= minX, \
+				DBUser.x <= maxX, \
+				DBUser.y >= minY, \
+				DBUser.y <= maxY).all()
+			metrics.rows(len(users))
+			result += region.countPoints(users)
+			continue
+		metrics.rect("split", depth)
+		if maxX - minX >= maxY - minY:
+			midX = (minX + maxX) // 2
+			rects = ((minX, minY, midX, maxY), (midX + 1, minY, maxX, maxY))
 		else:
-			result = self.getkNN(init_stats) - 1
+			midY = (minY + maxY) // 2
+			rects = ((minX, minY, maxX, midY), (minX, midY + 1, maxX, maxY))
+		queue.extend((DBUserStats(*rect), depth + 1) for rect in rects)
+	return result
+
+class RegionRect(Resource):
+	"""
+	Controller to count users in rect, bounds are included
+	Example:
+		curl "http://127.0.0.1:5000/v1/NN/users/region/rect?minX=0&minY=0&maxX=10&maxY=10" -X GET
+	"""
 
+	def get(self):
+		try:
+			bounds = [int(request.args[name]) for name in ("minX", "minY", "maxX", "maxY")]
+		except (KeyError, ValueError):
+			return {
+				"message": "Bad request. minX, minY, maxX and maxY arguments are required."
+			}, status.HTTP_400_BAD_REQUEST
+		if bounds[0] > bounds[2] or bounds[1] > bounds[3]:
+			return {
+				"message": "Bad request. Min bounds should not be greater than max ones."
+			}, status.HTTP_400_BAD_REQUEST
+		return {
+			"message": "OK",
+			"result": countInRegion(RectRegion(*bounds))
+		}, status.HTTP_200_OK
+
+class RegionAnnulus(Resource):
+	"""
+	Controller to count users farther than R1 and within R2
+	from user U or point x, y
+	Example:
+		curl "http://127.0.0.1:5000/v1/NN/users/region/annulus?U=1&R1=5&R2=10" -X GET
+	"""
+
+	def get(self):
+		try:
+			r1 = int(request.args["R1"])
+			r2 = int(request.args["R2"])
+			if "U" in request.args:
+				user_id = int(request.args["U"])
+				x0 = y0 = None
+			else:
+				user_id = None
+				x0, y0 = int(request.args["x"]), int(request.args["y"])
+		except (KeyError, ValueError):
+			return {
+				"message": "Bad request. R1, R2 and U or x and y arguments are required."
+			}, status.HTTP_400_BAD_REQUEST
+		if not 0 <= r1 < r2:
+			return {
+				"message": "Bad request. R1 should be less than R2."
+			}, status.HTTP_400_BAD_REQUEST
+		if user_id is not None:
+			u = DBUser.query.filter_by(id = user_id).first()
+			if not u:
+				return {
+					"message": "User %s not found" % user_id
+				}, status.HTTP_404_NOT_FOUND
+			x0, y0 = u.x, u.y
+		return {
+			"message": "OK",
+			"result": countInRegion(AnnulusRegion(x0, y0, r1, r2))
+		}, status.HTTP_200_OK
+
+class RegionCircles(Resource):
+	"""
+	Controller to count users in union of circles
+	Circle has R and user U or point x, y as KnnBatch query,
+	user in many circles is counted once
+	Example:
+		curl http://127.0.0.1:5000/v1/NN/users/region/circles -X POST -d '{"circles": [{"U": 1, "R": 10}, {"x": 5, "y": 5, "R": 10}]}'
+	"""
+
+	def post(self):
+		json_data = request.get_json(force = True)
+		circles = None
+		if isinstance(json_data, dict):
+			circles = json_data.get("circles")
+		if not isinstance(circles, list) or not circles:
+			return {
+				"message": "Bad request. circles list is required."
+			}, status.HTTP_400_BAD_REQUEST
+		parsed = list()
+		for number, circle in enumerate(circles):
+			try:
+				parsed.append(parseCircle(circle))
+			except (KeyError, ValueError, TypeError):
+				return {
+					"message": "Bad request. Circle %s should have R and U or x and y." % number
+				}, status.HTTP_400_BAD_REQUEST
+
+		user_ids = set(user_id for user_id, _, _, _ in parsed if user_id is not None)
+		users = dict()
+		if user_ids:
+			query = db.session.query(DBUser.id, DBUser.x, DBUser.y)
+			for user_id, x, y in query.filter(DBUser.id.in_(user_ids)):
+				users[user_id] = (x, y)
+		missed = user_ids - set(users)
+		if missed:
+			return {
+				"message": "User %s not found" % min(missed)
+			}, status.HTTP_404_NOT_FOUND
+		region = CirclesRegion(
+			users[user_id] + (r,) if user_id is not None else (x, y, r) \
+			for user_id, x, y, r in parsed
+		)
 		return {
 			"message": "OK",
-			"result": result,
+			"result": countInRegion(region)
 		}, status.HTTP_200_OK
 
 api.add_resource(UserList, "%s/users" % BASEURL)
 api.add_resource(Info, "%s/users/info" % BASEURL)
+api.add_resource(Metrics, "%s/metrics" % BASEURL)
+api.add_resource(UserBulk, "%s/users/bulk" % BASEURL)
+api.add_resource(UserExport, "%s/users/export" % BASEURL)
 api.add_resource(User, "%s/users/<int:user_id>" % BASEURL)
 api.add_resource(Knn, "%s/users/knn" % BASEURL)
+api.add_resource(KnnBatch, "%s/users/knn/batch" % BASEURL)
+api.add_resource(RegionRect, "%s/users/region/rect" % BASEURL)
+api.add_resource(RegionAnnulus, "%s/users/region/annulus" % BASEURL)
+api.add_resource(RegionCircles, "%s/users/region/circles" % BASEURL)
 
 if __name__ == '__main__':
 	app.run(debug = True)
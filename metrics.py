@@ -0,0 +1,217 @@
+"""
+Per-request performance metrics
+Counters of current request are kept in thread local storage,
+finished requests are summed by resource and exported
+in Prometheus text format
+"""
+from collections import OrderedDict
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds of request wall time histogram, seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+# kNN rect classification: inside and outside are counted at once,
+# split rect is divided into two, checked rect has distances checked
+RECT_KINDS = ("inside", "outside", "split", "checked")
+
+class RequestMetrics(object):
+	"""
+	Counters of one request
+	Counters are updated under lock, kNN worker threads
+	attached to request count into the same metrics
+	"""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.start_time = time.time()
+		self.wall_time = None
+		self.sql_statements = 0
+		self.sql_time = 0.0
+		self.knn_depth = 0
+		self.rects = OrderedDict((kind, 0) for kind in RECT_KINDS)
+		self.rows_checked = 0
+
+	def countSQL(self, sql_time):
+		with self.lock:
+			self.sql_statements += 1
+			self.sql_time += sql_time
+
+	def countRect(self, kind, depth):
+		with self.lock:
+			self.rects[kind] += 1
+			self.knn_depth = max(self.knn_depth, depth)
+
+	def countRows(self, count):
+		with self.lock:
+			self.rows_checked += count
+
+	def asDict(self):
+		with self.lock:
+			wall_time = self.wall_time
+			if wall_time is None:
+				wall_time = time.time() - self.start_time
+			return {
+				"wall_time": wall_time,
+				"sql_statements": self.sql_statements,
+				"sql_time": self.sql_time,
+				"knn_depth": self.knn_depth,
+				"rects": dict(self.rects),
+				"rows_checked": self.rows_checked,
+			}
+
+class ResourceMetrics(object):
+	"""
+	Sums of finished requests of one resource
+	"""
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.requests = 0
+		self.buckets = [0] * len(LATENCY_BUCKETS)
+		self.wall_time = 0.0
+		self.sql_statements = 0
+		self.sql_time = 0.0
+		self.max_knn_depth = 0
+		self.rects = OrderedDict((kind, 0) for kind in RECT_KINDS)
+		self.rows_checked = 0
+
+	def add(self, request_metrics):
+		counts = request_metrics.asDict()
+		with self.lock:
+			self.requests += 1
+			for number, bound in enumerate(LATENCY_BUCKETS):
+				if counts["wall_time"] <= bound:
+					self.buckets[number] += 1
+			self.wall_time += counts["wall_time"]
+			self.sql_statements += counts["sql_statements"]
+			self.sql_time += counts["sql_time"]
+			self.max_knn_depth = max(self.max_knn_depth, counts["knn_depth"])
+			for kind, count in counts["rects"].items():
+				self.rects[kind] += count
+			self.rows_checked += counts["rows_checked"]
+
+class MetricsRegistry(object):
+	"""
+	Request metrics collected by hooks and summed by resource
+	Hooks do nothing outside of request
+	"""
+
+	def __init__(self):
+		self.local = threading.local()
+		self.lock = threading.Lock()
+		self.resources = OrderedDict()
+
+	@property
+	def current(self):
+		"""
+		Metrics of current request or None
+		"""
+		return getattr(self.local, "metrics", None)
+
+	def start(self):
+		self.local.metrics = RequestMetrics()
+		self.local.sql_start = None
+
+	def attach(self, request_metrics):
+		"""
+		Count metrics of other thread working for request,
+		None detaches thread
+		"""
+		self.local.metrics = request_metrics
+		self.local.sql_start = None
+
+	def finish(self, resource):
+		"""
+		Stop current request and add its metrics to resource sums
+		"""
+		request_metrics = self.current
+		if request_metrics is None:
+			return None
+		self.local.metrics = None
+		with request_metrics.lock:
+			request_metrics.wall_time = time.time() - request_metrics.start_time
+		with self.lock:
+			if resource not in self.resources:
+				self.resources[resource] = ResourceMetrics()
+			self.resources[resource].add(request_metrics)
+		return request_metrics
+
+	def clear(self):
+		with self.lock:
+			self.resources.clear()
+
+	def beforeSQL(self):
+		if self.current is not None:
+			self.local.sql_start = time.time()
+
+	def afterSQL(self):
+		request_metrics = self.current
+		if request_metrics is not None and self.local.sql_start is not None:
+			request_metrics.countSQL(time.time() - self.local.sql_start)
+			self.local.sql_start = None
+
+	def rect(self, kind, depth):
+		"""
+		Count kNN rect of kind on recursion depth
+		"""
+		request_metrics = self.current
+		if request_metrics is not None:
+			request_metrics.countRect(kind, depth)
+
+	def rows(self, count):
+		"""
+		Count users with distance checked
+		"""
+		request_metrics = self.current
+		if request_metrics is not None:
+			request_metrics.countRows(count)
+
+	def export(self):
+		"""
+		Return metrics in Prometheus text format
+		"""
+		lines = list()
+		def metric(name, metric_type, description, values):
+			lines.append("# HELP %s %s" % (name, description))
+			lines.append("# TYPE %s %s" % (name, metric_type))
+			for labels, value in values:
+				labels = ",".join('%s="%s"' % label for label in labels)
+				lines.append("%s{%s} %s" % (name, labels, value))
+
+		with self.lock:
+			resources = list(self.resources.items())
+			metric("nn_requests_total", "counter", "Finished requests", \
+				[((("resource", name),), sums.requests) for name, sums in resources])
+			lines.append("# HELP nn_request_duration_seconds Request wall time")
+			lines.append("# TYPE nn_request_duration_seconds histogram")
+			for name, sums in resources:
+				for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), sums.buckets + [sums.requests]):
+					lines.append('nn_request_duration_seconds_bucket{resource="%s",le="%s"} %s' \
+						% (name, bound, count))
+				lines.append('nn_request_duration_seconds_sum{resource="%s"} %r' % (name, sums.wall_time))
+				lines.append('nn_request_duration_seconds_count{resource="%s"} %s' % (name, sums.requests))
+			metric("nn_sql_statements_total", "counter", "SQL statements executed", \
+				[((("resource", name),), sums.sql_statements) for name, sums in resources])
+			metric("nn_sql_duration_seconds_total", "counter", "SQL statements time", \
+				[((("resource", name),), repr(sums.sql_time)) for name, sums in resources])
+			metric("nn_knn_rects_total", "counter", "kNN rects by classification", \
+				[((("resource", name), ("kind", kind)), count) \
+				for name, sums in resources for kind, count in sums.rects.items()])
+			metric("nn_knn_rows_checked_total", "counter", "Users with distance checked", \
+				[((("resource", name),), sums.rows_checked) for name, sums in resources])
+			metric("nn_knn_depth_max", "gauge", "Max kNN recursion depth", \
+				[((("resource", name),), sums.max_knn_depth) for name, sums in resources])
+		return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+@event.listens_for(Engine, "before_cursor_execute")
+def beforeCursorExecute(conn, cursor, statement, parameters, context, executemany):
+	metrics.beforeSQL()
+
+@event.listens_for(Engine, "after_cursor_execute")
+def afterCursorExecute(conn, cursor, statement, parameters, context, executemany):
+	metrics.afterSQL()
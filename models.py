@@ -1,27 +1,407 @@
+from collections import deque, namedtuple, OrderedDict
+import sqlite3
+import threading
+import time
+
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, Column, Float, Integer, MetaData, Table
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
+
+from index import SpatialIndex
+
+class PooledSQLAlchemy(SQLAlchemy):
+	"""
+	SQLAlchemy with connection pool for SQLite file if pool size is set,
+	pooled connections are passed between request threads
+	"""
+
+	def apply_driver_hacks(self, app, info, options):
+		SQLAlchemy.apply_driver_hacks(self, app, info, options)
+		if info.drivername == "sqlite" and options.get("pool_size") \
+				and info.database not in (None, "", ":memory:"):
+			options["poolclass"] = QueuePool
+			options.setdefault("connect_args", dict())["check_same_thread"] = False
+
+db = PooledSQLAlchemy()
+
+# PRAGMAs applied to every new SQLite connection, filled from config
+sqlite_pragmas = OrderedDict()
+
+@event.listens_for(Engine, "connect")
+def applySQLitePragmas(dbapi_connection, connection_record):
+	if not isinstance(dbapi_connection, sqlite3.Connection):
+		return
+	cursor = dbapi_connection.cursor()
+	for name, value in sqlite_pragmas.items():
+		cursor.execute("PRAGMA %s = %s" % (name, value))
+	cursor.close()
+
+@event.listens_for(Engine, "begin")
+def beginSQLiteTransaction(conn):
+	"""
+	Begin transaction by explicit BEGIN <mode> if connection has
+	sqlite_begin execution option, e.g. IMMEDIATE to take write lock.
+	pysqlite begins only before DML and commits before SAVEPOINT,
+	so its implicit transactions are off until commit or rollback
+	"""
+	mode = conn._execution_options.get("sqlite_begin")
+	if mode is None or conn.dialect.name != "sqlite":
+		return
+	dbapi_connection = conn.connection.connection
+	conn.info["sqlite_isolation_level"] = dbapi_connection.isolation_level
+	dbapi_connection.isolation_level = None
+	conn.execute("BEGIN %s" % mode)
+
+@event.listens_for(Engine, "commit")
+@event.listens_for(Engine, "rollback")
+def endSQLiteTransaction(conn):
+	if "sqlite_isolation_level" in conn.info:
+		conn.connection.connection.isolation_level = conn.info.pop("sqlite_isolation_level")
 
-db = SQLAlchemy()
+# Version of DBUser data, it is bumped after every write
+data_version = 0
+data_version_lock = threading.Lock()
+
+def bumpDataVersion():
+	"""
+	Make results cached for previous data version unreachable
+	Call it after write is committed
+	"""
+	global data_version
+	with data_version_lock:
+		data_version += 1
+
+class LRUCache(object):
+	"""
+	Dict with limited size, least recently used item is evicted first
+	Hits, misses and evictions are counted to choose the size
+	"""
+
+	def __init__(self, maxsize):
+		self.maxsize = maxsize
+		self.items = OrderedDict()
+		self.lock = threading.RLock()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def get(self, key, default = None):
+		with self.lock:
+			if key not in self.items:
+				self.misses += 1
+				return default
+			# Move item to the end as the most recently used
+			value = self.items.pop(key)
+			self.items[key] = value
+			self.hits += 1
+			return value
+
+	def put(self, key, value):
+		with self.lock:
+			self.items.pop(key, None)
+			self.items[key] = value
+			while len(self.items) > self.maxsize:
+				self.items.popitem(last = False)
+				self.evictions += 1
+
+	def pop(self, key):
+		with self.lock:
+			return self.items.pop(key, None)
+
+	def clear(self):
+		with self.lock:
+			self.items.clear()
+
+	@property
+	def info(self):
+		return {
+			"size": len(self.items),
+			"maxsize": self.maxsize,
+			"hits": self.hits,
+			"misses": self.misses,
+			"evictions": self.evictions
+		}
 
 class DBUser(db.Model):
 	"""
 	Users with their coordinates
+	Coordinates are unique, so there is only one user in a point
 	"""
 	id = db.Column(db.Integer, primary_key = True)
-	x = db.Column(db.Integer)
-	y = db.Column(db.Integer)
+	x = db.Column(db.Integer, index = True)
+	y = db.Column(db.Integer, index = True)
+
+	__table_args__ = (
+		db.Index("ix_db_user_x_y", "x", "y", unique = True),
+	)
 
 	def __init__(self, x, y):
 		self.x = x
 		self.y = y
 
+class DBWriteCount(db.Model):
+	"""
+	Count of user writes committed by CRUD controllers, one row
+	It is bumped in the write transaction, so warm start finds
+	write committed but missed in snapshot log by comparing them
+	"""
+	id = db.Column(db.Integer, primary_key = True)
+	count = db.Column(db.Integer, nullable = False)
+
+def initWriteCount():
+	"""
+	Add write count row missed in new DB or DB created by older versions
+	"""
+	if DBWriteCount.query.get(1) is None:
+		db.session.add(DBWriteCount(id = 1, count = 0))
+		db.session.commit()
+
+def bumpWriteCount(writes):
+	"""
+	Add writes to write count in current transaction
+	"""
+	table = DBWriteCount.__table__
+	db.session.execute(table.update().values(count = table.c.count + writes))
+
+def getWriteCount():
+	return db.session.query(DBWriteCount.count).scalar() or 0
+
+def upgradeDB():
+	"""
+	Add DBUser indexes missed in DB created by older versions
+	Duplicated users are removed before, the first one is kept
+	Return count of removed users
+	"""
+	table = DBUser.__table__
+	bind = db.session.get_bind()
+	existing = [index["name"] for index in db.inspect(bind).get_indexes(table.name)]
+	missing = [index for index in table.indexes if index.name not in existing]
+	if not missing:
+		return 0
+	dups = db.session.query(db.func.min(DBUser.id)).group_by(DBUser.x, DBUser.y)
+	removed = DBUser.query.filter(~DBUser.id.in_(dups)).delete(synchronize_session = False)
+	db.session.commit()
+	bumpDataVersion()
+	for index in missing:
+		index.create(bind)
+	return removed
+
+# R*Tree virtual table is not created by metadata of models
+rtree_table = Table("db_user_rtree", MetaData(), \
+	Column("id", Integer, primary_key = True), \
+	Column("minX", Float), \
+	Column("maxX", Float), \
+	Column("minY", Float), \
+	Column("maxY", Float), \
+)
+
+RTREE_DDL = (
+	"CREATE VIRTUAL TABLE IF NOT EXISTS db_user_rtree USING rtree(id, minX, maxX, minY, maxY)",
+	"CREATE TRIGGER IF NOT EXISTS db_user_rtree_insert AFTER INSERT ON db_user BEGIN "
+	"INSERT INTO db_user_rtree VALUES (new.id, new.x, new.x, new.y, new.y); END",
+	"CREATE TRIGGER IF NOT EXISTS db_user_rtree_update AFTER UPDATE OF x, y ON db_user BEGIN "
+	"UPDATE db_user_rtree SET minX = new.x, maxX = new.x, minY = new.y, maxY = new.y "
+	"WHERE id = new.id; END",
+	"CREATE TRIGGER IF NOT EXISTS db_user_rtree_delete AFTER DELETE ON db_user BEGIN "
+	"DELETE FROM db_user_rtree WHERE id = old.id; END",
+)
+
+class RTreeIndex(SpatialIndex):
+	"""
+	SQLite R*Tree virtual table mirroring DBUser
+	Triggers on DBUser write it in the same transaction as CRUD
+	controllers do, so index write methods do nothing.
+	R*Tree keeps float32 boxes rounded outward, box of user
+	with coordinate not exact in float32 is checked by DBUser row.
+	"""
+
+	def __init__(self):
+		self.table = rtree_table
+		# DB created later gets R*Tree with DBUser table
+		event.listen(DBUser.__table__, "after_create", \
+			lambda target, connection, **kwargs: self.create(connection))
+
+	def create(self, connection):
+		"""
+		Create R*Tree table and triggers if they are missed,
+		new table is filled from DBUser
+		Return False if SQLite is built without R*Tree module
+		"""
+		exists = connection.execute(
+			"SELECT count(*) FROM sqlite_master WHERE name = 'db_user_rtree'").scalar()
+		try:
+			for statement in RTREE_DDL:
+				connection.execute(statement)
+		except OperationalError:
+			return False
+		if not exists:
+			connection.execute("INSERT INTO db_user_rtree SELECT id, x, x, y, y FROM db_user")
+		return True
+
+	@property
+	def count(self):
+		return db.session.query(db.func.count(self.table.c.id)).scalar()
+
+	def rebuild(self, users):
+		pass
+
+	def insert(self, user_id, x, y):
+		pass
+
+	def update(self, user_id, x, y):
+		pass
+
+	def delete(self, user_id):
+		pass
+
+	def _coords(self):
+		"""
+		Return exact x and y expressions, zero box side means
+		coordinate is exact in float32
+		"""
+		c = self.table.c
+		coords = list()
+		for low, high, column in ((c.minX, c.maxX, DBUser.x), (c.minY, c.maxY, DBUser.y)):
+			row = db.select([column]).where(DBUser.id == c.id).as_scalar()
+			coords.append(db.case([(low == high, low)], else_ = row))
+		return coords
+
+	def _query(self, columns, minX, minY, maxX, maxY):
+		"""
+		Query of columns with boxes intersecting the rect
+		"""
+		c = self.table.c
+		return db.session.query(*columns).select_from(self.table).filter(\
+			c.maxX >= minX, \
+			c.minX <= maxX, \
+			c.maxY >= minY, \
+			c.minY <= maxY)
+
+	def stats(self, minX, minY, maxX, maxY):
+		"""
+		Return DBUserStats result of users in the rect
+		"""
+		x, y = self._coords()
+		query = self._query((
+			db.cast(db.func.min(x), db.Integer).label("minX"), \
+			db.cast(db.func.min(y), db.Integer).label("minY"), \
+			db.cast(db.func.max(x), db.Integer).label("maxX"), \
+			db.cast(db.func.max(y), db.Integer).label("maxY"), \
+			db.func.avg(x).label("avgX"), \
+			db.func.avg(y).label("avgY"), \
+			db.func.count(self.table.c.id).label("count"), \
+		), minX, minY, maxX, maxY)
+		return query.filter(x >= minX, x <= maxX, y >= minY, y <= maxY).one()
+
+	def countInCircle(self, x0, y0, r):
+		x, y = self._coords()
+		query = self._query((db.func.count(self.table.c.id),), x0 - r, y0 - r, x0 + r, y0 + r)
+		return query.filter((x - x0) * (x - x0) + (y - y0) * (y - y0) <= r * r).scalar()
+
+class ResultCache(LRUCache):
+	"""
+	LRU cache of query results with time to live
+	Every result has square (minX, minY, maxX, maxY) where it depends
+	on users, write of user inside the square removes the result.
+	Recent writes are logged to skip results computed during the write.
+	"""
+
+	def __init__(self, maxsize, ttl, log_size = 1000):
+		LRUCache.__init__(self, maxsize)
+		self.ttl = ttl
+		self.writes = deque(maxlen = log_size)
+		self.write_number = 0
+		self.expirations = 0
+		self.invalidations = 0
+
+	def _inSquare(self, square, x, y):
+		minX, minY, maxX, maxY = square
+		return minX <= x <= maxX and minY <= y <= maxY
+
+	def start(self):
+		"""
+		Return token to take before reading data for new result
+		"""
+		return self.write_number
+
+	def get(self, key, default = None):
+		with self.lock:
+			entry = self.items.get(key)
+			if entry is not None and entry[0] < time.time():
+				del self.items[key]
+				self.expirations += 1
+				entry = None
+		entry = LRUCache.get(self, key)
+		if entry is None:
+			return default
+		return entry[2]
+
+	def put(self, key, value, square, token):
+		"""
+		Put result unless user inside its square was written after token
+		"""
+		with self.lock:
+			if token < self.write_number - len(self.writes):
+				# Writes after token are not logged anymore
+				return
+			for number, x, y in self.writes:
+				if number > token and self._inSquare(square, x, y):
+					return
+			LRUCache.put(self, key, (time.time() + self.ttl, square, value))
+
+	def invalidate(self, points):
+		"""
+		Remove results with any of written (x, y) points in their square
+		"""
+		with self.lock:
+			for x, y in points:
+				self.write_number += 1
+				self.writes.append((self.write_number, x, y))
+			outdated = [
+				key for key, (_, square, _) in self.items.items() \
+				if any(self._inSquare(square, x, y) for x, y in points)
+			]
+			for key in outdated:
+				del self.items[key]
+			self.invalidations += len(outdated)
+
+	def clear(self):
+		with self.lock:
+			# Skip results computed before clear
+			self.write_number += 1
+			self.writes.clear()
+			LRUCache.clear(self)
+
+	@property
+	def info(self):
+		info = LRUCache.info.fget(self)
+		info["ttl"] = self.ttl
+		info["expirations"] = self.expirations
+		info["invalidations"] = self.invalidations
+		return info
+
 class DBUserStats(object):
 	"""
 	Get stats from DBUser such as:
 	min, max, average, total with where clause
+	If cache is set, stats are cached by data version and rect bounds
+	If rtree is set, stats of bounded rect are taken by R*Tree
 	"""
+	cache = None
+	rtree = None
 
 	def __init__(self, offsetX = None, offsetY = None, \
 				limitX = None, limitY = None):
+		# Key with version read before the query, so stats which are
+		# read during write are cached for the previous version
+		key = (data_version, offsetX, offsetY, limitX, limitY)
+		if self.cache is not None:
+			self.result = self.cache.get(key)
+			if self.result is not None:
+				return
+
 		query = db.session.query(
 			db.func.min(DBUser.x).label("minX"), \
 			db.func.min(DBUser.y).label("minY"), \
@@ -41,7 +421,12 @@ class DBUserStats(object):
 		if limitY is not None:
 			query = query.filter(DBUser.y <= limitY)
 
-		self.result = query.one()
+		if self.rtree is not None and None not in (offsetX, offsetY, limitX, limitY):
+			self.result = self.rtree.stats(offsetX, offsetY, limitX, limitY)
+		else:
+			self.result = query.one()
+		if self.cache is not None:
+			self.cache.put(key, self.result)
 
 	@property
 	def rect(self):
@@ -55,6 +440,10 @@ class DBUserStats(object):
 			(self.result.maxX, self.result.maxY), \
 		)
 
+	@property
+	def bounds(self):
+		return (self.minX, self.minY, self.maxX, self.maxY)
+
 	@property
 	def minX(self):
 		return self.result.minX
@@ -82,3 +471,23 @@ class DBUserStats(object):
 	@property
 	def count(self):
 		return self.result.count
+
+RectResult = namedtuple("RectResult", "minX minY maxX maxY avgX avgY count")
+
+class RectStats(DBUserStats):
+	"""
+	Stats of rect with users count from in-memory index
+	Rect bounds are geometric, average is rect center
+	"""
+
+	def __init__(self, minX, minY, maxX, maxY, count):
+		self.result = RectResult(minX, minY, maxX, maxY, \
+							(minX + maxX) / 2.0, (minY + maxY) / 2.0, count)
+
+class TrackedStats(DBUserStats):
+	"""
+	Whole table stats from aggregate tracker without DB query
+	"""
+
+	def __init__(self, tracker):
+		self.result = RectResult(*tracker.stats())
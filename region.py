@@ -0,0 +1,128 @@
+"""
+Regions of count queries
+Region classifies rect as inside, outside or boundary,
+so rects inside or outside are counted without users checks
+"""
+from math import sqrt
+
+def getMinMaxRectDist2(x0, y0, rect):
+	"""
+	Returns squared min and max distances from point
+	to (minX, minY, maxX, maxY) rect
+	"""
+	minX, minY, maxX, maxY = rect
+	# Nearest and farthest rect points
+	nearX = min(max(x0, minX), maxX)
+	nearY = min(max(y0, minY), maxY)
+	farX = max(abs(x0 - minX), abs(x0 - maxX))
+	farY = max(abs(y0 - minY), abs(y0 - maxY))
+	return (nearX - x0) ** 2 + (nearY - y0) ** 2, farX ** 2 + farY ** 2
+
+def getMinMaxRectDist(x0, y0, rect):
+	"""
+	Returns min and max distances from point to (minX, minY, maxX, maxY) rect
+	"""
+	min_dist2, max_dist2 = getMinMaxRectDist2(x0, y0, rect)
+	return sqrt(min_dist2), sqrt(max_dist2)
+
+class Region(object):
+	"""
+	Base class of regions
+	bounds is (minX, minY, maxX, maxY) rect around the region
+	"""
+	bounds = None
+
+	def getRectPosition(self, rect):
+		"""
+		Return inside, outside or boundary position of rect to the region
+		"""
+		raise NotImplementedError
+
+	def contains(self, x, y):
+		raise NotImplementedError
+
+	def countPoints(self, points):
+		"""
+		Return count of (x, y) points in the region
+		"""
+		return len([1 for x, y in points if self.contains(x, y)])
+
+class RectRegion(Region):
+	"""
+	Rect with bounds included
+	"""
+
+	def __init__(self, minX, minY, maxX, maxY):
+		self.bounds = (minX, minY, maxX, maxY)
+
+	def getRectPosition(self, rect):
+		minX, minY, maxX, maxY = self.bounds
+		if rect[2] < minX or rect[0] > maxX or rect[3] < minY or rect[1] > maxY:
+			return "outside"
+		if minX <= rect[0] and rect[2] <= maxX and minY <= rect[1] and rect[3] <= maxY:
+			return "inside"
+		return "boundary"
+
+	def contains(self, x, y):
+		minX, minY, maxX, maxY = self.bounds
+		return minX <= x <= maxX and minY <= y <= maxY
+
+	def countPoints(self, points):
+		minX, minY, maxX, maxY = self.bounds
+		return len([1 for x, y in points if minX <= x <= maxX and minY <= y <= maxY])
+
+class AnnulusRegion(Region):
+	"""
+	Points farther than r1 and within r2 from (x0, y0),
+	so count is the same as count within r2 minus count within r1
+	"""
+
+	def __init__(self, x0, y0, r1, r2):
+		self.x0, self.y0, self.r1, self.r2 = x0, y0, r1, r2
+		self.bounds = (x0 - r2, y0 - r2, x0 + r2, y0 + r2)
+
+	def getRectPosition(self, rect):
+		min_dist2, max_dist2 = getMinMaxRectDist2(self.x0, self.y0, rect)
+		if max_dist2 <= self.r1 ** 2 or min_dist2 > self.r2 ** 2:
+			return "outside"
+		if min_dist2 > self.r1 ** 2 and max_dist2 <= self.r2 ** 2:
+			return "inside"
+		return "boundary"
+
+	def contains(self, x, y):
+		dist2 = (x - self.x0) ** 2 + (y - self.y0) ** 2
+		return self.r1 ** 2 < dist2 <= self.r2 ** 2
+
+	def countPoints(self, points):
+		x0, y0, r1_2, r2_2 = self.x0, self.y0, self.r1 ** 2, self.r2 ** 2
+		return len([1 for x, y in points if r1_2 < (x - x0) ** 2 + (y - y0) ** 2 <= r2_2])
+
+class CirclesRegion(Region):
+	"""
+	Union of (x0, y0, r) circles, user in many circles is counted once
+	"""
+
+	def __init__(self, circles):
+		self.circles = list(circles)
+		self.bounds = (
+			min(x0 - r for x0, _, r in self.circles),
+			min(y0 - r for _, y0, r in self.circles),
+			max(x0 + r for x0, _, r in self.circles),
+			max(y0 + r for _, y0, r in self.circles),
+		)
+
+	def getRectPosition(self, rect):
+		position = "outside"
+		for x0, y0, r in self.circles:
+			min_dist2, max_dist2 = getMinMaxRectDist2(x0, y0, rect)
+			if max_dist2 <= r * r:
+				return "inside"
+			if min_dist2 <= r * r:
+				position = "boundary"
+		return position
+
+	def contains(self, x, y):
+		for x0, y0, r in self.circles:
+			if (x - x0) ** 2 + (y - y0) ** 2 <= r * r:
+				return True
+		return False
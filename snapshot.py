@@ -0,0 +1,213 @@
+"""
+Persistent snapshot of users for fast warm start
+Snapshot file is a header and ids, x, y columns of little-endian int32,
+payload is checked by crc32 of the header. Writes made after the snapshot
+are appended to write-ahead log as fixed-size records with own crc32.
+"""
+from array import array
+import mmap
+import os
+import struct
+import sys
+import threading
+import zlib
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+SNAPSHOT_MAGIC = b"NNSNAP\0\0"
+SNAPSHOT_FORMAT = 1
+# magic, format, payload crc32, users count, last WAL record number
+SNAPSHOT_HEADER = struct.Struct("<8sIIQQ")
+# record number, operation, user id, x, y
+WAL_RECORD = struct.Struct("<Qciii")
+WAL_CRC = struct.Struct("<I")
+WAL_INSERT = b"I"
+WAL_UPDATE = b"U"
+WAL_DELETE = b"D"
+
+def _crc32(data, crc = 0):
+	return zlib.crc32(data, crc) & 0xffffffff
+
+def _column(buf, offset, count):
+	"""
+	Return list of count int32 from buf at offset
+	"""
+	if numpy is not None:
+		return numpy.frombuffer(buf, dtype = "<i4", count = count, offset = offset).tolist()
+	data = buf[offset:offset + 4 * count]
+	column = array("i")
+	if hasattr(column, "frombytes"):
+		column.frombytes(data)
+	else:
+		column.fromstring(data)
+	if sys.byteorder == "big":
+		column.byteswap()
+	return column.tolist()
+
+class SnapshotStore(object):
+	"""
+	Snapshot file with write-ahead log of CRUD writes made after it
+	Log is compacted into new snapshot every compact_records writes
+	"""
+
+	def __init__(self, snapshot_path, wal_path, compact_records):
+		self.snapshot_path = snapshot_path
+		self.wal_path = wal_path
+		self.compact_records = compact_records
+		self.lock = threading.Lock()
+		self.wal = None
+		self.record_number = 0
+		self.pending = 0
+
+	def _readSnapshot(self):
+		"""
+		Return (last record number, ids, xs, ys) from mapped snapshot
+		or None if it is missed or broken
+		"""
+		if not os.path.exists(self.snapshot_path):
+			return None
+		with open(self.snapshot_path, "rb") as f:
+			if os.fstat(f.fileno()).st_size < SNAPSHOT_HEADER.size:
+				return None
+			buf = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+		try:
+			magic, version, crc, count, record_number = \
+				SNAPSHOT_HEADER.unpack(buf[:SNAPSHOT_HEADER.size])
+			if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_FORMAT \
+					or len(buf) != SNAPSHOT_HEADER.size + 12 * count:
+				return None
+			if _crc32(buf[SNAPSHOT_HEADER.size:]) != crc:
+				return None
+			offset = SNAPSHOT_HEADER.size
+			ids, xs, ys = [_column(buf, offset + 4 * count * i, count) for i in range(3)]
+		finally:
+			buf.close()
+		return record_number, ids, xs, ys
+
+	def _readWAL(self, record_number, changes):
+		"""
+		Put log records after record_number to changes dict
+		as user id to (x, y) or None for deleted user
+		Reading stops at torn or broken record, log is truncated there
+		Return last applied record number
+		"""
+		if not os.path.exists(self.wal_path):
+			return record_number
+		size = WAL_RECORD.size + WAL_CRC.size
+		with open(self.wal_path, "r+b") as f:
+			valid_size = 0
+			while True:
+				data = f.read(size)
+				if len(data) < size:
+					break
+				record, (crc,) = data[:WAL_RECORD.size], WAL_CRC.unpack(data[WAL_RECORD.size:])
+				if _crc32(record) != crc:
+					break
+				valid_size += size
+				number, operation, user_id, x, y = WAL_RECORD.unpack(record)
+				if number <= record_number:
+					continue
+				# Last record of user wins
+				changes[user_id] = None if operation == WAL_DELETE else (x, y)
+				record_number = number
+			f.truncate(valid_size)
+		return record_number
+
+	def load(self):
+		"""
+		Return list of (id, x, y) users from snapshot and log
+		or None if there is no valid snapshot
+		"""
+		with self.lock:
+			snapshot = self._readSnapshot()
+			if snapshot is None:
+				return None
+			record_number, ids, xs, ys = snapshot
+			changes = dict()
+			self.record_number = self._readWAL(record_number, changes)
+			self.pending = self.record_number - record_number
+			self._openWAL("ab")
+		users = list(zip(ids, xs, ys))
+		if changes:
+			users = [user for user in users if user[0] not in changes]
+			users.extend((user_id,) + coord for user_id, coord in changes.items() \
+				if coord is not None)
+		return users
+
+	def _openWAL(self, mode):
+		if self.wal is not None:
+			self.wal.close()
+		self.wal = open(self.wal_path, mode)
+
+	def save(self, users, record_number = None):
+		"""
+		Write snapshot of (id, x, y) users and start new log
+		record_number is number of the last write in users,
+		log records go on after it
+		Snapshot is written to temporary file and renamed over old one
+		"""
+		users = list(users)
+		with self.lock:
+			if record_number is not None:
+				self.record_number = record_number
+			self._save(users)
+
+	def _columns(self, users):
+		"""
+		Return ids, xs, ys columns of users as little-endian int32 bytes
+		"""
+		if numpy is not None:
+			rows = numpy.array(users, dtype = "<i4").reshape(-1, 3)
+			return [rows[:, i].tobytes() for i in range(3)]
+		columns = [array("i", column) for column in (list(zip(*users)) or [(), (), ()])]
+		if sys.byteorder == "big":
+			for column in columns:
+				column.byteswap()
+		return [
+			column.tobytes() if hasattr(column, "tobytes") else column.tostring() \
+			for column in columns
+		]
+
+	def _save(self, users):
+		payload = self._columns(users)
+		crc = 0
+		for data in payload:
+			crc = _crc32(data, crc)
+		header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, crc, \
+			len(users), self.record_number)
+		path = self.snapshot_path + ".tmp"
+		with open(path, "wb") as f:
+			f.write(header)
+			for data in payload:
+				f.write(data)
+			f.flush()
+			os.fsync(f.fileno())
+		os.rename(path, self.snapshot_path)
+		self._openWAL("wb")
+		self.pending = 0
+
+	def log(self, records, users = None):
+		"""
+		Append (operation, id, x, y) records to log
+		users() returns current (id, x, y) users to compact log into snapshot
+		"""
+		with self.lock:
+			if self.wal is None:
+				self._openWAL("ab")
+			for operation, user_id, x, y in records:
+				self.record_number += 1
+				record = WAL_RECORD.pack(self.record_number, operation, user_id, x, y)
+				self.wal.write(record + WAL_CRC.pack(_crc32(record)))
+			self.wal.flush()
+			self.pending += len(records)
+			if users is not None and self.pending >= self.compact_records:
+				self._save(list(users()))
+
+	def close(self):
+		with self.lock:
+			if self.wal is not None:
+				self.wal.close()
+				self.wal = None
@@ -1,16 +1,30 @@
 import unittest
 import random
+import json
+import os
+import shutil
+import tempfile
+import threading
 from math import sqrt
 
-from main import app
+import main
+from main import app, indexes, reloadIndexes, Knn, knn_engines, countInRegion
 from flask_api import status
 
 from consts import *
 from models import *
+from index import *
+from metrics import *
+from snapshot import *
+from region import *
+from groupcommit import *
 
 db.app = app
 db.init_app(app)
 db.create_all()
+# Session opened by main import is bound to engine replaced by init_app
+db.session.remove()
+initWriteCount()
 
 # generate random data
 coord = [(x, y) for x in xrange(1, 1000) for y in xrange(1, 1000)]
@@ -53,6 +67,7 @@ class TestDB(unittest.TestCase):
 			user = DBUser(x, y)
 			db.session.add(user)
 		db.session.commit()
+		bumpDataVersion()
 
 		# Get stats from DB and validate them
 		stats = DBUserStats()
@@ -76,6 +91,74 @@ class TestDB(unittest.TestCase):
 		stats = DBUserStats(offsetX, offsetY, limitX, limitY)
 		self._assertValidStats(stats, testdata)
 
+	def testDBUserStatsCache(self):
+		"""
+		Check repeated stats are taken from cache
+		and write by API makes them outdated
+		"""
+		client = app.test_client()
+		client.post("%s/users" % BASEURL, data = '{"x": %s, "y": %s}' % coord.pop())
+		hits = DBUserStats.cache.hits
+		count = DBUserStats(0, 0, 1000, 1000).count
+		self.assertEquals(DBUserStats(0, 0, 1000, 1000).count, count)
+		self.assertEquals(DBUserStats.cache.hits, hits + 1)
+
+		client.post("%s/users" % BASEURL, data = '{"x": %s, "y": %s}' % coord.pop())
+		self.assertEquals(DBUserStats(0, 0, 1000, 1000).count, count + 1)
+		self.assertEquals(DBUserStats.cache.hits, hits + 1)
+
+	def testUpgradeDB(self):
+		"""
+		Drop DBUser indexes and add duplicated users
+		Check upgrade removes and counts duplicates and restores indexes
+		"""
+		DBUser.query.delete()
+		db.session.commit()
+		for index in DBUser.__table__.indexes:
+			index.drop(db.session.get_bind())
+		x, y = coord.pop()
+		for i in range(3):
+			db.session.add(DBUser(x, y))
+		db.session.add(DBUser(*coord.pop()))
+		db.session.commit()
+
+		self.assertEquals(upgradeDB(), 2)
+		self.assertEquals(DBUser.query.count(), 2)
+		self.assertEquals(DBUser.query.filter_by(x = x, y = y).one().id, 1)
+		db_indexes = db.inspect(db.session.get_bind()).get_indexes(DBUser.__table__.name)
+		self.assertEquals(len(db_indexes), len(DBUser.__table__.indexes))
+
+	def testRTreeIndex(self):
+		"""
+		Check R*Tree mirror follows DB writes and its circle count
+		and rect stats are exact for coordinates rounded in float32
+		"""
+		DBUser.query.delete()
+		base = 2 ** 25
+		users = [DBUser(base + x, base + y) for x, y in random.sample(coord, SQL_TESTDATA_COUNT)]
+		users += [DBUser(*coord.pop()) for i in range(SQL_TESTDATA_COUNT)]
+		db.session.add_all(users)
+		db.session.commit()
+		users[0].x += 1
+		db.session.delete(users[1])
+		db.session.commit()
+		points = [(user.x, user.y) for user in DBUser.query]
+
+		rtree = RTreeIndex()
+		self.assertEquals(rtree.count, len(points))
+		for x0, y0 in points[::20]:
+			for r in (1, 10, 100):
+				count = len([
+					(x, y) for x, y in points \
+					if (x - x0) ** 2 + (y - y0) ** 2 <= r * r
+				])
+				self.assertEquals(rtree.countInCircle(x0, y0, r), count)
+				testdata = [
+					(x, y) for x, y in points \
+					if x0 - r <= x <= x0 + r and y0 - r <= y <= y0 + r
+				]
+				self._assertValidStats(rtree.stats(x0 - r, y0 - r, x0 + r, y0 + r), testdata)
+
 class TestUserList(unittest.TestCase):
 	"""
 	Unittests for UserList
@@ -83,6 +166,7 @@ class TestUserList(unittest.TestCase):
 	def setUp(self):
 		self.client = app.test_client()
 		self.url = "%s/users" % BASEURL
+		reloadIndexes()
 
 	def testAddUser(self):
 		"""
@@ -94,7 +178,7 @@ class TestUserList(unittest.TestCase):
 
 	def testAddInvalidUser(self):
 		"""
-		Try to add new user without x or y
+		Try to add new user without x or y or out of coordinates range
 		Check return code is 400
 		"""
 		c = coord.pop()
@@ -102,6 +186,9 @@ class TestUserList(unittest.TestCase):
 		self.assertEquals(res.status_code, status.HTTP_400_BAD_REQUEST)
 		res = self.client.post(self.url, data = '{"y": %s}' % c[1])
 		self.assertEquals(res.status_code, status.HTTP_400_BAD_REQUEST)
+		res = self.client.post(self.url, data = '{"x": %s, "y": %s}' % (c[0], MAX_COORD + 1))
+		self.assertEquals(res.status_code, status.HTTP_400_BAD_REQUEST)
+		self.assertEquals(DBUser.query.filter_by(x = c[0]).count(), 0)
 
 	def testAddiExistedUser(self):
 		"""
@@ -156,6 +243,128 @@ class TestUserList(unittest.TestCase):
 		res = self.client.get(self.url + url_params)
 		self.assertEquals(res.status_code, status.HTTP_404_NOT_FOUND)
 
+	def testUserListCursor(self):
+		"""
+		Remove all data, generate 10 records.
+		Walk over pages with pagesize=3 by next cursor
+		Check all users are listed once and last page has no next cursor
+		Check invalid cursor returns 400
+		"""
+		DBUser.query.delete()
+		for i in range(10):
+			self.client.post(self.url, data = '{"x": %s, "y": %s}' % coord.pop())
+
+		user_ids = list()
+		url_params = "?pagesize=3"
+		while True:
+			res = self.client.get(self.url + url_params)
+			self.assertEquals(res.status_code, status.HTTP_200_OK)
+			data = json.loads(res.get_data())
+			user_ids.extend(sorted(int(user_id) for user_id in data["users"]))
+			if data["next"] is None:
+				break
+			url_params = "?pagesize=3&after=%s" % data["next"]
+		self.assertEquals(user_ids, [user.id for user in DBUser.query.order_by(DBUser.id)])
+
+		res = self.client.get(self.url + "?after=invalid")
+		self.assertEquals(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+class TestUserBulk(unittest.TestCase):
+	"""
+	Unittests for UserBulk
+	"""
+	def setUp(self):
+		self.client = app.test_client()
+		self.url = "%s/users/bulk" % BASEURL
+		DBUser.query.delete()
+		db.session.commit()
+		reloadIndexes()
+
+	def _post(self, params, data, content_type = None):
+		res = self.client.post("%s?%s" % (self.url, params), data = data, \
+							content_type = content_type)
+		return res.status_code, json.loads(res.get_data())
+
+	def testAddNDJSON(self):
+		"""
+		Add users with duplicates by batches of 3
+		Check created and conflicts counts per batch
+		"""
+		users = [coord.pop() for i in range(5)]
+		users.insert(2, users[0])
+		lines = ['{"x": %s, "y": %s}' % user for user in users]
+		code, data = self._post("batchsize=3", "\n".join(lines))
+		self.assertEquals(code, status.HTTP_200_OK)
+		self.assertEquals(data["created"], 5)
+		self.assertEquals(data["conflicts"], 1)
+		self.assertEquals(data["batches"], [
+			{"created": 2, "conflicts": 1},
+			{"created": 3, "conflicts": 0}
+		])
+		self.assertEquals(DBUser.query.count(), 5)
+		self.assertEquals(indexes.get("grid").count, 5)
+
+	def testAddCSV(self):
+		"""
+		Add users in CSV with header, format by Content-Type
+		"""
+		lines = ["x,y"] + ["%s,%s" % coord.pop() for i in range(10)]
+		code, data = self._post("", "\n".join(lines), "text/csv")
+		self.assertEquals(code, status.HTTP_200_OK)
+		self.assertEquals(data["created"], 10)
+		self.assertEquals(DBUser.query.count(), 10)
+
+	def testAddInvalidUser(self):
+		"""
+		Check invalid line or line out of coordinates range returns 400
+		and previous batches are kept, invalid batchsize returns 400
+		"""
+		lines = ["%s,%s" % coord.pop() for i in range(4)] + ["1"]
+		code, data = self._post("format=csv&batchsize=2", "\n".join(lines))
+		self.assertEquals(code, status.HTTP_400_BAD_REQUEST)
+		self.assertEquals(data["created"], 4)
+		lines = ['{"x": %s, "y": %s}' % (MIN_COORD - 1, 1)]
+		code, data = self._post("", "\n".join(lines))
+		self.assertEquals(code, status.HTTP_400_BAD_REQUEST)
+		self.assertEquals(data["created"], 0)
+		code, data = self._post("format=xml", "")
+		self.assertEquals(code, status.HTTP_400_BAD_REQUEST)
+		for batchsize in ("abc", "0"):
+			code, data = self._post("batchsize=%s" % batchsize, "")
+			self.assertEquals(code, status.HTTP_400_BAD_REQUEST)
+
+class TestUserExport(unittest.TestCase):
+	"""
+	Unittests for UserExport
+	"""
+	def setUp(self):
+		self.client = app.test_client()
+		self.url = "%s/users/export" % BASEURL
+
+	def _export(self, params = ""):
+		res = self.client.get("%s?%s" % (self.url, params))
+		self.assertEquals(res.status_code, status.HTTP_200_OK)
+		return [json.loads(line) for line in res.get_data().splitlines()]
+
+	def testExport(self):
+		"""
+		Export 10 users by chunks of EXPORT_CHUNK_SIZE
+		Compare them with DB and check user_url can be omitted
+		"""
+		DBUser.query.delete()
+		for i in range(10):
+			db.session.add(DBUser(*coord.pop()))
+		db.session.commit()
+
+		users = self._export()
+		self.assertEquals(
+			[(user["id"], user["x"], user["y"]) for user in users],
+			[(user.id, user.x, user.y) for user in DBUser.query.order_by(DBUser.id)])
+		self.assertTrue(users[0]["user_url"].endswith("/users/%s" % users[0]["id"]))
+		users = self._export("user_url=N")
+		self.assertEquals(len(users), 10)
+		self.assertNotIn("user_url", users[0])
+
 class TestUser(unittest.TestCase):
 	"""
 	Unittests for User: get, update, delete
@@ -164,6 +373,7 @@ class TestUser(unittest.TestCase):
 	def setUp(self):
 		self.client = app.test_client()
 		self.url = "%s/users" % BASEURL
+		reloadIndexes()
 
 	def _get_user_url(self, user_id):
 		return "%s/%s" % (self.url, user_id)
@@ -176,6 +386,7 @@ class TestUser(unittest.TestCase):
 		db.session.add(user)
 		db.session.flush()
 		db.session.commit()
+		reloadIndexes()
 		return user
 
 	def testGetUser(self):
@@ -207,10 +418,51 @@ class TestUser(unittest.TestCase):
 		self.assertEquals(res.status_code, status.HTTP_200_OK)
 		res = self.client.post(url, data = '{}')
 		self.assertEquals(res.status_code, status.HTTP_400_BAD_REQUEST)
+		res = self.client.post(url, data = '{"x": %s}' % (MAX_COORD + 1))
+		self.assertEquals(res.status_code, status.HTTP_400_BAD_REQUEST)
 
 		user = DBUser.query.filter_by(id = user_id).one()
 		self.assertNotEqual((old_x, old_y), (user.x, user.y))
 
+	def testUpdateUserToZero(self):
+		"""
+		Move user to zero coordinates one by one
+		Check zero is stored and the other coordinate is kept
+		"""
+		user = self._create_db_user()
+		user_id, old_y = user.id, user.y
+		url = self._get_user_url(user_id)
+		DBUser.query.filter_by(x = 0, y = old_y).delete()
+		DBUser.query.filter_by(x = 0, y = 0).delete()
+		db.session.commit()
+		reloadIndexes()
+
+		res = self.client.post(url, data = '{"x": 0}')
+		self.assertEquals(res.status_code, status.HTTP_200_OK)
+		user = DBUser.query.filter_by(id = user_id).one()
+		self.assertEqual((user.x, user.y), (0, old_y))
+
+		res = self.client.post(url, data = '{"y": 0}')
+		self.assertEquals(res.status_code, status.HTTP_200_OK)
+		db.session.expire_all()
+		user = DBUser.query.filter_by(id = user_id).one()
+		self.assertEqual((user.x, user.y), (0, 0))
+
+	def testUpdateExistedUser(self):
+		"""
+		Try to move user into coordinates of other user
+		Check return code is 409 and user is not changed
+		"""
+		user1 = self._create_db_user()
+		user2 = self._create_db_user()
+		user_id, old_x, old_y = user2.id, user2.x, user2.y
+		url = self._get_user_url(user_id)
+		res = self.client.post(url, data = '{"x": %s, "y": %s}' % (user1.x, user1.y))
+		self.assertEquals(res.status_code, status.HTTP_409_CONFLICT)
+
+		user = DBUser.query.filter_by(id = user_id).one()
+		self.assertEqual((old_x, old_y), (user.x, user.y))
+
 	def testDeleteUser(self):
 		"""
 		Add new user in DB and delete it with API
@@ -225,6 +477,95 @@ class TestUser(unittest.TestCase):
 		user = DBUser.query.filter_by(id = user_id).first()
 		self.assertIsNone(user)
 
+	def testWriteCount(self):
+		"""
+		Create, update and delete user and try to create it twice
+		Check DB write count is bumped by committed writes only
+		"""
+		write_count = getWriteCount()
+		data = '{"x": %s, "y": %s}' % coord.pop()
+		res = self.client.post(self.url, data = data)
+		user_url = json.loads(res.data)["user_url"]
+		res = self.client.post(self.url, data = data)
+		self.assertEquals(res.status_code, status.HTTP_409_CONFLICT)
+		self.client.post(user_url, data = '{"x": %s}' % coord.pop()[0])
+		self.client.delete(user_url)
+		self.assertEquals(getWriteCount(), write_count + 3)
+
+	def _requestAll(self, requests):
+		"""
+		Send (method, url, data) requests by threads at once
+		Return sorted status codes
+		"""
+		codes = list()
+		def send(method, url, data):
+			codes.append(getattr(app.test_client(), method)(url, data = data).status_code)
+		threads = [threading.Thread(target = send, args = request) for request in requests]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		return sorted(codes)
+
+	def _startCommitter(self):
+		"""
+		Commit single user writes by own group committer until test end
+		"""
+		committer = GroupCommitter(0.001, 100, app.logger)
+		committer.start()
+		main.committer = committer
+		self.addCleanup(self._stopCommitter, committer)
+		return committer
+
+	def _stopCommitter(self, committer):
+		main.committer = None
+		committer.stop()
+
+	def testConcurrentWrites(self):
+		"""
+		Send the same create, update and delete requests at once
+		by group committer
+		Check only one of them succeeds and others get own 409 or 404
+		"""
+		committer = self._startCommitter()
+		writes = committer.info["writes"]
+		x, y = coord.pop()
+		data = '{"x": %s, "y": %s}' % (x, y)
+		codes = self._requestAll([("post", self.url, data)] * 8)
+		self.assertEquals(codes, [status.HTTP_201_CREATED] + [status.HTTP_409_CONFLICT] * 7)
+
+		users = [self._create_db_user() for i in range(8)]
+		x, y = coord.pop()
+		data = '{"x": %s, "y": %s}' % (x, y)
+		codes = self._requestAll([("post", self._get_user_url(user.id), data) for user in users])
+		self.assertEquals(codes, [status.HTTP_200_OK] + [status.HTTP_409_CONFLICT] * 7)
+		self.assertEquals(DBUser.query.filter_by(x = x, y = y).count(), 1)
+
+		url = self._get_user_url(users[0].id)
+		codes = self._requestAll([("delete", url, None)] * 8)
+		self.assertEquals(codes, [status.HTTP_200_OK] + [status.HTTP_404_NOT_FOUND] * 7)
+		self.assertEquals(committer.info["writes"], writes + 24)
+		self.assertEquals(indexes.get("grid").count, DBUser.query.count())
+
+	def testCommittedSyncError(self):
+		"""
+		Fail in-memory sync of created user in group committer
+		Check request still gets 201 and sync error is counted
+		"""
+		committer = self._startCommitter()
+		def failSync(write):
+			raise RuntimeError("Sync failed")
+		sync = main.CreateUser.sync
+		main.CreateUser.sync = failSync
+		try:
+			x, y = coord.pop()
+			res = self.client.post(self.url, data = '{"x": %s, "y": %s}' % (x, y))
+		finally:
+			main.CreateUser.sync = sync
+		self.assertEquals(res.status_code, status.HTTP_201_CREATED)
+		self.assertEquals(committer.info["sync_errors"], 1)
+		self.assertEquals(DBUser.query.filter_by(x = x, y = y).count(), 1)
+
 class TestInfo(unittest.TestCase):
 	"""
 	Unittests for Info
@@ -241,6 +582,94 @@ class TestInfo(unittest.TestCase):
 		res = self.client.get(self.url)
 		self.assertEquals(res.status_code, status.HTTP_200_OK)
 
+	def testAggregates(self):
+		"""
+		Check Info stats follow user create, update and delete
+		"""
+		DBUser.query.delete()
+		db.session.commit()
+		reloadIndexes()
+		users_url = "%s/users" % BASEURL
+		for x, y in ((10, 20), (30, 40), (50, 0)):
+			res = self.client.post(users_url, data = '{"x": %s, "y": %s}' % (x, y))
+		self.client.post(json.loads(res.get_data())["user_url"], data = '{"x": 50, "y": 60}')
+		self.client.delete("%s/1" % users_url)
+
+		info = json.loads(self.client.get(self.url).get_data())
+		self.assertEquals(info["user_count"], DBUser.query.count())
+		self.assertEquals(info["min"], {"x": 30, "y": 40})
+		self.assertEquals(info["max"], {"x": 50, "y": 60})
+		self.assertEquals(info["avg"], {"x": 40, "y": 50})
+		self.assertEquals(info["density"], 2.0 / 21 / 21)
+		self.assertEquals(info["histogram"]["cells"], 1)
+
+class TestMetrics(unittest.TestCase):
+	"""
+	Unittests for request metrics
+	"""
+	def setUp(self):
+		self.client = app.test_client()
+		DBUser.query.delete()
+		for i in range(SQL_TESTDATA_COUNT):
+			db.session.add(DBUser(*coord.pop()))
+		db.session.commit()
+		reloadIndexes()
+		metrics.clear()
+
+	def testDebug(self):
+		"""
+		Check metrics of split algorythm are attached to response by debug flag
+		"""
+		url = "%s/users/knn?U=%s&engine=split" % (BASEURL, DBUser.query.first().id)
+		self.assertNotIn("debug", json.loads(self.client.get(url + "&R=200").get_data()))
+		res = self.client.get(url + "&R=300&debug=Y")
+		debug = json.loads(res.get_data())["debug"]
+		self.assertGreater(debug["sql_statements"], 0)
+		self.assertGreater(debug["knn_depth"], 0)
+		self.assertGreater(sum(debug["rects"].values()), 0)
+		self.assertGreaterEqual(debug["rows_checked"], 0)
+
+	def testExport(self):
+		"""
+		Check metrics are summed by resource in Prometheus format
+		"""
+		url = "%s/users/knn?U=%s&engine=dist" % (BASEURL, DBUser.query.first().id)
+		for radius in (10, 20):
+			self.client.get("%s&R=%s" % (url, radius))
+		res = self.client.get("%s/metrics" % BASEURL)
+		self.assertEquals(res.status_code, status.HTTP_200_OK)
+		text = res.get_data().decode()
+		self.assertIn('nn_requests_total{resource="knn"} 2', text)
+		self.assertIn('nn_request_duration_seconds_count{resource="knn"} 2', text)
+		self.assertIn('nn_knn_rows_checked_total{resource="knn"} %s' % (2 * SQL_TESTDATA_COUNT), text)
+
+	def testAttachedThreads(self):
+		"""
+		Count rects and rows by threads attached to one request
+		Check no update is lost
+		"""
+		registry = MetricsRegistry()
+		registry.start()
+		request_metrics = registry.current
+
+		def count():
+			registry.attach(request_metrics)
+			for i in range(10000):
+				registry.rect("split", i % 10)
+				registry.rows(1)
+			registry.attach(None)
+
+		threads = [threading.Thread(target = count) for i in range(4)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		registry.finish("knn")
+		self.assertEquals(request_metrics.rects["split"], 40000)
+		self.assertEquals(request_metrics.rows_checked, 40000)
+		self.assertEquals(request_metrics.knn_depth, 9)
+		self.assertIn('nn_knn_rows_checked_total{resource="knn"} 40000', registry.export())
+
 class TestKnn(unittest.TestCase):
 	"""
 	Unittests for Knn
@@ -250,6 +679,7 @@ class TestKnn(unittest.TestCase):
 		self.user_id = 1
 		self.client = app.test_client()
 		self.url = "%s/users/knn" % BASEURL
+		reloadIndexes()
 
 	def testGetKnn(self):
 		"""
@@ -266,14 +696,870 @@ class TestKnn(unittest.TestCase):
 		for i in range(SQL_TESTDATA_COUNT):
 			db.session.add(DBUser(*coord.pop()))
 		db.session.commit()
+		reloadIndexes()
 		res = self.client.get("%s?%s&%s" % (self.url, Rarg, Uarg))
 		self.assertEquals(res.status_code, status.HTTP_200_OK)
 		res = self.client.get("%s?%s&%s&dist=Y" % (self.url, Rarg, Uarg))
 		self.assertEquals(res.status_code, status.HTTP_200_OK)
 
+	def _getResult(self, params):
+		res = self.client.get("%s?%s" % (self.url, params))
+		self.assertEquals(res.status_code, status.HTTP_200_OK)
+		return json.loads(res.get_data())["result"]
+
+	def testGridKnn(self):
+		"""
+		Compare grid index result with all distances calculation
+		Check grid index is updated by user create, update and delete
+		"""
+		DBUser.query.delete()
+		for i in range(SQL_TESTDATA_COUNT):
+			db.session.add(DBUser(*coord.pop()))
+		db.session.commit()
+		reloadIndexes()
+
+		users_url = "%s/users" % BASEURL
+		res = self.client.post(users_url, data = '{"x": %s, "y": %s}' % coord.pop())
+		user_url = json.loads(res.get_data())["user_url"]
+		self.client.post(user_url, data = '{"x": %s, "y": %s}' % coord.pop())
+		self.client.delete("%s/%s" % (users_url, self.user_id))
+		self.assertEquals(indexes.get("grid").count, DBUser.query.count())
+
+		for user in DBUser.query.limit(5):
+			for radius in (10, 100, 500):
+				params = "R=%s&U=%s" % (radius, user.id)
+				self.assertEquals(self._getResult(params), \
+								self._getResult(params + "&dist=Y"))
+
+	def testNearestKnn(self):
+		"""
+		Check K nearest users are sorted by distance
+		and their amount is limited by K and users count within R
+		"""
+		DBUser.query.delete()
+		for i in range(SQL_TESTDATA_COUNT):
+			db.session.add(DBUser(*coord.pop()))
+		db.session.commit()
+		reloadIndexes()
+
+		params = "R=%s&U=%s" % (self.radius * 10, self.user_id)
+		res = self.client.get("%s?%s&K=0" % (self.url, params))
+		self.assertEquals(res.status_code, status.HTTP_400_BAD_REQUEST)
+		count = self._getResult(params)
+		for k in (1, count, count + 1):
+			res = self.client.get("%s?%s&K=%s" % (self.url, params, k))
+			self.assertEquals(res.status_code, status.HTTP_200_OK)
+			neighbors = json.loads(res.get_data())["neighbors"]
+			self.assertEquals(len(neighbors), min(k, count))
+			dists = [neighbor["dist"] for neighbor in neighbors]
+			self.assertEquals(dists, sorted(dists))
+			self.assertTrue(all(dist <= self.radius * 10 for dist in dists))
+
+	def testKnnEngines(self):
+		"""
+		Compare every engine and auto planner with all distances calculation
+		Check unknown engine is bad request
+		"""
+		DBUser.query.delete()
+		for i in range(SQL_TESTDATA_COUNT):
+			db.session.add(DBUser(*coord.pop()))
+		db.session.commit()
+		reloadIndexes()
+
+		res = self.client.get("%s?R=10&U=1&engine=unknown" % self.url)
+		self.assertEquals(res.status_code, status.HTTP_400_BAD_REQUEST)
+		knn = Knn()
+		knn.x0, knn.y0, knn.r = 500, 500, self.radius
+		self.assertEquals(set(knn.getCosts()), set(knn_engines))
+		self.assertIn(knn.planEngine(), knn_engines)
+
+		for user in DBUser.query.limit(3):
+			for radius in (10, 100, 500):
+				params = "R=%s&U=%s" % (radius, user.id)
+				expected = self._getResult(params + "&dist=Y")
+				for engine_name in list(knn_engines) + ["auto"]:
+					self.assertEquals(self._getResult(params + "&engine=" + engine_name), expected)
+
+	def testParallelKnn(self):
+		"""
+		Compare main algorythm by worker pool and in request thread
+		with all distances calculation
+		"""
+		DBUser.query.delete()
+		for i in range(SQL_TESTDATA_COUNT * 10):
+			db.session.add(DBUser(*coord.pop()))
+		db.session.commit()
+		reloadIndexes()
+
+		inline_rects = app.config["KNN_INLINE_RECTS"]
+		knn = Knn()
+		knn.x0, knn.y0 = 500, 500
+		try:
+			for radius in (50, 200, 500):
+				knn.r = radius
+				expected = knn.getDistkNN()
+				app.config["KNN_INLINE_RECTS"] = 1
+				self.assertEquals(knn.getkNN(knn.getInitStats()), expected)
+				app.config["KNN_INLINE_RECTS"] = SQL_TESTDATA_COUNT * 10
+				self.assertEquals(knn.getkNN(knn.getInitStats()), expected)
+		finally:
+			app.config["KNN_INLINE_RECTS"] = inline_rects
+
+	def testKnnCache(self):
+		"""
+		Check repeated request is served from cache
+		until user inside R square is written
+		"""
+		DBUser.query.delete()
+		db.session.commit()
+		reloadIndexes()
+		users_url = "%s/users" % BASEURL
+		res = self.client.post(users_url, data = '{"x": 2000, "y": 2000}')
+		user_url = json.loads(res.get_data())["user_url"]
+		params = "R=10&U=%s" % user_url.split("/")[-1]
+
+		def get():
+			res = self.client.get("%s?%s" % (self.url, params))
+			data = json.loads(res.get_data())
+			return data["result"], data["cache"]
+
+		self.assertEquals(get(), (0, "miss"))
+		self.assertEquals(get(), (0, "hit"))
+		self.client.post(users_url, data = '{"x": 3000, "y": 3000}')
+		self.assertEquals(get(), (0, "hit"))
+		self.client.post(users_url, data = '{"x": 2005, "y": 2000}')
+		self.assertEquals(get(), (1, "miss"))
+		self.client.post(user_url, data = '{"x": 3005, "y": 3000}')
+		self.assertEquals(get(), (1, "miss"))
+
+	def testApproxKnn(self):
+		"""
+		Compare approximate count and its error bound with exact one
+		Check invalid eps and approximate K nearest are bad requests
+		"""
+		DBUser.query.delete()
+		for i in range(SQL_TESTDATA_COUNT * 10):
+			db.session.add(DBUser(*coord.pop()))
+		db.session.commit()
+		reloadIndexes()
+
+		for user in DBUser.query.limit(3):
+			for radius in (100, 500):
+				params = "R=%s&U=%s" % (radius, user.id)
+				expected = self._getResult(params)
+				res = self.client.get("%s?%s&mode=approx&eps=0.1" % (self.url, params))
+				data = json.loads(res.get_data())
+				self.assertTrue(abs(data["result"] - expected) <= data["error"])
+				self.assertTrue(data["error"] <= 0.1 * (data["result"] + 1) + 1)
+				self.assertEquals(data["mode"], "approx" if data["error"] else "exact")
+		for params in ("mode=approx&eps=0", "mode=approx&eps=1", "mode=approx&K=3", "mode=fast"):
+			res = self.client.get("%s?R=10&U=%s&%s" % (self.url, user.id, params))
+			self.assertEquals(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+class TestKnnBatch(unittest.TestCase):
+	"""
+	Unittests for KnnBatch
+	"""
+	def setUp(self):
+		self.client = app.test_client()
+		self.url = "%s/users/knn" % BASEURL
+		DBUser.query.delete()
+		for i in range(SQL_TESTDATA_COUNT):
+			db.session.add(DBUser(*coord.pop()))
+		db.session.commit()
+		reloadIndexes()
+
+	def _post(self, queries, params = ""):
+		res = self.client.post("%s/batch?%s" % (self.url, params), \
+							data = json.dumps({"queries": queries}))
+		return res.status_code, json.loads(res.get_data())
+
+	def testBatch(self):
+		"""
+		Compare batch results with single kNN requests
+		and with manual calculation for point queries
+		Check user not found does not fail other queries
+		"""
+		users = DBUser.query.limit(3).all()
+		queries = [{"U": user.id, "R": r} for user in users for r in (50, 300)]
+		queries.append({"U": 0, "R": 10})
+		queries.append({"x": 500, "y": 500, "R": 200})
+		count = len([
+			user for user in DBUser.query \
+			if sqrt((user.x - 500) ** 2 + (user.y - 500) ** 2) <= 200
+		])
+
+		for params in ("", "dist=Y"):
+			code, data = self._post(queries, params)
+			self.assertEquals(code, status.HTTP_200_OK)
+			results = [result["result"] for result in data["results"]]
+			for query, result in zip(queries, results):
+				if query.get("U"):
+					res = self.client.get("%s?U=%s&R=%s" % (self.url, query["U"], query["R"]))
+					self.assertEquals(json.loads(res.get_data())["result"], result)
+			self.assertEquals(results[-2:], [None, count])
+
+	def testInvalidBatch(self):
+		"""
+		Check queries without R or center return 400
+		"""
+		for queries in ([{"U": 1}], [{"R": 1}], [{"x": 1, "R": 1}], None):
+			code, data = self._post(queries)
+			self.assertEquals(code, status.HTTP_400_BAD_REQUEST)
+
+class TestRegion(unittest.TestCase):
+	"""
+	Unittests for region count controllers
+	"""
+	def setUp(self):
+		self.client = app.test_client()
+		self.url = "%s/users/region" % BASEURL
+		DBUser.query.delete()
+		for i in range(SQL_TESTDATA_COUNT * 3):
+			db.session.add(DBUser(*coord.pop()))
+		db.session.commit()
+		reloadIndexes()
+		self.users = dict((user.id, (user.x, user.y)) for user in DBUser.query)
+
+	def _count(self, contains):
+		return len([1 for x, y in self.users.values() if contains(x, y)])
+
+	def _getResult(self, res):
+		self.assertEquals(res.status_code, status.HTTP_200_OK)
+		return json.loads(res.get_data())["result"]
+
+	def _assertCount(self, region, expected):
+		"""
+		Check count by grid and by DB rects
+		"""
+		self.assertEquals(countInRegion(region), expected)
+		grid = indexes.indexes.pop("grid")
+		try:
+			self.assertEquals(countInRegion(region), expected)
+		finally:
+			indexes.register("grid", grid)
+
+	def testRect(self):
+		for i in range(5):
+			minX, maxX = sorted(random.sample(range(0, 1000), 2))
+			minY, maxY = sorted(random.sample(range(0, 1000), 2))
+			expected = self._count(lambda x, y: minX <= x <= maxX and minY <= y <= maxY)
+			res = self.client.get("%s/rect?minX=%s&minY=%s&maxX=%s&maxY=%s" \
+				% (self.url, minX, minY, maxX, maxY))
+			self.assertEquals(self._getResult(res), expected)
+			self._assertCount(RectRegion(minX, minY, maxX, maxY), expected)
+		res = self.client.get("%s/rect?minX=10&minY=0&maxX=0&maxY=10" % self.url)
+		self.assertEquals(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+	def testAnnulus(self):
+		"""
+		Annulus count is difference of kNN counts
+		"""
+		for user_id in list(self.users)[:3]:
+			x0, y0 = self.users[user_id]
+			for r1, r2 in ((0, 100), (50, 300), (200, 1500)):
+				expected = self._count(lambda x, y: \
+					r1 ** 2 < (x - x0) ** 2 + (y - y0) ** 2 <= r2 ** 2)
+				res = self.client.get("%s/annulus?U=%s&R1=%s&R2=%s" % (self.url, user_id, r1, r2))
+				self.assertEquals(self._getResult(res), expected)
+				self._assertCount(AnnulusRegion(x0, y0, r1, r2), expected)
+		for params in ("U=%s&R1=10&R2=5" % user_id, "R1=1&R2=5", "U=0&R1=1&R2=5"):
+			res = self.client.get("%s/annulus?%s" % (self.url, params))
+			self.assertNotEquals(res.status_code, status.HTTP_200_OK)
+
+	def testCircles(self):
+		"""
+		User in many circles is counted once
+		"""
+		user_id = list(self.users)[0]
+		x0, y0 = self.users[user_id]
+		circles = [(x0, y0, 100), (x0 + 50, y0, 100), (200, 800, 150)]
+		expected = self._count(lambda x, y: \
+			any((x - cx) ** 2 + (y - cy) ** 2 <= r ** 2 for cx, cy, r in circles))
+		data = {"circles": [{"U": user_id, "R": 100}] + \
+			[{"x": cx, "y": cy, "R": r} for cx, cy, r in circles[1:]]}
+		res = self.client.post("%s/circles" % self.url, data = json.dumps(data))
+		self.assertEquals(self._getResult(res), expected)
+		self._assertCount(CirclesRegion(circles), expected)
+		res = self.client.post("%s/circles" % self.url, data = '{"circles": [{"R": 10}]}')
+		self.assertEquals(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+class SpatialIndexTestCase(unittest.TestCase):
+	"""
+	Common checks for in-memory indexes
+	"""
+
+	def _countInCircle(self, users, x0, y0, r):
+		return len([
+			user_id for user_id, (x, y) in users.items() \
+			if sqrt((x - x0) ** 2 + (y - y0) ** 2) <= r
+		])
+
+	def _nearest(self, users, x0, y0, k, r, exclude = None):
+		"""
+		Return k nearest users sorted by distance and id
+		"""
+		dists = sorted(
+			(sqrt((x - x0) ** 2 + (y - y0) ** 2), user_id) \
+			for user_id, (x, y) in users.items() if user_id != exclude
+		)
+		return [(user_id, dist) for dist, user_id in dists if dist <= r][:k]
+
+	def _assertValidIndex(self, index):
+		"""
+		Compare index count with all distances calculation
+		after rebuild, insert, update and delete
+		"""
+		users = dict(enumerate(random.sample(coord, SQL_TESTDATA_COUNT)))
+		index.rebuild((user_id, x, y) for user_id, (x, y) in users.items())
+		users[-1] = (500, 500)
+		index.insert(-1, 500, 500)
+		users[0] = (1, 1)
+		index.update(0, 1, 1)
+		del users[1]
+		index.delete(1)
+		self.assertEquals(index.count, len(users))
+
+		for x0, y0 in list(users.values())[:10]:
+			for r in (1, 10, 50, 300, 2000):
+				self.assertEquals(index.countInCircle(x0, y0, r), \
+							self._countInCircle(users, x0, y0, r))
+
+class TestAggregateTracker(unittest.TestCase):
+	"""
+	Unittests for AggregateTracker
+	"""
+
+	def testStats(self):
+		"""
+		Compare stats with users list after writes,
+		min and max users are deleted and updated
+		"""
+		users = dict(enumerate(random.sample(coord, SQL_TESTDATA_COUNT)))
+		tracker = AggregateTracker(100)
+		tracker.rebuild((user_id, x, y) for user_id, (x, y) in users.items())
+		for i in range(20):
+			xs = [x for x, _ in users.values()]
+			user_id = [user_id for user_id, (x, _) in users.items() if x == min(xs)][0]
+			if i % 2:
+				del users[user_id]
+				tracker.delete(user_id)
+			else:
+				users[user_id] = (2000 + i, 1000 + i)
+				tracker.update(user_id, 2000 + i, 1000 + i)
+
+		xs, ys = zip(*users.values())
+		self.assertEquals(tracker.stats(), (min(xs), min(ys), max(xs), max(ys), \
+			float(sum(xs)) / len(xs), float(sum(ys)) / len(ys), len(xs)))
+		self.assertEquals(tracker.density((2000, 1000, 2099, 1099)), 10.0 / 100 / 100)
+		self.assertEquals(sum(tracker.cells.values()), len(users))
+		tracker.rebuild(list())
+		self.assertEquals(tracker.stats()[-1], 0)
+
+class TestLRUCache(unittest.TestCase):
+	"""
+	Unittests for LRUCache
+	"""
+
+	def testEviction(self):
+		"""
+		Check the least recently used item is evicted
+		and hits, misses and evictions are counted
+		"""
+		cache = LRUCache(2)
+		cache.put("a", 1)
+		cache.put("b", 2)
+		self.assertEquals(cache.get("a"), 1)
+		cache.put("c", 3)
+		self.assertIsNone(cache.get("b"))
+		self.assertEquals(cache.get("c"), 3)
+		self.assertEquals(cache.info, {
+			"size": 2, "maxsize": 2, "hits": 2, "misses": 1, "evictions": 1
+		})
+
+class TestResultCache(unittest.TestCase):
+	"""
+	Unittests for ResultCache
+	"""
+
+	def testInvalidate(self):
+		"""
+		Check result is removed by write inside its square only
+		and is not put if such write happened after token
+		"""
+		cache = ResultCache(10, 60)
+		token = cache.start()
+		cache.put("a", 1, (0, 0, 10, 10), token)
+		cache.put("b", 2, (20, 20, 30, 30), token)
+		cache.invalidate([(5, 5)])
+		self.assertIsNone(cache.get("a"))
+		self.assertEquals(cache.get("b"), 2)
+		cache.put("a", 1, (0, 0, 10, 10), token)
+		self.assertIsNone(cache.get("a"))
+		cache.put("a", 1, (0, 0, 10, 10), cache.start())
+		self.assertEquals(cache.get("a"), 1)
+		self.assertEquals(cache.info["invalidations"], 1)
+
+	def testExpiration(self):
+		"""
+		Check result is removed after TTL
+		"""
+		cache = ResultCache(10, -1)
+		cache.put("a", 1, (0, 0, 10, 10), cache.start())
+		self.assertIsNone(cache.get("a"))
+		self.assertEquals(cache.info["expirations"], 1)
+
+class TestSnapshotStore(unittest.TestCase):
+	"""
+	Unittests for SnapshotStore
+	"""
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.snapshot_path = os.path.join(self.dir, "users.snapshot")
+		self.wal_path = os.path.join(self.dir, "users.wal")
+
+	def tearDown(self):
+		shutil.rmtree(self.dir)
+
+	def _store(self, compact_records = 100):
+		return SnapshotStore(self.snapshot_path, self.wal_path, compact_records)
+
+	def testLoad(self):
+		"""
+		Check users are loaded from snapshot with log replayed,
+		torn log record is ignored
+		"""
+		store = self._store()
+		self.assertIsNone(store.load())
+		store.save([(1, 10, 10), (2, 20, 20), (3, 30, 30)])
+		store.log([(WAL_INSERT, 4, 40, 40), (WAL_UPDATE, 1, 11, 11), (WAL_DELETE, 2, 20, 20)])
+		store.close()
+		with open(self.wal_path, "ab") as f:
+			f.write(b"torn")
+
+		store = self._store()
+		self.assertEquals(sorted(store.load()), [(1, 11, 11), (3, 30, 30), (4, 40, 40)])
+		store.log([(WAL_INSERT, 5, 50, 50)])
+		store.close()
+		self.assertEquals(sorted(self._store().load())[-1], (5, 50, 50))
+
+	def testRecordNumber(self):
+		"""
+		Check log records go on after record number of saved snapshot
+		and the last record number is restored by load
+		"""
+		store = self._store()
+		store.save([(1, 10, 10)], 5)
+		store.log([(WAL_INSERT, 2, 20, 20)])
+		self.assertEquals(store.record_number, 6)
+		store.close()
+
+		store = self._store()
+		self.assertEquals(sorted(store.load()), [(1, 10, 10), (2, 20, 20)])
+		self.assertEquals(store.record_number, 6)
+		store.close()
+
+	def testCorruptedSnapshot(self):
+		"""
+		Check snapshot with wrong checksum is not loaded
+		"""
+		store = self._store()
+		store.save([(1, 10, 10), (2, 20, 20)])
+		store.close()
+		with open(self.snapshot_path, "r+b") as f:
+			f.seek(-1, os.SEEK_END)
+			f.write(b"\xff")
+		self.assertIsNone(self._store().load())
+
+	def testCompact(self):
+		"""
+		Check log is compacted into snapshot after compact_records writes
+		"""
+		store = self._store(compact_records = 2)
+		users = [(1, 10, 10)]
+		store.save(users)
+		for user_id in (2, 3):
+			users.append((user_id, user_id * 10, user_id * 10))
+			store.log([(WAL_INSERT,) + users[-1]], lambda: users)
+		store.close()
+		self.assertEquals(os.path.getsize(self.wal_path), 0)
+		self.assertEquals(sorted(self._store().load()), users)
+
+class TestWarmStart(unittest.TestCase):
+	"""
+	Unittests for warm start of in-memory indexes from snapshot and log
+	"""
+
+	def setUp(self):
+		self.client = app.test_client()
+		self.dir = tempfile.mkdtemp()
+		self.snapshot_path = os.path.join(self.dir, "users.snapshot")
+		self.wal_path = os.path.join(self.dir, "users.wal")
+		main.store = SnapshotStore(self.snapshot_path, self.wal_path, 1000)
+		reloadIndexes()
+		for i in range(5):
+			self.client.post("%s/users" % BASEURL, data = '{"x": %s, "y": %s}' % coord.pop())
+		self.user_id = DBUser.query.first().id
+		self.client.post("%s/users/%s" % (BASEURL, self.user_id), data = '{"x": %s}' % coord.pop()[0])
+
+	def tearDown(self):
+		main.store.close()
+		main.store = None
+		shutil.rmtree(self.dir)
+		reloadIndexes()
+
+	def _warmStart(self):
+		"""
+		Warm start by new store as after restart
+		Return True if indexes were reloaded from DB
+		"""
+		main.store.close()
+		main.store = SnapshotStore(self.snapshot_path, self.wal_path, 1000)
+		reloads = list()
+		def reload():
+			reloads.append(True)
+			reloadIndexes()
+		main.reloadIndexes = reload
+		try:
+			main.warmStart()
+		finally:
+			main.reloadIndexes = reloadIndexes
+		return bool(reloads)
+
+	def _assertIndexesMatchDB(self):
+		columns = indexes.get("columns")
+		indexed = zip(*[column[:columns.size].tolist() for column in (columns.ids, columns.xs, columns.ys)])
+		users = db.session.query(DBUser.id, DBUser.x, DBUser.y).all()
+		self.assertEquals(sorted(indexed), sorted(users))
+		self.assertEquals(indexes.get("grid").count, len(users))
+
+	def testLoad(self):
+		"""
+		Check indexes loaded from snapshot and log are the same as DB
+		"""
+		self.assertFalse(self._warmStart())
+		self._assertIndexesMatchDB()
+
+	def testWriteMissedInLog(self):
+		"""
+		Commit update without log record as crash before log write
+		Check indexes are reloaded from DB
+		"""
+		DBUser.query.filter_by(id = self.user_id).update({"y": coord.pop()[1]})
+		bumpWriteCount(1)
+		db.session.commit()
+		self.assertTrue(self._warmStart())
+		self._assertIndexesMatchDB()
+
+	def testBrokenLogRecord(self):
+		"""
+		Append record with bad crc and torn record to log
+		Check they are dropped and indexes are the same as DB
+		"""
+		record = WAL_RECORD.pack(main.store.record_number + 1, WAL_UPDATE, self.user_id, 1, 1)
+		with open(self.wal_path, "ab") as f:
+			f.write(record + WAL_CRC.pack(0))
+			f.write(record[:5])
+		self.assertFalse(self._warmStart())
+		self._assertIndexesMatchDB()
+		self.assertEquals(os.path.getsize(self.wal_path) % (WAL_RECORD.size + WAL_CRC.size), 0)
+
+class TestGridIndex(SpatialIndexTestCase):
+	"""
+	Unittests for GridIndex
+	"""
+
+	def testCountInCircle(self):
+		self._assertValidIndex(GridIndex(10))
+
+	def testApproxCountInCircle(self):
+		"""
+		Check true count is within error bound of estimate
+		and small eps checks every boundary cell
+		"""
+		users = dict(enumerate(random.sample(coord, SQL_TESTDATA_COUNT * 10)))
+		index = GridIndex(10)
+		index.rebuild((user_id, x, y) for user_id, (x, y) in users.items())
+		for x0, y0 in list(users.values())[:10]:
+			for r in (10, 100, 500):
+				count = self._countInCircle(users, x0, y0, r)
+				for eps in (0.5, 0.1, 0.01):
+					estimate, error = index.approxCountInCircle(x0, y0, r, eps)
+					self.assertTrue(abs(estimate - count) <= error + 1e-6)
+					self.assertTrue(error <= eps * estimate + 1e-6)
+				self.assertEquals(index.approxCountInCircle(x0, y0, r, 1e-9), (count, 0))
+
+class TestShardedIndex(SpatialIndexTestCase):
+	"""
+	Unittests for ShardedIndex
+	"""
+
+	def setUp(self):
+		self.index = ShardedIndex(3, SQL_TESTDATA_COUNT // 2, 10)
+
+	def tearDown(self):
+		self.index.stop()
+
+	def testCountInCircle(self):
+		self._assertValidIndex(self.index)
+
+	def testRebalance(self):
+		"""
+		Check shard over max users is split, users keep their shards
+		and strips are ordered by x
+		"""
+		index = self.index
+		index.rebuild(list())
+		self.assertEquals(len(index.shards), 1)
+		users = dict(enumerate(random.sample(coord, SQL_TESTDATA_COUNT * 2)))
+		index.insertMany([(user_id, x, y) for user_id, (x, y) in users.items()])
+		self.assertGreater(len(index.shards), 3)
+		self.assertTrue(all(shard.count <= index.max_users for shard in index.shards))
+		self.assertEquals(index.splits, sorted(index.splits))
+		for user_id, (x, y) in users.items():
+			self.assertIs(index.owners[user_id], index.getShard(x))
+		for x0, y0 in list(users.values())[:10]:
+			self.assertEquals(index.countInCircle(x0, y0, 200), \
+						self._countInCircle(users, x0, y0, 200))
+
+	def testShardError(self):
+		"""
+		Make one shard fail in insertMany and countInCircle
+		Check later counts are not shifted by replies left in pipes
+		"""
+		index = self.index
+		users = dict(enumerate(random.sample(coord, SQL_TESTDATA_COUNT)))
+		index.rebuild((user_id, x, y) for user_id, (x, y) in users.items())
+		self.assertGreater(len(index.shards), 1)
+		# Invalid y fails only shard owning x
+		with self.assertRaises(RuntimeError):
+			index.insertMany([(-1, 0, None), (-2, 999, 999)])
+		users[-2] = (999, 999)
+		self.assertNotIn(-1, index.owners)
+		self.assertIn(-2, index.owners)
+		first = index.shards[0]
+		receive = first.receive
+		def failReceive():
+			receive()
+			raise EOFError()
+		first.receive = failReceive
+		with self.assertRaises(EOFError):
+			index.countInCircle(500, 500, 2000)
+		first.receive = receive
+		for x0, y0 in list(users.values())[:10]:
+			self.assertEquals(index.countInCircle(x0, y0, 300), \
+						self._countInCircle(users, x0, y0, 300))
+
+class TestColumnIndex(SpatialIndexTestCase):
+	"""
+	Unittests for ColumnIndex
+	"""
+
+	def testCountInCircle(self):
+		"""
+		Use small chunks to check results are merged correctly
+		"""
+		self._assertValidIndex(ColumnIndex(7))
+
+	def testInsertIntoEmpty(self):
+		index = ColumnIndex(7)
+		for user_id in range(100):
+			index.insert(user_id, user_id, user_id)
+		self.assertEquals(index.countInCircle(0, 0, 10), 8)
+
+	def testCountInCircles(self):
+		"""
+		Compare vectorized batch with single circle counts
+		"""
+		index = ColumnIndex(7)
+		index.rebuild((user_id, x, y) for user_id, (x, y) in \
+					enumerate(random.sample(coord, SQL_TESTDATA_COUNT)))
+		circles = [(x, y, r) for x, y in random.sample(coord, 5) for r in (10, 100, 500)]
+		self.assertEquals(index.countInCircles(circles), \
+						[index.countInCircle(*circle) for circle in circles])
+		self.assertEquals(index.countInCircles([]), [])
+
+	def testInt32Corners(self):
+		"""
+		Put users in corners of int32 range
+		Check squared deltas do not overflow for small and huge R
+		"""
+		index = ColumnIndex(7)
+		corners = [(MIN_COORD, MIN_COORD), (MAX_COORD, MAX_COORD), \
+				(MAX_COORD, MIN_COORD), (MIN_COORD, MAX_COORD)]
+		index.rebuild((user_id, x, y) for user_id, (x, y) in enumerate(corners))
+		circles = [(x, y, r) for x, y in corners for r in (10, 2 ** 32 - 1, 2 ** 33)]
+		expected = [
+			len([1 for x, y in corners if (x - x0) ** 2 + (y - y0) ** 2 <= r * r]) \
+			for x0, y0, r in circles
+		]
+		self.assertEquals(expected[:3], [1, 3, 4])
+		self.assertEquals([index.countInCircle(*circle) for circle in circles], expected)
+		self.assertEquals(index.countInCircles(circles), expected)
+		self.assertEquals(index.countInCircles(circles[:1]), [1])
+
+class TestFenwickIndex(SpatialIndexTestCase):
+	"""
+	Unittests for FenwickIndex
+	"""
+
+	def testCountInCircle(self):
+		"""
+		Part of users is outside of Fenwick tree bounds
+		"""
+		self._assertValidIndex(FenwickIndex(512))
+
+	def testCountRect(self):
+		"""
+		Compare rect count with filtered users
+		"""
+		users = random.sample(coord, SQL_TESTDATA_COUNT)
+		index = FenwickIndex(512)
+		index.rebuild((user_id, x, y) for user_id, (x, y) in enumerate(users))
+		for i in range(20):
+			minX, maxX = sorted(random.sample(range(-10, 1010), 2))
+			minY, maxY = sorted(random.sample(range(-10, 1010), 2))
+			count = len([
+				(x, y) for x, y in users \
+				if minX <= x <= maxX and minY <= y <= maxY
+			])
+			self.assertEquals(index.countRect(minX, minY, maxX, maxY), count)
+
+	def testSplitValues(self):
+		"""
+		Compare split values with median of sorted coordinates
+		of users in rect, users of the strip outside of rect
+		do not move the split
+		"""
+		users = random.sample(coord, SQL_TESTDATA_COUNT)
+		index = FenwickIndex(512)
+		index.rebuild((user_id, x, y) for user_id, (x, y) in enumerate(users))
+		for i in range(20):
+			rect = sorted(random.sample(range(-10, 1010), 2)) + \
+					sorted(random.sample(range(-10, 1010), 2))
+			minX, maxX, minY, maxY = rect
+			for axis in ("x", "y"):
+				values = sorted(
+					(x if axis == "x" else y) for x, y in users \
+					if minX <= x <= maxX and minY <= y <= maxY
+				)
+				split = index.splitValues((minX, minY, maxX, maxY), axis)
+				if len(set(values)) < 2:
+					self.assertEquals(split, None)
+					continue
+				median = values[(len(values) - 1) // 2]
+				upper = [value for value in values if value > median]
+				if upper:
+					self.assertEquals(split, (median, upper[0]))
+				else:
+					self.assertEquals(split, (max(value for value in values if value < median), median))
+
+		index = FenwickIndex(16)
+		index.rebuild([(1, 1, 1), (2, 2, 1), (3, 3, 1), (4, 4, 1)] + \
+				[(i, 1, 10) for i in range(5, 100)])
+		self.assertEquals(index.splitValues((1, 0, 4, 5), "x"), (2, 3))
+
+	def testFenwickKnn(self):
+		"""
+		Compare split algorythm by Fenwick tree with all distances
+		"""
+		DBUser.query.delete()
+		for i in range(SQL_TESTDATA_COUNT * 10):
+			db.session.add(DBUser(*coord.pop()))
+		db.session.commit()
+		reloadIndexes()
+
+		knn = Knn()
+		for user in DBUser.query.limit(5):
+			for r in (10, 100, 500):
+				knn.x0, knn.y0, knn.r = user.x, user.y, r
+				self.assertEquals(knn.getFenwickkNN(), knn.getDistkNN())
+
+class TestKDTreeIndex(SpatialIndexTestCase):
+	"""
+	Unittests for KDTreeIndex
+	"""
+
+	def testCountInCircle(self):
+		"""
+		Check index with writes in overlay only
+		"""
+		self._assertValidIndex(KDTreeIndex(4, SQL_TESTDATA_COUNT))
+
+	def testBackgroundRebuild(self):
+		"""
+		Make enough writes to start background rebuild
+		Check tree is rebuilt and overlay is merged
+		"""
+		index = KDTreeIndex(4, 3)
+		self._assertValidIndex(index)
+		index.rebuild_thread.join()
+		self.assertTrue(index.pending < 3)
+		self._assertValidIndex(index)
+
+	def testNearest(self):
+		"""
+		Compare K nearest users with sorted distances
+		"""
+		users = dict(enumerate(random.sample(coord, SQL_TESTDATA_COUNT)))
+		index = KDTreeIndex(4, SQL_TESTDATA_COUNT)
+		index.rebuild((user_id, x, y) for user_id, (x, y) in users.items())
+		users[-1] = (500, 500)
+		index.insert(-1, 500, 500)
+		del users[1]
+		index.delete(1)
+		for user_id, (x0, y0) in list(users.items())[:10]:
+			for k, r in ((1, 2000), (5, 100), (20, 300), (200, 2000)):
+				self.assertEquals(index.nearest(x0, y0, k, r, user_id), \
+						self._nearest(users, x0, y0, k, r, user_id))
+
+class TestQuantileIndex(unittest.TestCase):
+	"""
+	Unittests for QuantileIndex
+	"""
+
+	def testSplitValues(self):
+		"""
+		Compare quantiles and split values with sorted coordinates
+		after rebuild, bulk insert, update and delete
+		"""
+		users = dict(enumerate(random.sample(coord, SQL_TESTDATA_COUNT)))
+		index = QuantileIndex()
+		index.rebuild((user_id, x, y) for user_id, (x, y) in users.items())
+		bulk = dict((-i, (i, i)) for i in range(1, 201))
+		users.update(bulk)
+		index.insertMany((user_id, x, y) for user_id, (x, y) in bulk.items())
+		users[0] = (1, 1)
+		index.update(0, 1, 1)
+		del users[1]
+		index.delete(1)
+		self.assertEquals(index.count, len(users))
+
+		xs = sorted(x for x, _ in users.values())
+		self.assertEquals(index.quantile("x", 0, 1000, 0), xs[0])
+		self.assertEquals(index.quantile("x", 0, 1000, 1), xs[-1])
+		self.assertEquals(index.quantile("x", 2000, 3000, 0.5), None)
+		for i in range(20):
+			low, high = sorted(random.sample(range(0, 1000), 2))
+			values = [x for x in xs if low <= x <= high]
+			left, right = index.splitValues("x", low, high) or (None, None)
+			if len(set(values)) < 2:
+				self.assertEquals(left, None)
+				continue
+			self.assertEquals(index.median("x", low, high), values[(len(values) - 1) // 2])
+			# Halves are split by adjacent values and none is empty
+			lower = [x for x in values if x <= left]
+			upper = [x for x in values if x >= right]
+			self.assertEquals(len(lower) + len(upper), len(values))
+			self.assertTrue(lower and upper)
+		self.assertEquals(index.splitValues("y", 1, 1), None)
+
 if __name__ == "__main__":
 	suites = list()
-	for test in (TestDB, TestUserList, TestUser, TestInfo, TestKnn):
+	for test in (TestDB, TestUserList, TestUserBulk, TestUserExport, TestUser, TestInfo, TestMetrics, TestKnn, TestKnnBatch, TestRegion, \
+				TestGridIndex, TestShardedIndex, TestColumnIndex, TestKDTreeIndex, \
+				TestFenwickIndex, TestQuantileIndex, TestAggregateTracker, TestLRUCache, TestResultCache, TestSnapshotStore, TestWarmStart):
 		suites.append(unittest.TestLoader().loadTestsFromTestCase(test))
 	suite = unittest.TestSuite(suites)
 	results = unittest.TextTestRunner(verbosity = 2).run(suite)